@@ -1,11 +1,16 @@
 import argparse
+import hashlib
+import json
 import logging
 import os
 import re
+import socket
 import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import nullcontext
 from datetime import datetime, timedelta
-from logging.handlers import TimedRotatingFileHandler
-from typing import List, Optional, Set, Union, Tuple
+from typing import Dict, List, Optional, Set, Union, Tuple
 
 import tweepy
 
@@ -14,9 +19,20 @@ from bot_messages import AUTO_DM_NO_ALT_TEXT, AUTO_REPLY_NO_DM_NO_ALT_TEXT, \
     HEADER_REPORT, FOOTER_REPORT, SINGLE_USER_NO_ALT_TEXT_QUERY, SINGLE_USER_REPORT_FIRST_PLACE, \
     SINGLE_USER_REPORT_SECOND_PLACE, SINGLE_USER_REPORT_THIRD_PLACE, HEADER_REPORT_PERIODIC_FRIENDS, \
     HEADER_REPORT_PERIODIC_FOLLOWERS, FOOTER_REPORT_PERIODIC, ALL_ALT_TEXT_USER_PROVIDED, HEADER_ALT_TEXT_USER_PROVIDED, \
-    SUMMARY_REPORT, UNAVAILABLE_TWEET
-
+    SUMMARY_REPORT, UNAVAILABLE_TWEET, HEADER_ALT_TEXT_BOT_SUGGESTED, UNIQUE_IMAGES_REPORT
+
+from api_access_layer.api_metrics import ApiMetrics, InstrumentedAPI, serve_metrics
+from api_access_layer.circuit_breaker import CircuitBreakers, CircuitOpenError, backoff_delay, is_outage
+from api_access_layer.fetch_profiles import profile_kwargs
+from api_access_layer.http_pool import install_shared_pool
+from api_access_layer.rate_limiter import RateLimiter
+from api_access_layer.token_pool import BOT_TOKEN, TokenPool
+from captioning.caption_worker import CaptionClient
+from captioning.captioning import suggest_alt_texts
 from data_access_layer.data_access import DBAccess
+from log_setup import setup_logging, OneLine, SCAN_LOG, TWEETS_LOG, DMS_LOG
+from profiling import Profiler
+from run_summary import RunSummary
 
 try:
     from settings_prod import CONSUMER_KEY, CONSUMER_SECRET, KEY, SECRET
@@ -24,9 +40,27 @@ except Exception as e:
     print('settings_prod not found; running just with settings')
     from settings import CONSUMER_KEY, CONSUMER_SECRET, KEY, SECRET
 
-from settings import ACCEPT_DM_TWEET_ID, LOG_LEVEL, LOG_FILENAME, LAST_N_TWEETS, DB_FILE, ALT_BOT_NAME, \
+try:
+    from settings_prod import READ_ONLY_TOKENS
+except Exception as e:
+    from settings import READ_ONLY_TOKENS
+
+from settings import ACCEPT_DM_TWEET_ID, LOG_FILENAME, LAST_N_TWEETS, DB_FILE, ALT_BOT_NAME, \
     MAX_RECONNECTION_ATTEMPTS, MAX_MENTIONS_TO_PROCESS, MAINTEINER_NAME, MAINTAEINER_ID, LAST_N_MENTIONS,\
-    MAX_DAYS_TO_REFRESH_TWEETS, LAST_N_TWEETS_MAX, MAX_CHARS_IN_TWEET
+    MAX_DAYS_TO_REFRESH_TWEETS, LAST_N_TWEETS_MAX, MAX_CHARS_IN_TWEET, DM_QUOTA_PER_DAY, BROADCAST_WORKERS, \
+    BROADCAST_MAX_ATTEMPTS, CAPTIONING_ENABLED, OCR_ENABLED, CAPTION_WORKER_SOCKET, \
+    BACKFILL_CHUNK_SIZE, BACKFILL_CAPTIONS_CHECKPOINT_KEY, SCAN_JOB_LEASE_SECONDS, SCAN_JOB_CLAIM_SIZE, \
+    SCAN_JOB_MAX_ATTEMPTS, SCHEDULE_MIN_INTERVAL, SCHEDULE_MAX_INTERVAL, SCHEDULE_BACKOFF_FACTOR, \
+    SCHEDULE_TARGET_IMAGE_TWEETS, SCHEDULE_RATE_SMOOTHING, SCHEDULE_HISTORY_DAYS, NEGATIVE_CACHE_TTL, \
+    TWITTER_API_HOST, TWITTER_API_CA_BUNDLE, API_METRICS_PROMETHEUS_FILE, API_METRICS_JSON_FILE, API_METRICS_PORT, \
+    API_POOL_SIZE, API_COMPRESSION, API_CONNECT_TIMEOUT, API_READ_TIMEOUT, BROADCAST_DMS_PER_MINUTE, BROADCAST_BURST
+
+
+# loggers of the hot paths, DEBUG records can be sampled with LOG_SAMPLING; log with %-style arguments, so nothing is
+# formatted if the record is not written
+scan_logger = logging.getLogger(SCAN_LOG)
+tweets_logger = logging.getLogger(TWEETS_LOG)
+dms_logger = logging.getLogger(DMS_LOG)
 
 
 class AltBot:
@@ -43,37 +77,103 @@ class AltBot:
         self.live = live
 
         self.processed_tweets = set()  # type: Set[str]
+        # photos of the tweets read in the last user_timeline, to avoid reading them again one by one
+        self.timeline_photos = {}  # type: Dict[str, Optional[List[Dict[str, Optional[str]]]]]
 
         self.db = DBAccess(DB_FILE)
+        # identifies this process as owner of the scan jobs it claims
+        self.worker_id = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+        # timings and counts of this run, saved in the run history at the end
+        self.run_summary = RunSummary(self.worker_id)
 
         self.api = None  # type: tweepy.API
+        # read calls are spread over the bot token and READ_ONLY_TOKENS
+        self.read_pool = None  # type: TokenPool
         self.alt_bot_user = None  # type: tweepy.models.User
+        # every call to the API, with any token, is recorded here
+        self.api_metrics = ApiMetrics()
+        # during outages, calls to the failing group of endpoints pause instead of failing one by one
+        self.circuit_breakers = CircuitBreakers(metrics=self.api_metrics)
+
+        # budget of the run: epoch to stop at and max number of read calls to the API; None means no limit
+        self.deadline = None  # type: Optional[float]
+        self.max_api_calls = None  # type: Optional[int]
 
         self.connect_api()
-        self.load_alt_bot_user()
 
     # region: Tweeter API interaction
     def connect_api(self) -> None:
         """
-        Stablish a connection with the Tweeter API. In case some other opperation get the connection closed,
-        reopen it again
-        :return: None; self.api is instantiated when succeeds, otherwise raises an arror
+        Stablish a connection with the Tweeter API, checking the credentials with it. If the API is not available, try
+        again up to MAX_RECONNECTION_ATTEMPTS times with exponential backoff
+        :return: None; self.api and self.alt_bot_user are instantiated when succeeds, otherwise raises an arror
         """
 
+        if TWITTER_API_CA_BUNDLE is not None:
+            # requests trusts the certificates in this bundle, e.g. the one of a local stand-in of the API
+            os.environ['REQUESTS_CA_BUNDLE'] = TWITTER_API_CA_BUNDLE
+
+        # every API (bot identity and read tokens) and every thread reuse the same connections
+        install_shared_pool(API_POOL_SIZE)
+        http_kwargs = dict(host=TWITTER_API_HOST, compression=API_COMPRESSION,
+                           timeout=(API_CONNECT_TIMEOUT, API_READ_TIMEOUT))
+
+        self.api = InstrumentedAPI(tweepy.API(self.auth, wait_on_rate_limit=True, wait_on_rate_limit_notify=True,
+                                              **http_kwargs), self.api_metrics, self.circuit_breakers)
+        self.read_pool = TokenPool([(CONSUMER_KEY, CONSUMER_SECRET, KEY, SECRET)] + list(READ_ONLY_TOKENS),
+                                   metrics=self.api_metrics, breakers=self.circuit_breakers, **http_kwargs)
+
+        # creating the APIs does not touch the network, the first call does
         i = 0
-        while i < MAX_RECONNECTION_ATTEMPTS:
+        while True:
             try:
-                self.api = tweepy.API(self.auth, wait_on_rate_limit=True, wait_on_rate_limit_notify=True)
+                self.load_alt_bot_user()
                 break
-            except Exception as e:
-                logging.warning(f'[{i}/{MAX_RECONNECTION_ATTEMPTS}] Can not connect: {e}')
+            except tweepy.TweepError as e:
                 i += 1
+                if not is_outage(e) or i >= MAX_RECONNECTION_ATTEMPTS:
+                    # e.g. wrong credentials, trying again does not help
+                    msg = f'[{i}/{MAX_RECONNECTION_ATTEMPTS}] Can not connect: {e}'
+                    logging.error(msg)
+                    raise Exception(msg)
+                delay = backoff_delay(i - 1)
+                logging.warning(f'[{i}/{MAX_RECONNECTION_ATTEMPTS}] Can not connect: {e}; '
+                                f'trying again in {delay:.0f} s')
+                time.sleep(delay)
+
+        logging.info(f'Connected to Tweeter API at {TWITTER_API_HOST}, {len(self.read_pool)} tokens for reading')
+
+    def read_pages(self, sync_key: str, method, to_user, kindly_sleep: float,
+                   **kwargs) -> Set[Tuple[Optional[str], int]]:
+        """
+        Read all pages of a cursor paginated API method. Each page is saved in the DB with the cursor of the next
+        one, so if the process dies the next call with the same sync_key resumes from the last page read
+        :param sync_key: name of the fetch, to find its checkpoint
+        :param method: tweepy.API method, paginated with cursors
+        :param to_user: function from each item in the pages to a pair (screen_name, user_id); screen_name may be None
+        :param kindly_sleep: time to sleep between pages to prevent overloading the API
+        :param kwargs: arguments for the method
+        :return: set of (screen_name, user_id) in all pages
+        """
+        cursor, result = self.db.get_sync_checkpoint(sync_key)
+        if cursor is not None:
+            logging.info(f'Resuming {sync_key} from cursor {cursor}, {len(result)} users already read')
+            kwargs['cursor'] = cursor
+
+        # cursor 0 means the last page was already read
+        if cursor != 0:
+            pages = tweepy.Cursor(method, **kwargs).pages()
+            for page in pages:
+                begin = time.time()
+                users = [to_user(p) for p in page]
+                result.update(users)
+                self.db.save_sync_page(sync_key, users, pages.next_cursor)
+                # go to sleep some time to avoid being banned
+                time.sleep(max(kindly_sleep - (time.time() - begin), 0))
+
+        self.db.clear_sync_checkpoint(sync_key)
 
-        if i >= MAX_RECONNECTION_ATTEMPTS:
-            msg = f'[{i}/{MAX_RECONNECTION_ATTEMPTS}] Can not connect.'
-            logging.error(msg)
-            raise Exception(msg)
-        logging.info('Connected to Tweeter API')
+        return result
 
     def get_retweeters(self, tweet_id: int, kindly_sleep: float = 15) -> Set[int]:
         """
@@ -82,31 +182,37 @@ class AltBot:
         :param kindly_sleep: time to sleep to prevent overloading the API, 15 requests in 15 minutes
         :return: set of user ids who retweeted the tweet
         """
-        result = set()  # type: Set[int]
-
         logging.info(f'Reading users who RTed this tweet: {tweet_id}')
 
-        for page in tweepy.Cursor(self.api.retweeters, id=tweet_id, count=500).pages():
-            begin = time.time()
-            for p in page:
-                result.add(p)
-            # go to sleep some time to avoid being banned
-            time.sleep(max(kindly_sleep - (time.time() - begin), 0))
+        result = {user_id for _, user_id in self.read_pages(f'retweeters_{tweet_id}', self.api.retweeters,
+                                                            lambda p: (None, p), kindly_sleep, id=tweet_id,
+                                                            count=500)}
 
         logging.info(f'{len(result)} RTed this tweet: {tweet_id}')
 
         return result
 
-    def get_tweet(self, tweet_id: str):
+    def get_tweet(self, tweet_id: str, profile: str = 'media_alt_only') -> dict:
         """
         Read particular tweet from the API
         :param tweet_id: id of the twet to be read from the API
-        :return: tweet, as tweepy object
+        :param profile: fetch profile, what to read of the tweet; see FETCH_PROFILES
+        :return: tweet, as the dict of its JSON
         """
-        status = self.api.get_status(tweet_id, include_ext_alt_text=True,
-                                         include_entities=True, tweet_mode="extended")
+        status = self.read_pool.call('get_status', tweet_id, **profile_kwargs(profile))
         return status
 
+    def lookup_photos(self, tweet_ids: List[str]) -> Dict[str, Optional[List[Dict[str, Optional[str]]]]]:
+        """
+        Read several tweets at once (up to 100) and extract their photos
+        :param tweet_ids: ids of the tweets to read
+        :return: dict from tweet_id to its photos, as described in get_photos; unavailable tweets are missing. Raises
+         TweepError if the lookup fails, so the tweets are not taken as unavailable
+        """
+        tweets = self.read_pool.call('statuses_lookup', tweet_ids, **profile_kwargs('media_alt_only'))
+
+        return {tweet['id_str']: self.resolve_known_media(self.extract_photos(tweet)) for tweet in tweets}
+
     def load_alt_bot_user(self):
         self.alt_bot_user = self.api.verify_credentials()
 
@@ -122,16 +228,8 @@ class AltBot:
         :param kindly_sleep: time to sleep to prevent overloading the API, 15 requests in 15 minutes
         :return: yields pair of  (screen_name, id)
         """
-        result = set()  # type: Set[Tuple[str, int]]
-
-        for page in tweepy.Cursor(self.api.followers, screen_name=screen_name, count=500).pages():
-            begin = time.time()
-            for p in page:
-                result.add((p.screen_name, p.id))
-            # go to sleep some time to avoid being banned
-            time.sleep(max(kindly_sleep - (time.time() - begin), 0))
-
-        return result
+        return self.read_pages(f'followers_{screen_name}', self.api.followers, lambda p: (p.screen_name, p.id),
+                               kindly_sleep, screen_name=screen_name, count=500)
 
     def get_allowed_to_dm_from_api(self) -> Set[int]:
         """
@@ -151,39 +249,51 @@ class AltBot:
         :return: set of pairs (screen_name, id)
         """
 
-        result = set()  # type: Set[Tuple[str, int]]
-
-        for page in tweepy.Cursor(self.api.friends, screen_name=screen_name, count=500).pages():
-            begin = time.time()
-            for p in page:
-                result.add((p.screen_name, p.id))
-            # go to sleep some time to avoid being banned
-            time.sleep(max(kindly_sleep - (time.time() - begin), 0))
+        result = self.read_pages(f'friends_{screen_name}', self.api.friends, lambda p: (p.screen_name, p.id),
+                                 kindly_sleep, screen_name=screen_name, count=500)
 
         return result
 
-    def get_last_tweets_for_account(self, screen_name: str, n_tweets: int, include_rts: bool = False) -> List[str]:
+    def get_last_tweets_for_account(self, screen_name: str, n_tweets: int, include_rts: bool = False,
+                                    user_id: Optional[int] = None) -> List[str]:
         """
         get the last n_tweets for @screen_name user, as a list of tweeter_id strings
         :param screen_name: name of the account to extract its tweets
         :param n_tweets: max number of tweets to extract of accounts, 0 <= n_tweets <= 200
         :param include_rts: wether to include re tweets or not
+        :param user_id: id of the account, if known; accounts that recently could not be read are not requested
         :return: List of ids for last tweets
         """
 
+        if user_id is not None:
+            error_code = self.db.get_negative_cache('user', user_id)
+            if error_code is not None:
+                scan_logger.debug('Skipping %s, can not be read: error %s', screen_name, error_code)
+                return []
+
+        timeline_kwargs = dict(screen_name=screen_name,
+                               # 200 is the maximum allowed count
+                               count=n_tweets,
+                               include_rts=include_rts,
+                               # only the ids and the photos of the tweets are used
+                               **profile_kwargs('media_alt_only'))
         try:
-            results = self.api.user_timeline(screen_name=screen_name,
-                                             # 200 is the maximum allowed count
-                                             count=n_tweets,
-                                             include_rts=include_rts,
-                                             # Necessary to keep full_text
-                                             # otherwise only the first 140 words are extracted
-                                             tweet_mode='extended'
-                                             )
-
-            tweets_ids = [tweet.id_str for tweet in results]
+            try:
+                results = self.read_pool.call('user_timeline', **timeline_kwargs)
+            except tweepy.error.TweepError as tpe:
+                not_authorized = tpe.response is not None and tpe.response.status_code == 401
+                if not not_authorized or len(self.read_pool) == 1 or user_id is None or not self.db.is_friend(user_id):
+                    raise
+                # a protected account the bot follows: only the bot's own token can read it
+                scan_logger.debug('Reading protected %s with the bot token', screen_name)
+                results = self.read_pool.call('user_timeline', token=BOT_TOKEN, **timeline_kwargs)
+
+            tweets_ids = [tweet['id_str'] for tweet in results]
+            self.timeline_photos = {tweet['id_str']: self.extract_photos(tweet) for tweet in results}
         except tweepy.error.TweepError as tpe:
             logging.error(f'can not extract tweets for {screen_name}: {tpe}')
+            if user_id is not None:
+                self.remember_unreadable('user', user_id, tpe)
             tweets_ids = []
 
         return tweets_ids
@@ -197,10 +307,11 @@ class AltBot:
         if self.live:
             try:
                 self.api.create_favorite(tweet_id)
+                self.run_summary.count('favs')
             except tweepy.error.TweepError as tw_error:
                 logging.error(f'Can not fav tweet {tweet_id}: {tw_error}')
 
-        logging.debug(f'[live={self.live}] - fav {tweet_id}')
+        tweets_logger.debug('[live=%s] - fav %s', self.live, tweet_id)
 
     def reply(self, reply_to: str, msg: str, tweet_id: str) -> None:
         """
@@ -219,11 +330,13 @@ class AltBot:
                     status=msg,
                     in_reply_to_status_id=tweet_id
                 )
+                self.run_summary.count('replies')
             except tweepy.error.TweepError as tw_error:
                 logging.error(f'Can not send tweet to {reply_to} in reply '
                               f'to {self.get_tweet_url(reply_to, tweet_id)}: {tw_error}')
 
-        logging.debug(f'[live={self.live}] - reply tweet to {tweet_id} in {len(msg)} chars: [{msg}]'.replace("\n", ";"))
+        tweets_logger.debug('[live=%s] - reply tweet to %s in %d chars: [%s]', self.live, tweet_id, len(msg),
+                            OneLine(msg))
 
     def reply_thread(self, reply_to: str, thread_message: List[str], tweet_id: str) -> None:
         """
@@ -234,9 +347,9 @@ class AltBot:
         :return: None
         """
 
-        logging.debug(f'Collapse thread with {len(thread_message)} messages...')
+        tweets_logger.debug('Collapse thread with %d messages...', len(thread_message))
         thread_message = self.collapse_text_in_tweets(thread_message)
-        logging.debug(f'Collapsed thread now contains {len(thread_message)} messages...')
+        tweets_logger.debug('Collapsed thread now contains %d messages...', len(thread_message))
 
         for single_message in thread_message:
             msg = single_message  # f'@{reply_to} {single_message}'
@@ -249,11 +362,12 @@ class AltBot:
                         auto_populate_reply_metadata=True
                     )
                     tweet_id = status.id
+                    self.run_summary.count('replies')
                 except tweepy.error.TweepError as tw_error:
                     logging.error(f'Can not send tweet to {reply_to} in reply '
                                   f'to {self.get_tweet_url(reply_to, tweet_id)}: {tw_error}')
-            logging.debug(
-                f'[live={self.live}] - reply tweet to {tweet_id} in {len(msg)} chars: [{msg}]'.replace("\n", ";"))
+            tweets_logger.debug('[live=%s] - reply tweet to %s in %d chars: [%s]', self.live, tweet_id, len(msg),
+                                OneLine(msg))
 
     def write_tweet(self, message: str) -> None:
         """
@@ -267,6 +381,7 @@ class AltBot:
                 self.api.update_status(
                     status=message
                 )
+                self.run_summary.count('tweets')
             except tweepy.error.TweepError as tw_error:
                 logging.error(f'Can not send tweet {message}: {tw_error}')
         logging.debug(
@@ -286,7 +401,8 @@ class AltBot:
         try:
             if self.live:
                 self.api.send_direct_message(recipient_id, msg)
-            logging.debug(f'[live={self.live}] - send Direct Message to {recipient_id}: [[{msg}]]'.replace("\n", ";"))
+                self.run_summary.count('dms')
+            dms_logger.debug('[live=%s] - send Direct Message to %s: [[%s]]', self.live, recipient_id, OneLine(msg))
             ret = 0
 
         except tweepy.error.TweepError as tw_error:
@@ -428,7 +544,7 @@ class AltBot:
         :return: None
         """
         n_local_allowed_to_dm = self.db.count_allowed_to_dm()
-        n_real_allowed = self.get_tweet(ACCEPT_DM_TWEET_ID).retweet_count
+        n_real_allowed = self.get_tweet(ACCEPT_DM_TWEET_ID, 'ids_only')['retweet_count']
 
         logging.info(f'Locally have {n_local_allowed_to_dm} allowed_to_dm currently they are {n_real_allowed}. '
                      f'Needed = {needed}')
@@ -481,39 +597,183 @@ class AltBot:
         """
         return f'https://twitter.com/{user_screen_name}/status/{tweet_id}'
 
-    def get_alt_text(self, tweet_id: str) -> Union[List[Union[str, None]], int, None]:
+    def get_photos(self, tweet_id: str) -> Union[List[Dict[str, Optional[str]]], int, None]:
         """
-        This method gets back alt_text from the given tweet_id
+        This method gets back the photos attached to the given tweet_id
         :param tweet_id: str identifying a tweet
         :return: if the tweet does not contain media, returns None
-                 if the tweet contain images, returns a list with.
-                     Each element of the list contains a string with the alt_text if available,
-                     None otherwise.
-                Consider a single tweet may contain up to 4 images and each of them can not contain an alt_text.
+                 if the tweet contain images, returns a list with a dict for each of them, with keys
+                     media_key: twitter id of the media
+                     alt_text: the alt_text given by the user if available, None otherwise
+                     url: url of the image, to download it
+                     bot_alt_text: the alt_text suggested by the bot if the media was already seen, None otherwise
                 if tweet can't be read, then return -1
         """
-        try:
-            tweet = self.get_tweet(tweet_id)
-        except tweepy.TweepError as e:
-            logging.info(f'Can not read tweet {tweet_id}. Exception thrown {e}')
-            return -1
-
-        if hasattr(tweet, 'extended_entities'):
-            if len(tweet.extended_entities['media']) > 0:
-                result = [media['ext_alt_text'] for media in tweet.extended_entities['media'] if
-                          media['type'] == 'photo']
-                logging.debug(f'Tweet {tweet_id} contains extended_entities and media: {result}.')
+        if tweet_id in self.timeline_photos:
+            # already read with the timeline of the account
+            photos = self.timeline_photos.pop(tweet_id)
+        else:
+            photos = self.db.get_tweet_media(tweet_id)
+
+            if not photos:
+                error_code = self.db.get_negative_cache('tweet', tweet_id)
+                if error_code is not None:
+                    logging.info(f'Can not read tweet {tweet_id}: error {error_code} (cached)')
+                    return -1
+                try:
+                    tweet = self.get_tweet(tweet_id)
+                except tweepy.TweepError as e:
+                    logging.info(f'Can not read tweet {tweet_id}. Exception thrown {e}')
+                    self.remember_unreadable('tweet', tweet_id, e)
+                    return -1
+                photos = self.extract_photos(tweet)
+
+        return self.resolve_known_media(photos)
+
+    def remember_unreadable(self, target_type: str, target_id: Union[int, str], error: tweepy.TweepError) -> None:
+        """
+        Save the account or tweet in the negative cache if the error means it will not be readable for a while
+        (protected, suspended, deleted...), see NEGATIVE_CACHE_TTL
+        :param target_type: 'user' or 'tweet'
+        :param target_id: id of the user or tweet
+        :param error: error got when reading it
+        :return: None
+        """
+        # several errors come as a list of codes
+        error_codes = error.api_code if isinstance(error.api_code, list) else [error.api_code]
+        for error_code in error_codes:
+            if error_code in NEGATIVE_CACHE_TTL:
+                self.db.add_negative_cache(target_type, target_id, error_code, NEGATIVE_CACHE_TTL[error_code])
+                return
+
+    def resolve_known_media(self, photos: Optional[List[Dict[str, Optional[str]]]]) \
+            -> Optional[List[Dict[str, Optional[str]]]]:
+        """
+        Complete the photos with the bot alt_text of those already seen in other tweets (quotes, replies, reposts)
+        :param photos: list of photos, as returned by get_photos, or None
+        :return: the same photos, with bot_alt_text set for known media
+        """
+        for photo in photos or []:
+            if photo.get('bot_alt_text') is None:
+                known = self.db.get_media(photo['media_key'])
+                photo['bot_alt_text'] = None if known is None else known['bot_alt_text']
+
+        return photos
+
+    def index_photos(self, tweet_id: str, user_id: int, photos: List[Dict[str, Optional[str]]],
+                     bot_alt_texts: Optional[List[Optional[str]]] = None) -> None:
+        """
+        Save the photos of the tweet in the media index
+        :param tweet_id: id of the tweet
+        :param user_id: id of the author of the tweet
+        :param photos: photos of the tweet, as returned by get_photos
+        :param bot_alt_texts: suggestions computed for the photos, aligned with them
+        :return: None
+        """
+        if bot_alt_texts:
+            photos = [dict(photo, bot_alt_text=text or photo.get('bot_alt_text'))
+                      for photo, text in zip(photos, bot_alt_texts)]
+
+        self.db.index_tweet_media(tweet_id, user_id, photos)
+
+    @staticmethod
+    def extract_photos(tweet: dict) -> Optional[List[Dict[str, Optional[str]]]]:
+        """
+        Extract the photos attached to the tweet
+        :param tweet: tweet read with the media_alt_only fetch profile, as a dict
+        :return: None if the tweet does not contain media, otherwise the list of photos as described in get_photos
+        """
+        if 'extended_entities' in tweet:
+            if len(tweet['extended_entities']['media']) > 0:
+                result = [dict(media_key=media['id_str'], alt_text=media['ext_alt_text'], url=media['media_url_https'])
+                          for media in tweet['extended_entities']['media'] if media['type'] == 'photo']
+                scan_logger.debug('Tweet %s contains extended_entities and media: %s.', tweet['id_str'], result)
             else:
                 # This is a tweet without media, not sure if this can happen
-                logging.debug(f'Tweet {tweet_id} contains extended_entities but not media.')
+                scan_logger.debug('Tweet %s contains extended_entities but not media.', tweet['id_str'])
                 result = None
         else:
             # This is a tweet without images or multimedia
-            logging.debug(f'Tweet {tweet_id} does not contain extended_entities.')
+            scan_logger.debug('Tweet %s does not contain extended_entities.', tweet['id_str'])
             result = None
 
         return result
 
+    def get_alt_text(self, tweet_id: str) -> Union[List[Union[str, None]], int, None]:
+        """
+        This method gets back alt_text from the given tweet_id
+        :param tweet_id: str identifying a tweet
+        :return: if the tweet does not contain media, returns None
+                 if the tweet contain images, returns a list with.
+                     Each element of the list contains a string with the alt_text if available,
+                     None otherwise.
+                Consider a single tweet may contain up to 4 images and each of them can not contain an alt_text.
+                if tweet can't be read, then return -1
+        """
+        photos = self.get_photos(tweet_id)
+
+        if photos == -1 or photos is None:
+            return photos
+
+        return [photo['alt_text'] for photo in photos]
+
+    @staticmethod
+    def request_alt_texts(urls: List[str], raise_errors: bool = False) -> List[Optional[str]]:
+        """
+        Compute an alt_text suggestion for each image, in the caption worker if configured, otherwise locally
+        :param urls: list of image urls
+        :param raise_errors: raise the errors of the captioner instead of returning no suggestions
+        :return: list aligned with urls with the suggested alt_text, None if it could not be computed
+        """
+        if not urls or (not CAPTIONING_ENABLED and not OCR_ENABLED):
+            return [None] * len(urls)
+
+        try:
+            if CAPTION_WORKER_SOCKET:
+                # the models are loaded once by the caption worker, shared with other bot processes
+                return CaptionClient().suggest_alt_texts(urls)
+            return suggest_alt_texts(urls)
+        except Exception as e:
+            if raise_errors:
+                raise
+            logging.error(f'Can not compute alt_text suggestions: {e}', exc_info=True)
+            return [None] * len(urls)
+
+    def suggest_alt_texts(self, photos: List[Dict[str, Optional[str]]]) -> List[Optional[str]]:
+        """
+        Compute an alt_text suggestion for each photo without alt_text given by the user
+        :param photos: photos of a tweet, as returned by get_photos
+        :return: list aligned with photos with the suggested alt_text, None for photos which already have an alt_text
+                 or when captioning is disabled or fails
+        """
+        # media seen before in other tweets already have their suggestion
+        suggestions = [None if photo['alt_text'] else photo.get('bot_alt_text')
+                       for photo in photos]  # type: List[Optional[str]]
+        to_suggest = [i for i, photo in enumerate(photos) if not photo['alt_text'] and not suggestions[i]]
+
+        for i, suggestion in zip(to_suggest, self.request_alt_texts([photos[i]['url'] for i in to_suggest])):
+            suggestions[i] = suggestion
+
+        return suggestions
+
+    @staticmethod
+    def get_bot_alt_text_messages(bot_alt_texts: List[Optional[str]]) -> List[str]:
+        """
+        Build the messages to reply with the alt_texts suggested by the bot
+        :param bot_alt_texts: list of suggestions, aligned with the images of the tweet
+        :return: list of messages, empty if there are no suggestions
+        """
+        if not any(bot_alt_texts):
+            return []
+
+        messages = [HEADER_ALT_TEXT_BOT_SUGGESTED]
+        for template, text in zip(ALL_ALT_TEXT_USER_PROVIDED, bot_alt_texts):
+            if text is None:
+                continue
+            messages.extend(AltBot.split_text_in_tweets(template.format(alt_text=text)))
+
+        return messages
+
     @staticmethod
     def compute_alt_text_score(alt_texts: List[Union[str, None]]) -> float:
         """
@@ -527,7 +787,7 @@ class AltBot:
         return round(sum(alt_text_count) / len(alt_text_count), 2)
 
     def process_account(self, screen_name: str, user_id: int, follower: bool, allowed_to_be_dmed: bool,
-                        n_tweets: int) -> None:
+                        n_tweets: int) -> int:
         """
         Process an account checking its last n_tweets:
          - If all images in tweet contain alt_text, then it is faved
@@ -538,116 +798,297 @@ class AltBot:
         :param follower: whether or not the screen_name account is a follower
         :param allowed_to_be_dmed: whether or not the bot is allowed to contact the user via DM
         :param n_tweets: number of tweets to consider
-        :return: None
+        :return: number of new tweets with images found
         """
 
-        last_tweets = self.get_last_tweets_for_account(screen_name, n_tweets)
+        last_tweets = self.get_last_tweets_for_account(screen_name, n_tweets, user_id=user_id)
+        n_image_tweets = 0
+        self.run_summary.count('accounts_scanned')
+        self.run_summary.count('tweets_fetched', len(last_tweets))
 
         for tweet_id in last_tweets:
 
             try:
                 if self.db.tweet_was_processed(tweet_id):
                     # skip the tweet since it was already processed
+                    self.run_summary.count('tweets_already_processed')
                     continue
 
-                logging.info(f'Processing tweet {self.get_tweet_url(screen_name, tweet_id)}')
+                scan_logger.info('Processing tweet https://twitter.com/%s/status/%s', screen_name, tweet_id)
 
-                alt_texts = self.get_alt_text(tweet_id)
+                photos = self.get_photos(tweet_id)
+                alt_texts = photos if photos == -1 or photos is None else [photo['alt_text'] for photo in photos]
 
                 if alt_texts == -1:
                     # the tweet could not be read
-                    logging.debug(f'This tweet can not be read by us: '
-                                  f'{self.get_tweet_url(screen_name, tweet_id)}')
-                    self.db.save_processed_tweet(tweet_id)
+                    scan_logger.debug('This tweet can not be read by us: https://twitter.com/%s/status/%s',
+                                      screen_name, tweet_id)
+                    self.db.save_processed_tweet(tweet_id, user_id)
                     continue
 
                 if alt_texts is None or not alt_texts:
                     # skip since the tweet does not contain images
-                    logging.debug(f'This tweet is not interesting for us: '
-                                  f'{self.get_tweet_url(screen_name, tweet_id)}')
-                    self.db.save_processed_tweet(tweet_id)
+                    scan_logger.debug('This tweet is not interesting for us: https://twitter.com/%s/status/%s',
+                                      screen_name, tweet_id)
+                    self.db.save_processed_tweet(tweet_id, user_id)
                     continue
 
                 alt_text_score = self.compute_alt_text_score(alt_texts)
 
                 if alt_text_score == 1:
                     # all of the images contains alt_text, let's like it
-                    logging.debug(f'All images in tweet contain alt texts: '
-                                  f'{self.get_tweet_url(screen_name, tweet_id)}')
+                    scan_logger.debug('All images in tweet contain alt texts: https://twitter.com/%s/status/%s',
+                                      screen_name, tweet_id)
                     self.fav_tweet(tweet_id)
                 else:
                     # there are some images without alt_text; alert message needed
                     if follower and allowed_to_be_dmed:
                         # if it is a follower who allowed to be DMed by the bot, write a DM
-                        logging.debug(f'Some images ({alt_text_score*100} %) in tweet does not contain alt texts: '
-                                      f'{self.get_tweet_url(screen_name, tweet_id)} | '
-                                      f'DM the user, this is a follower')
+                        scan_logger.debug('Some images (%s %%) in tweet does not contain alt texts: '
+                                          'https://twitter.com/%s/status/%s | DM the user, this is a follower',
+                                          alt_text_score * 100, screen_name, tweet_id)
                         self.direct_message(screen_name, user_id, AUTO_DM_NO_ALT_TEXT.format(
                             self.get_tweet_url(screen_name, tweet_id)))
                     else:
                         # if it is not a follower or is not allowed to be DMed by the bot, just log it
-                        logging.debug(f'Some images ({alt_text_score*100} %) in tweet does not contain alt texts: '
-                                      f'{self.get_tweet_url(screen_name, tweet_id)} | '
-                                      f'IGNORED: follower: {follower} allowed_to_be_DMed: {allowed_to_be_dmed}')
-
-                # Compute user_alt_text_X as param to save each alt_text
+                        scan_logger.debug('Some images (%s %%) in tweet does not contain alt texts: '
+                                          'https://twitter.com/%s/status/%s | IGNORED: follower: %s '
+                                          'allowed_to_be_DMed: %s', alt_text_score * 100, screen_name, tweet_id,
+                                          follower, allowed_to_be_dmed)
+
+                # Compute user_alt_text_X as param to save each alt_text. Suggestions (bot_alt_text_X) take seconds of
+                # CPU per image: the scan leaves them to --backfill-captions, which captions in batches the tweets
+                # saved without them
                 user_alt_texts_params = {f'user_alt_text_{idx}': text for idx, text in enumerate(alt_texts, start=1)}
 
-                self.db.save_processed_tweet(tweet_id)
+                self.index_photos(tweet_id, user_id, photos)
+                self.db.save_processed_tweet(tweet_id, user_id)
                 self.db.save_processed_tweet_with_with_alt_text_info(screen_name, user_id, tweet_id, len(alt_texts),
                                                                      alt_text_score, **user_alt_texts_params)
+                n_image_tweets += 1
+                self.run_summary.count('image_tweets')
+                self.run_summary.count('images', len(alt_texts))
 
+            except CircuitOpenError:
+                raise
             except Exception as e:
                 logging.error(f'Exception: {e} while processing tweet '
                               f'https://twitter.com/{screen_name}/status/{tweet_id}', exc_info=True)
 
-    def process_followers(self, followers: Set[Tuple[str, int]], users_accepted: Set[int]) -> None:
+        return n_image_tweets
+
+    def process_followers(self, followers: Set[Tuple[str, int]], users_accepted: Set[int]) -> int:
         """
-        Process each follower account in followers set with self.process_account, as followers
+        Queue a scan job for each follower account in followers set due to be scanned and process them with
+        self.process_scan_jobs; other processes running with --worker followers help draining the queue
         :param followers: set of followers to be processed
         :param users_accepted: set of user ids who accepted to receive DMs
-        :return: None
+        :return: number of accounts scanned by this process
         """
 
-        n_followers = len(followers)
+        if self.start_scan_run('follower'):
+            # accounts more likely to have posted new images first
+            self.db.enqueue_scan_jobs('follower', [(follower_screen_name, follower_id, follower_id in users_accepted,
+                                                    expected_image_tweets)
+                                                   for follower_screen_name, follower_id, expected_image_tweets in
+                                                   self.get_due_accounts(followers)])
+        return self.process_scan_jobs('follower')
+
+    def process_friends(self, friends: Set[Tuple[str, int]], followers: Set[Tuple[str, int]]) -> int:
+        """
+        Queue a scan job for each friend account in friends set due to be scanned which is not in followers set
+        (those are processed as followers) and process them with self.process_scan_jobs; other processes running with
+        --worker friends help draining the queue
+        :param friends: set of friends
+        :param followers: set of followers
+        :return: number of accounts scanned by this process
 
-        for i, (follower_screen_name, follower_id) in enumerate(followers):
+        """
+        followers_ids = {f[1] for f in followers}  # type: Set[int]
 
-            logging.info(f'[{i}/{n_followers}] Processing follower @{follower_screen_name}...')
+        if self.start_scan_run('friend'):
+            friends = {(friend_screen_name, friend_id) for friend_screen_name, friend_id in friends
+                       if friend_id not in followers_ids}
 
-            try:
-                self.process_account(follower_screen_name, follower_id, follower=True, n_tweets=LAST_N_TWEETS,
-                                     allowed_to_be_dmed=follower_id in users_accepted)
-            except Exception as e:
-                logging.error(f'Error while processing follower: {follower_screen_name}:\n{e}')
-                continue
+            # accounts more likely to have posted new images first
+            self.db.enqueue_scan_jobs('friend', [(friend_screen_name, friend_id, False, expected_image_tweets)
+                                                 for friend_screen_name, friend_id, expected_image_tweets in
+                                                 self.get_due_accounts(friends)])
+        return self.process_scan_jobs('friend')
 
-    def process_friends(self, friends: Set[Tuple[str, int]], followers: Set[Tuple[str, int]]) -> None:
+    def start_scan_run(self, kind: str) -> bool:
         """
-        Process each friend account in friends set with self.process_account, as friends if they are not in
-        followers set, otherwise skip their processing
-        :param friends: set of friends
-        :param followers: set of followers
+        Start a new scan run of the given kind, unless the previous one did not finish (it was interrupted or ran
+        out of budget): then it is resumed, taking at once the jobs of dead workers of this host
+        :param kind: 'follower' or 'friend'
+        :return: True iff a new run was started, so its jobs must be queued
+        """
+        run_id = self.db.get_setting(f'scan_run_{kind}')
+
+        if run_id is None:
+            run_id = f'{datetime.now().strftime("%Y%m%d%H%M%S")}-{uuid.uuid4().hex[:8]}'
+            self.db.set_setting(f'scan_run_{kind}', run_id)
+            logging.info(f'Starting scan run {run_id} of {kind}s')
+            return True
+
+        logging.info(f'Resuming scan run {run_id} of {kind}s: {self.db.count_scan_jobs(kind)}')
+
+        hostname = socket.gethostname()
+        for owner in self.db.get_scan_job_lease_owners(kind):
+            owner_hostname, owner_pid, _ = owner.rsplit(':', 2)
+            if owner_hostname == hostname and owner != self.worker_id and not self.is_process_alive(int(owner_pid)):
+                logging.info(f'Worker {owner} is dead, releasing its jobs')
+                self.db.expire_scan_job_leases(kind, owner)
+
+        return False
+
+    @staticmethod
+    def is_process_alive(pid: int) -> bool:
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            # exists, owned by other user
+            return True
+        return True
+
+    def get_due_accounts(self, users: Set[Tuple[str, int]]) -> List[Tuple[str, int, float]]:
+        """
+        Select the accounts due to be scanned, according to their schedule. Accounts never scheduled are due, with
+        the rate of image tweets seen in the last SCHEDULE_HISTORY_DAYS
+        :param users: set of (screen_name, user_id)
+        :return: list of (screen_name, user_id, expected new image tweets) of the due accounts
+        """
+        now = time.time()
+        schedules = self.db.get_account_schedules()
+        history_start = (datetime.now() - timedelta(days=SCHEDULE_HISTORY_DAYS)).strftime("%Y-%m-%d %H:%M:%S")
+        image_tweets = self.db.count_image_tweets_by_user(history_start)
+
+        result = []
+        for screen_name, user_id in users:
+            schedule = schedules.get(user_id)
+            if schedule is None:
+                result.append((screen_name, user_id, image_tweets.get(user_id, 0) / SCHEDULE_HISTORY_DAYS *
+                               SCHEDULE_MAX_INTERVAL / 86400))
+            elif schedule['next_due_at'] <= now:
+                result.append((screen_name, user_id, schedule['image_rate'] * (now - schedule['last_scan_at']) / 86400))
+
+        logging.info(f'{len(result)}/{len(users)} accounts due to be scanned')
+
+        return result
+
+    def reschedule_account(self, user_id: int, n_image_tweets: int) -> None:
+        """
+        Update the rate of image tweets of the account with the last scan and compute when to scan it again: when
+        SCHEDULE_TARGET_IMAGE_TWEETS new ones are expected, or SCHEDULE_BACKOFF_FACTOR times later than the last
+        time if it posted no images, between SCHEDULE_MIN_INTERVAL and SCHEDULE_MAX_INTERVAL
+        :param user_id: id of the account just scanned
+        :param n_image_tweets: new tweets with images found in the scan
         :return: None
+        """
+        now = time.time()
+        schedule = self.db.get_account_schedule(user_id)
+
+        if schedule is None:
+            # first scan: the period covered by the scan is unknown, start with the rate from the history
+            history_start = (datetime.now() - timedelta(days=SCHEDULE_HISTORY_DAYS)).strftime("%Y-%m-%d %H:%M:%S")
+            image_rate = self.db.count_image_tweets_for_user(user_id, history_start) / SCHEDULE_HISTORY_DAYS
+            scan_interval = SCHEDULE_MIN_INTERVAL
+            # the tweets of the scan may have been processed before, with no schedule: only the history counts
+            no_new_images = False
+        else:
+            elapsed_days = max(now - schedule['last_scan_at'], SCHEDULE_MIN_INTERVAL) / 86400
+            image_rate = SCHEDULE_RATE_SMOOTHING * n_image_tweets / elapsed_days + \
+                (1 - SCHEDULE_RATE_SMOOTHING) * schedule['image_rate']
+            scan_interval = schedule['scan_interval']
+            no_new_images = n_image_tweets == 0
+
+        if no_new_images or image_rate <= 0:
+            scan_interval *= SCHEDULE_BACKOFF_FACTOR
+        else:
+            scan_interval = SCHEDULE_TARGET_IMAGE_TWEETS / image_rate * 86400
+        scan_interval = min(max(scan_interval, SCHEDULE_MIN_INTERVAL), SCHEDULE_MAX_INTERVAL)
 
+        scan_logger.debug('Account %s: %.2f image tweets per day, next scan in %s', user_id, image_rate,
+                          timedelta(seconds=int(scan_interval)))
+
+        self.db.save_account_schedule(user_id, image_rate, scan_interval, now, now + scan_interval)
+
+    def budget_exhausted(self) -> bool:
         """
-        followers_ids = {f[1] for f in followers}  # type: Set[int]
-        n_friends = len(friends)
+        Check the budget of the run, see --max-duration and --max-api-calls
+        :return: True iff the run must stop taking new work
+        """
+        if self.deadline is not None and time.time() >= self.deadline:
+            logging.info('Run budget exhausted: max duration reached')
+            return True
+        if self.max_api_calls is not None and self.read_pool.n_calls >= self.max_api_calls:
+            logging.info(f'Run budget exhausted: {self.read_pool.n_calls} API calls')
+            return True
+        return False
 
-        for i, (friend_screen_name, friend_id) in enumerate(friends):
+    def process_scan_jobs(self, kind: str) -> int:
+        """
+        Claim scan jobs of the given kind and process each account with self.process_account, until the queue is
+        empty, the budget of the run is exhausted or the API stays down longer than CIRCUIT_MAX_PAUSE. Jobs are
+        leased: if this process dies, other workers take them when the lease expires. Jobs not done stay pending for
+        the next run
+        :param kind: 'follower' or 'friend'
+        :return: number of accounts processed by this process
+        """
+        n_processed = 0
+        api_down = False
 
-            if friend_id in followers_ids:
-                # this friend is also a follower, we can skip it
-                continue
+        while not api_down and not self.budget_exhausted():
+            jobs = self.db.claim_scan_jobs(kind, self.worker_id, SCAN_JOB_CLAIM_SIZE, SCAN_JOB_LEASE_SECONDS)
+            if not jobs:
+                break
+            # once per batch, for the log; other workers also drain the queue meanwhile, so it is approximate
+            n_pending = self.db.count_scan_jobs(kind).get('pending', 0)
 
-            logging.info(f'[{i}/{n_friends}] Processing friend @{friend_screen_name}...')
+            for i, (screen_name, user_id, allowed_to_dm) in enumerate(jobs):
 
-            try:
-                self.process_account(friend_screen_name, friend_id, follower=False, n_tweets=LAST_N_TWEETS,
-                                     allowed_to_be_dmed=False)
-            except Exception as e:
-                logging.error(f'Error while processing follower: {friend_screen_name}:\n{e}')
-                continue
+                if self.budget_exhausted():
+                    # leave the rest for the next run
+                    self.db.release_scan_jobs(kind, [job[1] for job in jobs[i:]], self.worker_id)
+                    break
+
+                # the job may have waited for the previous ones of the batch; renew the lease before starting
+                if not self.db.renew_scan_job_lease(kind, user_id, self.worker_id, SCAN_JOB_LEASE_SECONDS):
+                    logging.warning(f'Lease lost for {kind} @{screen_name}, skipping it')
+                    continue
+
+                # the rest of this batch is leased, not pending, but still to be done
+                scan_logger.info('[%d pending] Processing %s @%s...', n_pending + len(jobs) - i, kind, screen_name)
+
+                success = True
+                try:
+                    n_image_tweets = self.process_account(screen_name, user_id, follower=kind == 'follower',
+                                                          n_tweets=LAST_N_TWEETS, allowed_to_be_dmed=allowed_to_dm)
+                    self.reschedule_account(user_id, n_image_tweets)
+                    n_processed += 1
+                except CircuitOpenError as e:
+                    # the calls already waited for the API as long as allowed; leave the jobs for the next run
+                    logging.error(f'Stopping scan of {kind}s: {e}')
+                    self.db.release_scan_jobs(kind, [job[1] for job in jobs[i:]], self.worker_id)
+                    api_down = True
+                    break
+                except Exception as e:
+                    logging.error(f'Error while processing {kind}: {screen_name}:\n{e}')
+                    success = False
+
+                self.db.complete_scan_job(kind, user_id, self.worker_id, success, SCAN_JOB_MAX_ATTEMPTS)
+
+        jobs_by_status = self.db.count_scan_jobs(kind)
+        logging.info(f'Scan jobs of {kind}s drained by {self.worker_id}: {n_processed} processed here, '
+                     f'{jobs_by_status}')
+
+        if not jobs_by_status.get('pending') and not jobs_by_status.get('leased'):
+            # the run is over, the next one queues the due accounts again
+            self.db.delete_setting(f'scan_run_{kind}')
+
+        return n_processed
 
     def process_tweets_in_reply_to_other_tweet(self, mentions: List[tweepy.models.Status]):
 
@@ -695,10 +1136,11 @@ class AltBot:
                     # the tweet contain images with alt_text but we didn't have it, so lets download it and check
                     alt_text_info['user_alt_text'] = self.get_alt_text(str(tweet_to_process_tweet_id))
 
-                    if user_alt_text != -1:
+                    if alt_text_info['user_alt_text'] != -1:
                         update_params = {f'user_alt_text_{i}': txt for i, txt in
                                          enumerate(alt_text_info['user_alt_text'], start=1)}
-                        self.db.update_user_alt_text_info(str(tweet_to_process_tweet_id), **update_params)
+                        self.db.update_user_alt_text_info(str(tweet_to_process_tweet_id),
+                                                          tweet_to_process_user_id, **update_params)
 
                 if alt_text_score > 0:
 
@@ -724,8 +1166,20 @@ class AltBot:
                                       tweet_to_reply_id)
                 elif alt_text_score < 1:
                     logging.debug(f'Tweet being reply was already processed and NOT all images contain alt_text')
+                    if not any(alt_text_info['bot_alt_text']) and (CAPTIONING_ENABLED or OCR_ENABLED):
+                        # processed before the bot could suggest alt_texts; compute them now and keep them
+                        photos = self.get_photos(str(tweet_to_process_tweet_id))
+                        if photos != -1 and photos:
+                            alt_text_info['bot_alt_text'] = self.suggest_alt_texts(photos)
+                            self.index_photos(str(tweet_to_process_tweet_id), tweet_to_process_user_id, photos,
+                                              alt_text_info['bot_alt_text'])
+                            self.db.update_bot_alt_text_info(
+                                str(tweet_to_process_tweet_id), tweet_to_process_user_id,
+                                **{f'bot_alt_text_{i}': txt for i, txt in
+                                   enumerate(alt_text_info['bot_alt_text'], start=1)})
                     alt_text_messages = [SINGLE_USER_NO_ALT_TEXT_QUERY.format(
-                        tweet_to_process_screen_name)] + alt_text_messages
+                        tweet_to_process_screen_name)] + alt_text_messages + \
+                        self.get_bot_alt_text_messages(alt_text_info['bot_alt_text'])
                     self.reply_thread(tweet_to_reply_screen_name, alt_text_messages, tweet_to_reply_id)
                 else:
                     logging.debug(f'Tweet being reply was already processed and ALL images contain alt_text')
@@ -734,19 +1188,21 @@ class AltBot:
                     self.reply_thread(tweet_to_reply_screen_name, alt_text_messages, tweet_to_reply_id)
         else:
             # tweet is not in our DB; we need to get it from the API and process accordingly
-            alt_texts = self.get_alt_text(str(tweet_to_process_tweet_id))
+            photos = self.get_photos(str(tweet_to_process_tweet_id))
+            alt_texts = photos if photos == -1 or photos is None else [photo['alt_text'] for photo in photos]
+            bot_alt_texts = []  # type: List[Optional[str]]
 
             if alt_texts==-1:
                 # can not download the tweet
                 logging.debug(f'This tweet is not interesting for us, we can not read it {tweet_to_process_url}')
-                self.db.save_processed_tweet(str(tweet_to_process_tweet_id))
+                self.db.save_processed_tweet(str(tweet_to_process_tweet_id), tweet_to_process_user_id)
                 self.reply(tweet_to_reply_screen_name,
                            UNAVAILABLE_TWEET.format(screen_name=tweet_to_process_screen_name), tweet_to_reply_id)
 
             elif alt_texts is None or not alt_texts:
                 # skip since the tweet does not contain images
                 logging.debug(f'This tweet is not interesting for us: {tweet_to_process_url}')
-                self.db.save_processed_tweet(str(tweet_to_process_tweet_id))
+                self.db.save_processed_tweet(str(tweet_to_process_tweet_id), tweet_to_process_user_id)
                 self.reply(tweet_to_reply_screen_name,
                            AUTO_REPLY_NO_IMAGES_FOUND.format(tweet_to_process_screen_name), tweet_to_reply_id)
             else:
@@ -771,8 +1227,10 @@ class AltBot:
                     logging.debug(f'Some images ({alt_text_score * 100} %) in tweet does not contain '
                                   f'alt texts: {tweet_to_process_url}')
 
+                    bot_alt_texts = self.suggest_alt_texts(photos)
                     alt_text_messages = [SINGLE_USER_NO_ALT_TEXT_QUERY.format(
-                        tweet_to_process_screen_name)] + alt_text_messages
+                        tweet_to_process_screen_name)] + alt_text_messages + \
+                        self.get_bot_alt_text_messages(bot_alt_texts)
                     self.reply_thread(tweet_to_reply_screen_name, alt_text_messages, tweet_to_reply_id)
 
                     # also reply to the author if needed
@@ -782,10 +1240,13 @@ class AltBot:
                         self.direct_message(tweet_to_process_screen_name, tweet_to_process_user_id,
                                             AUTO_REPLY_NO_DM_NO_ALT_TEXT.format(tweet_to_process_url))
 
-                # Compute user_alt_text_X as param to save each alt_text
+                # Compute user_alt_text_X and bot_alt_text_X as param to save each alt_text
                 user_alt_texts_params = {f'user_alt_text_{idx}': text for idx, text in enumerate(alt_texts, start=1)}
+                user_alt_texts_params.update({f'bot_alt_text_{idx}': text for idx, text in
+                                              enumerate(bot_alt_texts, start=1)})
 
                 # save the processed tweet as processed with images data
+                self.index_photos(str(tweet_to_process_tweet_id), tweet_to_process_user_id, photos, bot_alt_texts)
                 self.db.save_processed_tweet_with_with_alt_text_info(tweet_to_process_screen_name,
                                                                      tweet_to_process_user_id,
                                                                      str(tweet_to_process_tweet_id),
@@ -798,7 +1259,7 @@ class AltBot:
         # the watch use case is run; B's reply is processed
         # the mentions use case is run, B's reply must be processed again since
         # now we're checking for A's tweet
-        self.db.save_processed_tweet(str(tweet_to_process_tweet_id), do_not_fail=True)
+        self.db.save_processed_tweet(str(tweet_to_process_tweet_id), tweet_to_process_user_id, do_not_fail=True)
 
     @staticmethod
     def check_text_only_mention_users(text: str) -> bool:
@@ -891,7 +1352,7 @@ class AltBot:
         # the watch use case is run; A's tweet is processed
         # the mentions use case is run, A's tweet mentioning other accounts must be processed again since
         # now we're checking for accounts mentioned in A's tweet
-        self.db.save_processed_tweet(str(tweet.id), do_not_fail=True)
+        self.db.save_processed_tweet(str(tweet.id), tweet.author.id, do_not_fail=True)
 
     def process_original_tweets_mentioning_bot(self, tweets: List[tweepy.models.Status]):
         """
@@ -958,9 +1419,9 @@ class AltBot:
 
         allowed_to_be_dmed = self.db.get_allowed_to_dm()
         followers = self.db.get_followers()
-        self.process_followers(followers, allowed_to_be_dmed)
-        logging.info(f'{len(followers)} followers were processed, {len(allowed_to_be_dmed)} allowed to DM '
-                     f'({len(allowed_to_be_dmed)/len(followers)*100:.2} %)')
+        n_scanned = self.process_followers(followers, allowed_to_be_dmed)
+        logging.info(f'{n_scanned} followers were scanned, of {len(followers)} followers; {len(allowed_to_be_dmed)} '
+                     f'allowed to DM ({len(allowed_to_be_dmed)/len(followers)*100:.1f} %)')
 
     def watch_for_alt_text_usage_in_friends(self) -> None:
         """
@@ -973,14 +1434,27 @@ class AltBot:
 
         followers = self.db.get_followers()
         friends = self.db.get_friends()
-        self.process_friends(friends, followers)
-        logging.info(f'{len(friends)} friends were processed.')
+        n_scanned = self.process_friends(friends, followers)
+        logging.info(f'{n_scanned} friends were scanned, of {len(friends)} friends.')
+
+    @staticmethod
+    def get_broadcast_id(msg: str) -> str:
+        """
+        Compute the id of a broadcast from its message, so sending the same message again resumes the broadcast
+        :param msg: message being broadcast
+        :return: id of the broadcast
+        """
+        return hashlib.sha1(msg.encode('utf-8')).hexdigest()[:16]
 
-    def send_message_to_all_followers(self, msg: str) -> None:
+    def send_message_to_all_followers(self, msg: str) -> Dict[str, Dict[str, int]]:
         """
-        Send a DM to every follower
+        Send a DM to every follower as a resumable broadcast: the state of each delivery is saved on DB, so if the
+        run is interrupted (or the DM quota is exhausted), running it again with the same message continues
+        where it stopped. DMs are sent by BROADCAST_WORKERS threads, at most DM_QUOTA_PER_DAY in the last 24 hs and
+        BROADCAST_DMS_PER_MINUTE.
+        In a dry run (not live) the recipients are only logged, nothing is saved
         :param msg: string message to the followers or path to the file containing the message
-        :return: None
+        :return: delivery report, as status -> dict with the number of recipients and attempts in that status
         """
         if os.path.isfile(msg):
             logging.info(f'Reading message from file {msg}')
@@ -988,16 +1462,186 @@ class AltBot:
                 msg = f.read()
             logging.info(f'Read message: {msg}')
 
-        followers = self.db.get_followers()
-        msg_sent = 0
+        broadcast_id = self.get_broadcast_id(msg)
 
-        for follower_screen_name, follower_id in followers:
-            if self.direct_message(follower_screen_name, follower_id, msg) == 0:
-                msg_sent += 1
-            else:
-                logging.info(f'Can not write DM to {follower_screen_name}')
+        if not self.live:
+            # saving the deliveries would take them as sent in the live run, and count them in the quota
+            followers = self.db.get_followers()
+            for screen_name, user_id in followers:
+                dms_logger.debug('[live=False] - broadcast %s to %s: [[%s]]', broadcast_id, user_id, OneLine(msg))
+            logging.info(f'Broadcast {broadcast_id} (dry run): {len(followers)} followers would be messaged')
+            return self.db.get_broadcast_report(broadcast_id)
+
+        self.db.add_broadcast_recipients(broadcast_id, self.db.get_followers())
+        pending = self.db.get_pending_broadcast_recipients(broadcast_id, BROADCAST_MAX_ATTEMPTS)
+
+        # remaining quota for the last 24 hs, considering DMs sent by this or previous broadcasts
+        quota = DM_QUOTA_PER_DAY - self.db.count_dms_sent_since(datetime.now() - timedelta(days=1))
+        logging.info(f'Broadcast {broadcast_id}: {len(pending)} pending recipients, quota for {quota} DMs')
+
+        if quota < len(pending):
+            logging.warning(f'Broadcast {broadcast_id}: DM quota is not enough for all pending recipients; '
+                            f'run it again later to resume it')
+            pending = pending[:max(quota, 0)]
+
+        # the quota, already applied to pending, caps the DMs in 24 hs; the limiter spreads them over time
+        limiter = RateLimiter(BROADCAST_DMS_PER_MINUTE / 60, BROADCAST_BURST)
 
-        logging.info(f'{msg_sent}/{len(followers)} messages sent')
+        def paced_direct_message(screen_name: str, user_id: int) -> int:
+            limiter.acquire()
+            return self.direct_message(screen_name, user_id, msg)
+
+        with ThreadPoolExecutor(max_workers=BROADCAST_WORKERS) as executor:
+            futures = {executor.submit(paced_direct_message, screen_name, user_id): (screen_name, user_id)
+                       for screen_name, user_id in pending}
+
+            # DB is only written from this thread
+            for i, future in enumerate(as_completed(futures), start=1):
+                screen_name, user_id = futures[future]
+                try:
+                    result = future.result()
+                    error = None
+                except CircuitOpenError as e:
+                    # not the recipient's fault: the delivery stays pending, without spending an attempt
+                    logging.warning(f'Can not write DM to {screen_name}, left for the next run: {e}')
+                    continue
+                except Exception as e:
+                    result = -1
+                    error = str(e)
+
+                if result == 0:
+                    self.db.update_broadcast_delivery(broadcast_id, user_id, 'sent')
+                elif result == 1:
+                    self.db.update_broadcast_delivery(broadcast_id, user_id, 'closed', 'DMs closed')
+                else:
+                    logging.info(f'Can not write DM to {screen_name}')
+                    self.db.update_broadcast_delivery(broadcast_id, user_id, 'failed', error)
+
+                logging.debug(f'[{i}/{len(pending)}] Broadcast {broadcast_id}: {screen_name} done')
+
+        report = self.db.get_broadcast_report(broadcast_id)
+        report_file = os.path.join(os.path.dirname(LOG_FILENAME), f'broadcast-{broadcast_id}.json')
+        with open(report_file, 'w') as f:
+            json.dump(dict(broadcast_id=broadcast_id, message=msg, deliveries=report), f, indent=2)
+
+        sent = report.get('sent', {}).get('recipients', 0)
+        total = sum(status['recipients'] for status in report.values())
+        logging.info(f'Broadcast {broadcast_id}: {sent}/{total} messages sent; report in {report_file}: {report}')
+
+        return report
+
+    def backfill_captions(self, chunk_size: int = BACKFILL_CHUNK_SIZE, cpu_budget: float = 1.) -> None:
+        """
+        Compute bot alt_texts for tweets processed before the bot could suggest them. Tweets are read from the DB in
+        chunks, hydrated from the API 100 at a time, and suggestions are saved per chunk in a single transaction.
+        The last row done is saved in bot_settings, so the backfill can be stopped and resumed at any time; it stops
+        without moving past the chunk if its tweets can not be read or the captioner fails. Tweets left without any
+        suggestion hold the checkpoint before them, so the next run tries them again.
+        :param chunk_size: number of tweets to process at once
+        :param cpu_budget: fraction of the time the backfill is allowed to work, in (0, 1]; it sleeps the rest,
+         leaving CPU for the live bot
+        :return: None
+        """
+        if not CAPTIONING_ENABLED and not OCR_ENABLED:
+            # the tweets would be read and checkpointed without suggestions
+            raise Exception('Captioning and OCR are disabled, can not backfill')
+
+        n_tweets = n_suggested = 0
+
+        for shard in range(self.db.n_shards):
+            try:
+                n_shard_tweets, n_shard_suggested = self.backfill_captions_in_shard(shard, chunk_size, cpu_budget)
+            except Exception as e:
+                logging.error(f'Backfill stopped in shard {shard}, run it again to resume: {e}')
+                raise
+            n_tweets += n_shard_tweets
+            n_suggested += n_shard_suggested
+
+        logging.info(f'Backfill done: {n_suggested}/{n_tweets} tweets with suggestions')
+
+    def backfill_captions_in_shard(self, shard: int, chunk_size: int, cpu_budget: float) -> Tuple[int, int]:
+        """
+        Backfill bot alt_texts for the tweets in one shard of the DB, see self.backfill_captions
+        :param shard: shard to process, each one has its own checkpoint
+        :param chunk_size: number of tweets to process at once
+        :param cpu_budget: fraction of the time the backfill is allowed to work, in (0, 1]
+        :return: pair with the number of tweets processed and the number of them with suggestions
+        """
+        # rows are numbered in each shard, each one has its own checkpoint (reset when the rows are moved to the shards)
+        if self.db.n_shards == 1:
+            checkpoint_key = BACKFILL_CAPTIONS_CHECKPOINT_KEY
+        else:
+            checkpoint_key = f'{BACKFILL_CAPTIONS_CHECKPOINT_KEY}_{shard}'
+        last_row = checkpoint = int(self.db.get_setting(checkpoint_key, '0'))
+        # once a tweet is left without suggestions the checkpoint stays before it, the rest of the shard is still done
+        checkpoint_held = False
+        n_tweets = n_suggested = 0
+        logging.info(f'Backfilling bot alt_texts from row {last_row} of shard {shard}, cpu budget {cpu_budget}')
+
+        while True:
+            begin = time.time()
+
+            chunk = self.db.get_tweets_without_bot_alt_text(last_row, chunk_size, shard)
+            if not chunk:
+                break
+
+            photos_by_tweet = {}  # type: Dict[str, Optional[List[Dict[str, Optional[str]]]]]
+            for start in range(0, len(chunk), 100):
+                photos_by_tweet.update(self.lookup_photos([tweet['tweet_id'] for tweet in chunk[start:start + 100]]))
+
+            # caption all photos of the chunk together, so they are processed in batches
+            urls = []
+            owners = []  # type: List[Tuple[str, int]]
+            bot_alt_texts = {}  # type: Dict[str, List[Optional[str]]]
+            for tweet in chunk:
+                photos = photos_by_tweet.get(tweet['tweet_id'])
+                if not photos:
+                    # the tweet is not available anymore
+                    continue
+                bot_alt_texts.setdefault(tweet['tweet_id'], [None] * len(photos))
+                for i, photo in enumerate(photos):
+                    if photo['alt_text']:
+                        continue
+                    if photo['bot_alt_text']:
+                        # media already seen in other tweet
+                        bot_alt_texts[tweet['tweet_id']][i] = photo['bot_alt_text']
+                    else:
+                        urls.append(photo['url'])
+                        owners.append((tweet['tweet_id'], i))
+
+            for (tweet_id, i), suggestion in zip(owners, self.request_alt_texts(urls, raise_errors=True)):
+                bot_alt_texts[tweet_id][i] = suggestion
+
+            authors = {tweet['tweet_id']: tweet['user_id'] for tweet in chunk}
+            for tweet_id, texts in bot_alt_texts.items():
+                self.index_photos(tweet_id, authors[tweet_id], photos_by_tweet[tweet_id], texts)
+            bot_alt_texts = {tweet_id: texts for tweet_id, texts in bot_alt_texts.items() if any(texts)}
+
+            self.db.update_bot_alt_text_info_bulk(bot_alt_texts, shard)
+            last_row = chunk[-1]['row']
+            if not checkpoint_held:
+                failed = {tweet_id for tweet_id, _ in owners} - bot_alt_texts.keys()
+                failed_rows = [tweet['row'] for tweet in chunk if tweet['tweet_id'] in failed]
+                if failed_rows:
+                    checkpoint_held = True
+                    checkpoint = failed_rows[0] - 1
+                    logging.warning(f'Backfill: no suggestions for tweet at row {failed_rows[0]} of shard {shard}, '
+                                    f'the next run starts there')
+                else:
+                    checkpoint = last_row
+                self.db.set_setting(checkpoint_key, str(checkpoint))
+
+            n_tweets += len(chunk)
+            n_suggested += len(bot_alt_texts)
+            took = time.time() - begin
+            logging.info(f'Backfill: {n_suggested}/{n_tweets} tweets with suggestions, '
+                         f'up to row {last_row} of shard {shard}; '
+                         f'chunk took {took:.1f} s')
+
+            if cpu_budget < 1:
+                time.sleep(took * (1 / cpu_budget - 1))
+
+        return n_tweets, n_suggested
 
     def update_users_if_needed(self, needed: bool, friends: bool, followers: bool) -> None:
         """
@@ -1010,13 +1654,16 @@ class AltBot:
         """
         if followers:
             logging.info('Updating followers if needed')
-            self.update_followers_if_needed(needed)
+            with self.run_summary.phase('followers_sync'):
+                self.update_followers_if_needed(needed)
             logging.info('Updating allowed_to_dm if needed')
-            self.update_allowed_to_dm_if_needed(needed)
+            with self.run_summary.phase('allowed_to_dm_sync'):
+                self.update_allowed_to_dm_if_needed(needed)
 
         if friends:
             logging.info('Updating friends if needed')
-            self.update_friends_if_needed(needed)
+            with self.run_summary.phase('friends_sync'):
+                self.update_friends_if_needed(needed)
 
     def write_report(self, friends, followers):
 
@@ -1050,17 +1697,36 @@ class AltBot:
         report_messages.append(SUMMARY_REPORT.format(n_accounts_some_texts=n_accounts_some_texts,
                                                  n_accounts=n_accounts,
                                                  portion=100*n_accounts_some_texts/n_accounts))
+
+        # the same image may be in several tweets (quotes, replies), count it once
+        n_unique_images, n_images = self.db.count_unique_images(start_date, friends=friends, followers=followers)
+        logging.info(f'Report considers {n_unique_images} unique images in {n_images} images')
+        if n_unique_images > 0:
+            report_messages.append(UNIQUE_IMAGES_REPORT.format(n_unique_images=n_unique_images))
         report_messages.append(FOOTER_REPORT_PERIODIC)
 
         self.reply_thread(self.alt_bot_user, report_messages, None)
 
     def main(self, update_users: bool, msg_to_followers: Optional[str], watch_for_alt_text_usage_in_friends: bool,
-             watch_for_alt_text_usage_in_followers: bool, process_mentions: bool, top_users: Optional[str]) -> None:
+             watch_for_alt_text_usage_in_followers: bool, process_mentions: bool, top_users: Optional[str],
+             backfill_captions: bool = False, cpu_budget: float = 1., worker: Optional[str] = None,
+             max_duration: Optional[float] = None, max_api_calls: Optional[int] = None) -> None:
         """
         Main process for the AltBotUY
         :return: None
         """
 
+        if max_duration is not None:
+            self.deadline = time.time() + max_duration
+        self.max_api_calls = max_api_calls
+
+        if worker is not None:
+            # only help draining the scan jobs queued by the process watching followers or friends
+            logging.info(f'Working on scan jobs of {worker} as {self.worker_id}')
+            with self.run_summary.phase(f'{worker}_scan'):
+                self.process_scan_jobs(worker.rstrip('s'))
+            return
+
         # use cases that need updated friends
         frd = any([update_users, watch_for_alt_text_usage_in_friends])
         # use cases that need updated followers
@@ -1070,33 +1736,49 @@ class AltBot:
 
         if watch_for_alt_text_usage_in_followers:
             logging.info('Watching for alt_text usage in followers')
-            self.watch_for_alt_text_usage_in_followers()
+            with self.run_summary.phase('followers_scan'):
+                self.watch_for_alt_text_usage_in_followers()
         if watch_for_alt_text_usage_in_friends:
             logging.info('Watching for alt_text usage in friends')
-            self.watch_for_alt_text_usage_in_friends()
+            with self.run_summary.phase('friends_scan'):
+                self.watch_for_alt_text_usage_in_friends()
         if process_mentions:
             logging.info('Processing bot mentions')
-            self.process_mentions()
+            with self.run_summary.phase('mentions'):
+                self.process_mentions()
         if msg_to_followers:
             logging.info(f'Sending message to all followers: {msg_to_followers}')
-            self.send_message_to_all_followers(msg_to_followers)
+            with self.run_summary.phase('broadcast'):
+                self.send_message_to_all_followers(msg_to_followers)
         if top_users == 'friends':
             logging.info('Computing top-users for friends')
-            self.write_report(friends=True, followers=False)
+            with self.run_summary.phase('report'):
+                self.write_report(friends=True, followers=False)
         if top_users == 'followers':
             logging.info('Computing top-users for followers')
-            self.write_report(friends=False, followers=True)
+            with self.run_summary.phase('report'):
+                self.write_report(friends=False, followers=True)
+        if backfill_captions:
+            logging.info('Backfilling bot alt_texts')
+            with self.run_summary.phase('backfill'):
+                self.backfill_captions(cpu_budget=cpu_budget)
+
+    def save_run_summary(self, error: Optional[str] = None) -> None:
+        """
+        Save the timings and counts of the run in the run history
+        :param error: error that stopped the run, if any
+        :return: None
+        """
+        summary = self.run_summary.to_json(self.api_metrics, error)
+        logging.info(f'Run summary: {summary}')
+        self.db.save_run_summary(self.run_summary.started_at.strftime("%Y-%m-%d %H:%M:%S"), self.worker_id, summary)
 
     # endregion
 
 
 if __name__ == '__main__':
 
-    handler = TimedRotatingFileHandler(LOG_FILENAME, when='D', backupCount=7)
-
-    logging.basicConfig(level=LOG_LEVEL,
-                        format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s',
-                        datefmt='%y-%m-%d %H:%M:%S', handlers=[handler])
+    setup_logging()
 
     logging.debug('AltBot is running...')
 
@@ -1116,27 +1798,66 @@ if __name__ == '__main__':
                         action="store_true")
     parser.add_argument("-t", "--top-users", help="Compute top-3 users of alt-texts.",
                         choices=['friends', 'followers'], type=lambda s: str(s).lower(), default=None)
+    parser.add_argument("--backfill-captions", help="Compute alt_text suggestions for already processed tweets. "
+                                                    "Can be stopped and resumed.", action="store_true")
+    parser.add_argument("--cpu-budget", help="Fraction of time the backfill can use the CPU, in (0, 1], "
+                                             "to run it next to the live bot.", type=float, default=1.)
+    parser.add_argument("-w", "--worker", help="Only process the accounts queued by a run watching followers or "
+                                               "friends, next to it in another process.",
+                        choices=['friends', 'followers'], type=lambda s: str(s).lower(), default=None)
+    parser.add_argument("--max-duration", help="Seconds the watch use cases can run; accounts not processed in "
+                                               "time are processed first in the next run.", type=float, default=None)
+    parser.add_argument("--max-api-calls", help="Read calls to the API the watch use cases can do; accounts not "
+                                                "processed are processed first in the next run.", type=int,
+                        default=None)
+    parser.add_argument("--metrics-port", help="Serve the metrics of the calls to the API on this port of localhost "
+                                               "while running.", type=int, default=API_METRICS_PORT)
+    parser.add_argument("--profile", help="Profile the run (pyinstrument if installed, cProfile otherwise); the "
+                                          "profile is written next to the log.", action="store_true")
+    parser.add_argument("--profile-memory", help="As --profile, also reporting the lines allocating more memory "
+                                                 "(tracemalloc, slows the run down).", action="store_true")
     args = parser.parse_args()
+    if args.backfill_captions and not CAPTIONING_ENABLED and not OCR_ENABLED:
+        parser.error('--backfill-captions needs CAPTIONING_ENABLED or OCR_ENABLED in settings')
 
     start = time.time()
 
     bot = AltBot(live=args.live)
 
+    if args.metrics_port is not None:
+        serve_metrics(bot.api_metrics, args.metrics_port)
+        logging.info(f'Serving API metrics on http://localhost:{args.metrics_port}/metrics')
+
+    run_error = None
     try:
         logging.debug(f'Running bot with args {args}')
 
-        bot.main(update_users=args.update_users, msg_to_followers=args.message,
-                 watch_for_alt_text_usage_in_friends=args.watch_alt_texts_friends,
-                 watch_for_alt_text_usage_in_followers=args.watch_alt_texts_followers,
-                 process_mentions=args.process_mentions, top_users=args.top_users)
+        with Profiler(memory=args.profile_memory) if args.profile or args.profile_memory else nullcontext():
+            bot.main(update_users=args.update_users, msg_to_followers=args.message,
+                     watch_for_alt_text_usage_in_friends=args.watch_alt_texts_friends,
+                     watch_for_alt_text_usage_in_followers=args.watch_alt_texts_followers,
+                     process_mentions=args.process_mentions, top_users=args.top_users,
+                     backfill_captions=args.backfill_captions, cpu_budget=args.cpu_budget, worker=args.worker,
+                     max_duration=args.max_duration, max_api_calls=args.max_api_calls)
 
     except Exception as e:
         error_msg = f'Unknown error on bot execution with args = {args}: {e}.\n\n'
+        run_error = str(e)
 
         logging.critical(error_msg, exc_info=e)
         now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         bot.direct_message(MAINTEINER_NAME, MAINTAEINER_ID, f'[{now}] \n {error_msg}')
 
+    try:
+        bot.api_metrics.export(API_METRICS_PROMETHEUS_FILE, API_METRICS_JSON_FILE)
+    except OSError as e:
+        logging.error(f'Can not write API metrics: {e}')
+
+    try:
+        bot.save_run_summary(run_error)
+    except Exception as e:
+        logging.error(f'Can not save run summary: {e}')
+
     took_seconds = time.time() - start
 
     logging.info(f'Execution ended, took {timedelta(seconds=took_seconds)}.')
@@ -0,0 +1,332 @@
+"""
+Metrics of the calls to the Twitter API per endpoint, and of the circuit breakers, see InstrumentedAPI.
+"""
+import copy
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional, Tuple, Union
+
+import tweepy
+
+from api_access_layer.circuit_breaker import CircuitBreakers, CircuitOpenError, is_outage, CLOSED, HALF_OPEN, OPEN
+from settings import API_LATENCY_BUCKETS
+
+# error code for calls that got no response at all (connection errors, timeouts)
+NO_RESPONSE = 'no_response'
+# error code for calls not done because the circuit of their endpoint stayed open too long
+CIRCUIT_OPEN = 'circuit_open'
+
+# value of the altbot_api_circuit_state gauge
+CIRCUIT_STATES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class ApiMetrics:
+
+    def __init__(self, buckets: Tuple[float, ...] = API_LATENCY_BUCKETS):
+        """
+        Metrics of the calls to the API
+        :param buckets: upper bounds, in seconds, of the latency histogram buckets
+        """
+        self.buckets = tuple(sorted(buckets))
+        self.endpoints = {}  # type: Dict[str, dict]
+        # group of endpoints -> state of its circuit breaker
+        self.circuits = {}  # type: Dict[str, dict]
+        self.lock = threading.Lock()
+
+    def new_endpoint(self) -> dict:
+        return dict(calls=0, latency_buckets=[0] * len(self.buckets), latency_sum=0., response_bytes=0,
+                    rate_limit_remaining=None, rate_limit_reset=None, errors={})
+
+    def observe(self, endpoint: str, seconds: float, response_bytes: int = 0,
+                rate_limit_remaining: Optional[int] = None, rate_limit_reset: Optional[float] = None,
+                error_code: Optional[Union[int, str]] = None) -> None:
+        """
+        Record a call to the API
+        :param endpoint: tweepy.API method called
+        :param seconds: latency of the call
+        :param response_bytes: size of the response body
+        :param rate_limit_remaining: calls left in the window, if the response told
+        :param rate_limit_reset: epoch the window resets, if the response told
+        :param error_code: twitter error code, HTTP status or NO_RESPONSE if the call failed
+        :return: None
+        """
+        with self.lock:
+            metrics = self.endpoints.setdefault(endpoint, self.new_endpoint())
+            metrics['calls'] += 1
+            metrics['latency_sum'] += seconds
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    metrics['latency_buckets'][i] += 1
+            metrics['response_bytes'] += response_bytes
+            if rate_limit_remaining is not None:
+                metrics['rate_limit_remaining'] = rate_limit_remaining
+                metrics['rate_limit_reset'] = rate_limit_reset
+            if error_code is not None:
+                metrics['errors'][str(error_code)] = metrics['errors'].get(str(error_code), 0) + 1
+
+    def circuit(self, group: str) -> dict:
+        return self.circuits.setdefault(group, dict(state=CLOSED, opens=0, paused_seconds=0.))
+
+    def observe_circuit_state(self, group: str, state: str) -> None:
+        with self.lock:
+            self.circuit(group)['state'] = state
+
+    def observe_circuit_open(self, group: str) -> None:
+        with self.lock:
+            self.circuit(group)['opens'] += 1
+
+    def observe_circuit_pause(self, group: str, seconds: float) -> None:
+        with self.lock:
+            self.circuit(group)['paused_seconds'] += seconds
+
+    def circuits_snapshot(self) -> Dict[str, dict]:
+        """
+        :return: dict from group of endpoints to the state of its circuit breaker, times opened and seconds paused
+        """
+        with self.lock:
+            return {group: dict(circuit) for group, circuit in self.circuits.items()}
+
+    def snapshot(self) -> Dict[str, dict]:
+        """
+        :return: dict from endpoint to its metrics; latency buckets are cumulative, by upper bound
+        """
+        with self.lock:
+            return {endpoint: dict(metrics, errors=dict(metrics['errors']),
+                                   latency_buckets=dict(zip(map(str, self.buckets), metrics['latency_buckets'])))
+                    for endpoint, metrics in self.endpoints.items()}
+
+    def to_prometheus(self) -> str:
+        """
+        :return: the metrics in Prometheus text format
+        """
+        lines = ['# HELP altbot_api_calls_total Calls to the Twitter API.',
+                 '# TYPE altbot_api_calls_total counter']
+        snapshot = self.snapshot()
+        for endpoint, metrics in snapshot.items():
+            lines.append(f'altbot_api_calls_total{{endpoint="{endpoint}"}} {metrics["calls"]}')
+
+        lines += ['# HELP altbot_api_latency_seconds Latency of the calls to the Twitter API.',
+                  '# TYPE altbot_api_latency_seconds histogram']
+        for endpoint, metrics in snapshot.items():
+            for bound, count in metrics['latency_buckets'].items():
+                lines.append(f'altbot_api_latency_seconds_bucket{{endpoint="{endpoint}",le="{bound}"}} {count}')
+            lines.append(f'altbot_api_latency_seconds_bucket{{endpoint="{endpoint}",le="+Inf"}} {metrics["calls"]}')
+            lines.append(f'altbot_api_latency_seconds_sum{{endpoint="{endpoint}"}} {metrics["latency_sum"]}')
+            lines.append(f'altbot_api_latency_seconds_count{{endpoint="{endpoint}"}} {metrics["calls"]}')
+
+        lines += ['# HELP altbot_api_response_bytes_total Bytes received from the Twitter API.',
+                  '# TYPE altbot_api_response_bytes_total counter']
+        for endpoint, metrics in snapshot.items():
+            lines.append(f'altbot_api_response_bytes_total{{endpoint="{endpoint}"}} {metrics["response_bytes"]}')
+
+        lines += ['# HELP altbot_api_rate_limit_remaining Calls left in the rate limit window, as of the last call.',
+                  '# TYPE altbot_api_rate_limit_remaining gauge']
+        for endpoint, metrics in snapshot.items():
+            if metrics['rate_limit_remaining'] is not None:
+                lines.append(f'altbot_api_rate_limit_remaining{{endpoint="{endpoint}"}} '
+                             f'{metrics["rate_limit_remaining"]}')
+
+        lines += ['# HELP altbot_api_rate_limit_reset_seconds Epoch the rate limit window resets, as of the last call.',
+                  '# TYPE altbot_api_rate_limit_reset_seconds gauge']
+        for endpoint, metrics in snapshot.items():
+            if metrics['rate_limit_reset'] is not None:
+                lines.append(f'altbot_api_rate_limit_reset_seconds{{endpoint="{endpoint}"}} '
+                             f'{metrics["rate_limit_reset"]}')
+
+        lines += ['# HELP altbot_api_errors_total Failed calls to the Twitter API, by error code.',
+                  '# TYPE altbot_api_errors_total counter']
+        for endpoint, metrics in snapshot.items():
+            for code, count in metrics['errors'].items():
+                lines.append(f'altbot_api_errors_total{{endpoint="{endpoint}",code="{code}"}} {count}')
+
+        circuits = self.circuits_snapshot()
+        lines += ['# HELP altbot_api_circuit_state State of the circuit breaker of the group of endpoints: '
+                  '0 closed, 1 half open, 2 open.',
+                  '# TYPE altbot_api_circuit_state gauge']
+        for group, circuit in circuits.items():
+            lines.append(f'altbot_api_circuit_state{{group="{group}"}} {CIRCUIT_STATES[circuit["state"]]}')
+
+        lines += ['# HELP altbot_api_circuit_opens_total Times the circuit breaker of the group of endpoints opened.',
+                  '# TYPE altbot_api_circuit_opens_total counter']
+        for group, circuit in circuits.items():
+            lines.append(f'altbot_api_circuit_opens_total{{group="{group}"}} {circuit["opens"]}')
+
+        lines += ['# HELP altbot_api_circuit_paused_seconds_total Seconds calls waited for the circuit breaker.',
+                  '# TYPE altbot_api_circuit_paused_seconds_total counter']
+        for group, circuit in circuits.items():
+            lines.append(f'altbot_api_circuit_paused_seconds_total{{group="{group}"}} {circuit["paused_seconds"]}')
+
+        return '\n'.join(lines) + '\n'
+
+    def export(self, prometheus_file: Optional[str], json_file: Optional[str]) -> None:
+        """
+        Write the metrics; each file is replaced atomically, so collectors never read half a file
+        :param prometheus_file: path of the Prometheus textfile, None to skip it
+        :param json_file: path of the JSON snapshot, None to skip it
+        :return: None
+        """
+        for path, content in [(prometheus_file, self.to_prometheus),
+                              (json_file, lambda: json.dumps(self.snapshot(), indent=2))]:
+            if path is None:
+                continue
+            tmp_path = f'{path}.tmp'
+            with open(tmp_path, 'w') as f:
+                f.write(content())
+            os.replace(tmp_path, path)
+
+
+class InstrumentedAPI:
+    """
+    Wrapper of tweepy.API recording every call in an ApiMetrics and, if given, passing it through the circuit breaker
+    of its endpoint; any other attribute is the one of the wrapped API.
+
+    tweepy.API keeps the response of the last call in last_response, which the metrics and the token pool read after
+    the call; each thread (e.g. the broadcast workers) gets its own shallow copy of the API, so it reads its own.
+    """
+
+    def __init__(self, api: tweepy.API, metrics: ApiMetrics, breakers: Optional[CircuitBreakers] = None):
+        object.__setattr__(self, 'base_api', api)
+        object.__setattr__(self, 'metrics', metrics)
+        object.__setattr__(self, 'breakers', breakers)
+        object.__setattr__(self, 'local', threading.local())
+
+    @property
+    def api(self) -> tweepy.API:
+        """
+        :return: the wrapped API of the calling thread
+        """
+        api = getattr(self.local, 'api', None)
+        if api is None:
+            # the copy shares the auth, the cache and the settings; last_response is its own
+            api = self.local.api = copy.copy(self.base_api)
+        return api
+
+    def __getattr__(self, name: str):
+        attribute = getattr(self.api, name)
+        if not callable(attribute) or name.startswith('_'):
+            return attribute
+
+        @functools.wraps(attribute)
+        def call(*args, **kwargs):
+            if kwargs.get('create'):
+                # tweepy.Cursor asks for the method object, without calling the API
+                return attribute(*args, **kwargs)
+
+            if self.breakers is None:
+                return self.timed_call(name, attribute, *args, **kwargs)
+
+            breaker = self.breakers.for_method(name)
+            begin = time.time()
+            while True:
+                try:
+                    breaker.acquire(since=begin)
+                except CircuitOpenError:
+                    self.metrics.observe(name, 0., error_code=CIRCUIT_OPEN)
+                    raise
+
+                try:
+                    result = self.timed_call(name, attribute, *args, **kwargs)
+                except tweepy.TweepError as e:
+                    if not is_outage(e):
+                        breaker.success()
+                        raise
+                    breaker.failure()
+                    if not self.breakers.retryable(name):
+                        raise
+                    logging.warning(f'{name} failed, API unavailable: {e}; retrying')
+                    continue
+                except BaseException:
+                    breaker.release()
+                    raise
+
+                breaker.success()
+                return result
+
+        # tweepy.Cursor reads the pagination mode and the API of the method
+        if hasattr(attribute, 'pagination_mode'):
+            call.pagination_mode = attribute.pagination_mode
+        if hasattr(attribute, '__self__'):
+            call.__self__ = attribute.__self__
+        return call
+
+    def __setattr__(self, name: str, value) -> None:
+        setattr(self.api, name, value)
+
+    def timed_call(self, name: str, method, *args, **kwargs):
+        """
+        Call the method of the API and record it
+        :param name: name of the method
+        :param method: the method of the wrapped API
+        :return: the result of the method
+        """
+        self.api.last_response = None
+        begin = time.time()
+        error_code = None
+        try:
+            return method(*args, **kwargs)
+        except tweepy.TweepError as e:
+            if e.api_code is not None:
+                error_code = e.api_code
+            elif e.response is not None:
+                error_code = e.response.status_code
+            else:
+                error_code = NO_RESPONSE
+            raise
+        finally:
+            self.observe(name, time.time() - begin, error_code)
+
+    def observe(self, endpoint: str, seconds: float, error_code: Optional[Union[int, str]]) -> None:
+        response = self.api.last_response
+        if response is None:
+            self.metrics.observe(endpoint, seconds, error_code=error_code)
+            return
+
+        remaining = response.headers.get('x-rate-limit-remaining')
+        reset = response.headers.get('x-rate-limit-reset')
+        # bytes on the wire, i.e. compressed if the response was gzipped
+        length = response.headers.get('content-length')
+        response_bytes = int(length) if length is not None else len(response.content or b'')
+        self.metrics.observe(endpoint, seconds, response_bytes=response_bytes,
+                             rate_limit_remaining=int(remaining) if remaining is not None else None,
+                             rate_limit_reset=float(reset) if reset is not None else None, error_code=error_code)
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, fmt, *args) -> None:
+        logging.debug(f'Metrics server: {fmt % args}')
+
+    def do_GET(self) -> None:
+        metrics = self.server.metrics  # type: ApiMetrics
+        if self.path == '/metrics':
+            data, content_type = metrics.to_prometheus().encode('utf-8'), 'text/plain; version=0.0.4'
+        elif self.path == '/metrics.json':
+            data, content_type = json.dumps(metrics.snapshot()).encode('utf-8'), 'application/json'
+        else:
+            self.send_error(404)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def serve_metrics(metrics: ApiMetrics, port: int) -> ThreadingHTTPServer:
+    """
+    Serve the metrics on localhost in a background thread
+    :param metrics: metrics to serve
+    :param port: port to listen to
+    :return: the running server
+    """
+    server = ThreadingHTTPServer(('localhost', port), MetricsRequestHandler)
+    server.daemon_threads = True
+    server.metrics = metrics
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    return server
@@ -0,0 +1,218 @@
+"""
+Circuit breakers around the calls to the Twitter API, one per group of endpoints (ENDPOINT_GROUPS).
+"""
+import logging
+import random
+import threading
+import time
+from typing import Dict, Optional
+
+import requests
+import tweepy
+
+from settings import CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_BASE_DELAY, CIRCUIT_MAX_DELAY, CIRCUIT_MAX_PAUSE
+
+# group of endpoints of each tweepy.API method; endpoints in a group are expected to fail together
+ENDPOINT_GROUPS = {
+    'user_timeline': 'timelines',
+    'mentions_timeline': 'timelines',
+    'get_status': 'tweets',
+    'statuses_lookup': 'tweets',
+    'retweeters': 'tweets',
+    'followers': 'users',
+    'friends': 'users',
+    'verify_credentials': 'account',
+    'create_favorite': 'writes',
+    'update_status': 'writes',
+    'send_direct_message': 'writes',
+    'create_friendship': 'writes',
+}
+# group of the methods not listed above
+OTHER_GROUP = 'other'
+# groups whose calls only read, so they can be retried
+RETRY_GROUPS = {'timelines', 'tweets', 'users'}
+
+CLOSED = 'closed'
+HALF_OPEN = 'half_open'
+OPEN = 'open'
+
+
+class CircuitOpenError(Exception):
+    """
+    The API has been unavailable for longer than the call was allowed to wait. Not a TweepError, so the handlers of
+    errors about a single account or tweet do not swallow it
+    """
+
+
+def backoff_delay(attempt: int, base_delay: float = CIRCUIT_BASE_DELAY, max_delay: float = CIRCUIT_MAX_DELAY) -> float:
+    """
+    Exponential backoff with jitter: half of the delay is fixed, the other half random, so clients failing at the same
+    time do not all come back at the same time
+    :param attempt: number of attempts already failed, starting at 0
+    :param base_delay: seconds for the first attempt
+    :param max_delay: upper bound of the delay
+    :return: seconds to wait
+    """
+    delay = min(max_delay, base_delay * 2 ** attempt)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def is_outage(error: tweepy.TweepError) -> bool:
+    """
+    :param error: error raised by a call to the API
+    :return: whether the API was not available, as opposed to an answer about the request (not found, protected...)
+    """
+    if error.response is not None:
+        return error.response.status_code >= 500
+    # tweepy wraps the errors of requests; other errors without response are raised by tweepy itself (bad arguments,
+    # unparseable payload) and would fail again
+    return isinstance(error.__context__, (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                                          requests.exceptions.ChunkedEncodingError))
+
+
+class CircuitBreaker:
+
+    def __init__(self, group: str, failure_threshold: int = CIRCUIT_FAILURE_THRESHOLD,
+                 base_delay: float = CIRCUIT_BASE_DELAY, max_delay: float = CIRCUIT_MAX_DELAY,
+                 max_pause: float = CIRCUIT_MAX_PAUSE, metrics=None):
+        """
+        Circuit breaker of a group of endpoints
+        :param group: name of the group
+        :param failure_threshold: consecutive outage errors opening the circuit
+        :param base_delay: seconds the circuit stays open the first time
+        :param max_delay: upper bound of the seconds the circuit stays open
+        :param max_pause: seconds a call waits for the circuit at most
+        :param metrics: ApiMetrics where to record the state, if given
+        """
+        self.group = group
+        self.failure_threshold = failure_threshold
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_pause = max_pause
+        self.metrics = metrics
+
+        self.state = CLOSED
+        self.failures = 0
+        # times opened since it was last closed, for the backoff
+        self.n_opens = 0
+        self.open_until = 0.
+        # whether a call is probing the API in half open state
+        self.probing = False
+        self.condition = threading.Condition()
+
+    def acquire(self, since: Optional[float] = None) -> None:
+        """
+        Wait until the circuit lets a call through
+        :param since: epoch the call started, if it is being retried; the max_pause counts from it
+        :return: None; raises CircuitOpenError if the call waited more than max_pause
+        """
+        with self.condition:
+            if self.state == CLOSED:
+                return
+
+            begin = time.time()
+            deadline = (since if since is not None else begin) + self.max_pause
+            try:
+                while True:
+                    now = time.time()
+                    if self.state == OPEN and now >= self.open_until:
+                        self.set_state(HALF_OPEN)
+                    if self.state == CLOSED:
+                        return
+                    if self.state == HALF_OPEN and not self.probing:
+                        self.probing = True
+                        return
+                    if now >= deadline:
+                        raise CircuitOpenError(f'API unavailable ({self.group}) for more than {self.max_pause} s')
+                    # open: until it is time to probe; half open: until the probe ends
+                    wait = self.open_until - now if self.state == OPEN else self.max_pause
+                    self.condition.wait(max(min(wait, deadline - now), 0.01))
+            finally:
+                if self.metrics is not None:
+                    self.metrics.observe_circuit_pause(self.group, time.time() - begin)
+
+    def success(self) -> None:
+        """
+        Record a call answered by the API, closing the circuit
+        :return: None
+        """
+        with self.condition:
+            self.failures = 0
+            if self.state != CLOSED:
+                logging.info(f'Circuit {self.group} closed, the API answers again')
+                self.n_opens = 0
+                self.probing = False
+                self.set_state(CLOSED)
+                self.condition.notify_all()
+
+    def failure(self) -> None:
+        """
+        Record a call the API did not answer, opening the circuit after failure_threshold in a row or if it was probing
+        :return: None
+        """
+        with self.condition:
+            self.failures += 1
+            if self.state == OPEN or (self.state == CLOSED and self.failures < self.failure_threshold):
+                return
+
+            delay = backoff_delay(self.n_opens, self.base_delay, self.max_delay)
+            self.n_opens += 1
+            self.probing = False
+            self.open_until = time.time() + delay
+            logging.warning(f'Circuit {self.group} open after {self.failures} failures, '
+                            f'calls paused for {delay:.0f} s')
+            self.set_state(OPEN)
+            if self.metrics is not None:
+                self.metrics.observe_circuit_open(self.group)
+            self.condition.notify_all()
+
+    def release(self) -> None:
+        """
+        Record a call ended without knowing if the API answers (e.g. interrupted), letting another call probe it
+        :return: None
+        """
+        with self.condition:
+            if self.probing:
+                self.probing = False
+                self.condition.notify_all()
+
+    def set_state(self, state: str) -> None:
+        self.state = state
+        if self.metrics is not None:
+            self.metrics.observe_circuit_state(self.group, state)
+
+
+class CircuitBreakers:
+    """
+    Circuit breakers of all groups of endpoints, shared by every tweepy.API (tokens) and thread
+    """
+
+    def __init__(self, metrics=None, **breaker_kwargs):
+        """
+        :param metrics: ApiMetrics where to record the state of the circuits, if given
+        :param breaker_kwargs: other arguments for CircuitBreaker
+        """
+        self.metrics = metrics
+        self.breaker_kwargs = breaker_kwargs
+        self.breakers = {}  # type: Dict[str, CircuitBreaker]
+        self.lock = threading.Lock()
+
+    def for_method(self, method: str) -> CircuitBreaker:
+        """
+        :param method: name of the tweepy.API method
+        :return: the circuit breaker of its group
+        """
+        group = ENDPOINT_GROUPS.get(method, OTHER_GROUP)
+        with self.lock:
+            breaker = self.breakers.get(group)  # type: Optional[CircuitBreaker]
+            if breaker is None:
+                breaker = self.breakers[group] = CircuitBreaker(group, metrics=self.metrics, **self.breaker_kwargs)
+            return breaker
+
+    @staticmethod
+    def retryable(method: str) -> bool:
+        """
+        :param method: name of the tweepy.API method
+        :return: whether the method only reads, so it can be called again after an outage error
+        """
+        return ENDPOINT_GROUPS.get(method, OTHER_GROUP) in RETRY_GROUPS
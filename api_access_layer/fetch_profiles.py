@@ -0,0 +1,30 @@
+"""
+Fetch profiles: the parameters each read asks the API for, so responses carry only what the bot reads.
+"""
+from typing import Dict
+
+from tweepy.parsers import JSONParser
+
+# parameters sent as the API documents them ('true'/'false'), tweepy would send True as 'True'
+FETCH_PROFILES = {
+    # id, text and counters (retweet_count...) of the tweets, without entities nor author
+    'ids_only': dict(trim_user='true', include_entities='false'),
+    # also the media of the tweets with their alt texts; extended_entities are only complete with tweet_mode=extended
+    'media_alt_only': dict(trim_user='true', include_entities='true', include_ext_alt_text='true',
+                           tweet_mode='extended'),
+}  # type: Dict[str, Dict[str, str]]
+
+# stateless, shared by every thread
+_json_parser = JSONParser()
+
+
+def profile_kwargs(profile: str) -> dict:
+    """
+    :param profile: one of FETCH_PROFILES
+    :return: keyword arguments for a tweepy.API read method: the parameters of the profile and the parser returning
+     the JSON response as is
+    """
+    if profile not in FETCH_PROFILES:
+        raise ValueError(f'Unknown fetch profile {profile}, expected one of {", ".join(FETCH_PROFILES)}')
+
+    return dict(FETCH_PROFILES[profile], parser=_json_parser)
@@ -0,0 +1,65 @@
+"""
+Connection pool shared by every call to the Twitter API.
+"""
+import threading
+from typing import Optional
+
+import requests
+import tweepy.binder
+from requests.adapters import HTTPAdapter
+
+from settings import API_POOL_SIZE
+
+_lock = threading.Lock()
+_shared_adapter = None  # type: Optional[SharedHTTPAdapter]
+
+
+class SharedHTTPAdapter(HTTPAdapter):
+    """
+    HTTPAdapter kept open when the sessions mounting it are closed
+    """
+
+    def close(self) -> None:
+        # called by Session.close after each tweepy call; the pool must outlive the session
+        pass
+
+    def close_pool(self) -> None:
+        super().close()
+
+
+class PooledRequests:
+    """
+    Stand-in for the requests module in tweepy.binder, whose sessions use the shared adapter
+    """
+
+    def __init__(self, adapter: HTTPAdapter):
+        self.adapter = adapter
+
+    def Session(self) -> requests.Session:
+        session = requests.Session()
+        session.mount('https://', self.adapter)
+        session.mount('http://', self.adapter)
+        return session
+
+    def __getattr__(self, name: str):
+        return getattr(requests, name)
+
+
+def install_shared_pool(pool_size: int = API_POOL_SIZE) -> Optional[SharedHTTPAdapter]:
+    """
+    Make every tweepy call use a shared pool of keep-alive connections; calling it again does nothing
+    :param pool_size: connections kept open per host, should match the number of threads calling the API at once;
+     0 leaves tweepy as is, with a new connection per call
+    :return: the shared adapter, None if pooling is off
+    """
+    global _shared_adapter
+
+    if pool_size <= 0:
+        return None
+
+    with _lock:
+        if _shared_adapter is None:
+            # a few hosts: api, upload, the stand-in in tests
+            _shared_adapter = SharedHTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+            tweepy.binder.requests = PooledRequests(_shared_adapter)
+        return _shared_adapter
@@ -0,0 +1,40 @@
+"""
+Token bucket to pace calls shared by several threads.
+"""
+import threading
+import time
+
+
+class RateLimiter:
+    """
+    Token bucket: on average at most rate calls per second, in bursts of up to burst calls. Callers reserve their
+    token under the lock and sleep outside it, so waiting threads are served in order.
+    """
+
+    def __init__(self, rate: float, burst: int = 1):
+        """
+        :param rate: calls per second
+        :param burst: calls allowed at once after a quiet period
+        """
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> float:
+        """
+        Wait for a token
+        :return: seconds waited
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # a negative balance is the queue of threads already waiting
+            self.tokens -= 1
+            wait = max(-self.tokens, 0.) / self.rate
+
+        if wait > 0:
+            time.sleep(wait)
+        return wait
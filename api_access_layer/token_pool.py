@@ -0,0 +1,152 @@
+import logging
+import threading
+import time
+from typing import Dict, List, Optional, Set, Tuple
+
+import tweepy
+
+from api_access_layer.api_metrics import ApiMetrics, InstrumentedAPI
+from api_access_layer.circuit_breaker import CircuitBreakers
+
+# read methods spread over the pool, with the endpoint whose rate limit they consume
+READ_ENDPOINTS = {
+    'user_timeline': '/statuses/user_timeline',
+    'get_status': '/statuses/show',
+    'statuses_lookup': '/statuses/lookup',
+}
+
+# index of the bot's own token, the first of the pool: the only one that can read the protected accounts the bot
+# follows, the other apps get 401 for them
+BOT_TOKEN = 0
+
+# used when the API does not tell when the window resets
+RATE_LIMIT_WINDOW = 15 * 60
+
+# errors meaning the token itself is not valid (89: invalid or expired token, 32: could not authenticate)
+INVALID_TOKEN_CODES = {89, 32}
+
+
+class TokenPool:
+    """
+    Pool of read-only app tokens to spread read calls: each call goes to the token with more remaining quota for the
+    endpoint, according to the x-rate-limit-* headers of its last response. Write calls (tweets, favs, DMs) must not
+    use the pool, they go with the bot identity.
+    """
+
+    def __init__(self, tokens: List[Tuple[str, str, str, str]], metrics: Optional[ApiMetrics] = None,
+                 breakers: Optional[CircuitBreakers] = None, **api_kwargs):
+        """
+        Create an API for each token
+        :param tokens: list of (consumer_key, consumer_secret, key, secret)
+        :param metrics: where to record the calls, if given
+        :param breakers: circuit breakers for the calls, shared by all tokens; only used with metrics
+        :param api_kwargs: other arguments for tweepy.API
+        """
+        if not tokens:
+            raise ValueError('At least one token is needed')
+
+        self.apis = []  # type: List[tweepy.API]
+        for consumer_key, consumer_secret, key, secret in tokens:
+            auth = tweepy.OAuthHandler(consumer_key, consumer_secret)
+            auth.set_access_token(key, secret)
+            # the pool handles rate limits itself, switching tokens instead of sleeping
+            api = tweepy.API(auth, wait_on_rate_limit=False, **api_kwargs)
+            self.apis.append(InstrumentedAPI(api, metrics, breakers) if metrics is not None else api)
+
+        # (token index, endpoint) -> (remaining calls, reset epoch)
+        self.quotas = {}  # type: Dict[Tuple[int, str], Tuple[int, float]]
+        self.lock = threading.Lock()
+        # requests sent through the pool, with any token
+        self.n_calls = 0
+        # indexes of the tokens rejected by the API, not used anymore
+        self.invalid = set()  # type: Set[int]
+
+    def __len__(self) -> int:
+        return len(self.apis)
+
+    def pick(self, endpoint: str, token: Optional[int] = None) -> Tuple[int, float]:
+        """
+        Choose the token with more remaining calls for the endpoint; tokens never used for it are preferred
+        :param endpoint: endpoint to call
+        :param token: index of the only token to consider, any token if None
+        :return: pair (token index, seconds to wait before using it)
+        """
+        now = time.time()
+        best = None  # type: Optional[Tuple[int, int, float]]
+
+        with self.lock:
+            for i in range(len(self.apis)):
+                if i in self.invalid or (token is not None and i != token):
+                    continue
+                remaining, reset = self.quotas.get((i, endpoint), (None, 0))
+                if remaining is None or reset <= now:
+                    # unknown or window already reset
+                    remaining = 1 << 30
+                if best is None or remaining > best[1] or (remaining == best[1] == 0 and reset < best[2]):
+                    best = (i, remaining, reset)
+
+            if best is None:
+                raise tweepy.TweepError('Every token of the pool was rejected by the API')
+            i, remaining, reset = best
+            if remaining > 0:
+                # count this call already, so concurrent callers spread over the tokens
+                old_remaining, old_reset = self.quotas.get((i, endpoint), (None, 0))
+                if old_remaining is not None and old_reset > now:
+                    self.quotas[(i, endpoint)] = (old_remaining - 1, old_reset)
+                return i, 0.
+
+            return i, reset - now
+
+    def update_quota(self, i: int, endpoint: str) -> None:
+        response = self.apis[i].last_response
+        if response is None:
+            return
+
+        remaining = response.headers.get('x-rate-limit-remaining')
+        reset = response.headers.get('x-rate-limit-reset')
+
+        if remaining is not None:
+            with self.lock:
+                self.quotas[(i, endpoint)] = (int(remaining),
+                                              float(reset) if reset is not None else time.time() + RATE_LIMIT_WINDOW)
+
+    def call(self, method: str, *args, token: Optional[int] = None, **kwargs):
+        """
+        Call the read method of tweepy.API with the best token for its endpoint, waiting only if every token is
+        exhausted
+        :param method: name of the tweepy.API method, one of READ_ENDPOINTS
+        :param args: arguments for the method
+        :param token: index of the token to use (e.g. BOT_TOKEN), the best one if None
+        :param kwargs: keyword arguments for the method
+        :return: the result of the method
+        """
+        endpoint = READ_ENDPOINTS[method]
+
+        while True:
+            i, wait = self.pick(endpoint, token)
+
+            if wait > 0:
+                logging.warning(f'Tokens exhausted for {endpoint}, waiting {wait:.0f} s')
+                time.sleep(wait + 1)
+                continue
+
+            api = self.apis[i]
+            api.last_response = None
+            with self.lock:
+                self.n_calls += 1
+            try:
+                return getattr(api, method)(*args, **kwargs)
+            except tweepy.RateLimitError:
+                logging.info(f'Token {i} exhausted for {endpoint}')
+                with self.lock:
+                    self.quotas[(i, endpoint)] = (0, time.time() + RATE_LIMIT_WINDOW)
+            except tweepy.TweepError as e:
+                codes = e.api_code if isinstance(e.api_code, list) else [e.api_code]
+                if not INVALID_TOKEN_CODES.intersection(codes):
+                    raise
+                # not an error of the account or tweet read; try again with other token
+                logging.error(f'Token {i} rejected by the API, removed from the pool: {e}')
+                with self.lock:
+                    self.invalid.add(i)
+            finally:
+                self.update_quota(i, endpoint)
@@ -0,0 +1,239 @@
+"""
+Microbenchmarks of DBAccess on a synthetic DB with production-like volumes, so indexing and schema decisions rest on
+measured timings and query plans instead of on our own modest DB file.
+
+generate fills a DB file (and its shards) with processed tweets, alt text info rows skewed towards the most active
+accounts, followers and friends:
+    python -m benchmarks.bench_db generate /tmp/big.db --processed-tweets 20000000 --alt-text-rows 2000000 \
+        --followers 1000000
+
+run times tweet_was_processed, get_percentage_of_alt_text_usage, get_top_alt_text_users, update_followers and the
+startup (connection and create_tables) on it, prints the EXPLAIN QUERY PLAN of the queries behind them and appends the
+results to benchmarks/results.jsonl:
+    python -m benchmarks.bench_db run /tmp/big.db
+"""
+import argparse
+import json
+import os
+import random
+import sqlite3
+import sys
+import time
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from benchmarks.bench_flows import percentile, git_commit  # noqa: E402
+from data_access_layer import db_queries  # noqa: E402
+from data_access_layer.data_access import DBAccess  # noqa: E402
+
+# ids of the synthetic tweets are FIRST_TWEET_ID + i * TWEET_ID_STEP, so FIRST_TWEET_ID + i * TWEET_ID_STEP + 1 are
+# never processed
+FIRST_TWEET_ID = 1300000000000000000
+TWEET_ID_STEP = 4096
+# followers have ids from FIRST_USER_ID, friends follow them
+FIRST_USER_ID = 1000
+
+CHUNK_SIZE = 100000
+
+# query behind each benchmark, with sample parameters for its plan
+QUERY_PLANS = {
+    'tweet_was_processed': (db_queries.CHECK_TWEET_PROCESSED, (str(FIRST_TWEET_ID),)),
+    'get_percentage_of_alt_text_usage': (db_queries.GET_HISTORIC_SCORE_TABLE, (FIRST_USER_ID,)),
+    'get_top_alt_text_users': (db_queries.GET_HISTORIC_INFO_TABLE_FULL, ('2000-01-01 00:00:00',)),
+    'update_followers (remove)': (db_queries.REMOVE_FOLLOWER, (FIRST_USER_ID,)),
+    'update_followers (add)': (db_queries.ADD_FOLLOWER, ('user', FIRST_USER_ID)),
+}
+
+
+def tweet_id(i: int) -> str:
+    return str(FIRST_TWEET_ID + i * TWEET_ID_STEP)
+
+
+def generate(db_file: str, n_shards: int, n_processed_tweets: int, n_alt_text_rows: int, n_followers: int,
+             n_friends: int, seed: int) -> None:
+    """
+    Fill db_file with synthetic data
+    :param db_file: DB file to fill; it must not exist
+    :param n_shards: number of shards of the tables of processed tweets
+    :param n_processed_tweets: number of processed tweets
+    :param n_alt_text_rows: number of processed tweets with images, i.e. with alt text info
+    :param n_followers: number of followers
+    :param n_friends: number of friends; the last ones are also followers
+    :param seed: seed of the generator
+    :return: None
+    """
+    if os.path.exists(db_file):
+        raise Exception(f'{db_file} already exists')
+
+    rng = random.Random(seed)
+    db = DBAccess(db_file, n_shards)
+    # durability is useless while generating
+    for connection in db.shards + [db.connection]:
+        connection.execute('PRAGMA synchronous=OFF')
+
+    begin = time.time()
+    for start in range(0, n_processed_tweets, CHUNK_SIZE):
+        # the author of most tweets is not generated; spread them by tweet_id, as moving them to the shards does
+        for shard, shard_connection in enumerate(db.shards):
+            shard_connection.executemany(db_queries.SAVE_PROCESSED_TWEET_NO_FAIL,
+                                         ((tweet_id(i),) for i in range(start, min(start + CHUNK_SIZE,
+                                                                                   n_processed_tweets))
+                                          if int(tweet_id(i)) % n_shards == shard))
+            shard_connection.commit()
+    print(f'{n_processed_tweets} processed tweets in {time.time() - begin:.0f} s')
+
+    begin = time.time()
+    db.connection.executemany(db_queries.ADD_FOLLOWER, ((f'user{user_id}', user_id) for user_id in
+                                                        range(FIRST_USER_ID, FIRST_USER_ID + n_followers)))
+    first_friend = FIRST_USER_ID + max(n_followers - n_friends // 2, 0)
+    db.connection.executemany(db_queries.ADD_FRIEND, ((f'user{user_id}', user_id) for user_id in
+                                                      range(first_friend, first_friend + n_friends)))
+    db.connection.commit()
+    print(f'{n_followers} followers and {n_friends} friends in {time.time() - begin:.0f} s')
+
+    # a few accounts post most of the images
+    n_accounts = first_friend + n_friends - FIRST_USER_ID
+    now = datetime.now()
+    step = max(n_processed_tweets // max(n_alt_text_rows, 1), 1)
+
+    begin = time.time()
+    for start in range(0, n_alt_text_rows, CHUNK_SIZE):
+        rows_by_shard = {}  # type: Dict[int, List[tuple]]
+        for i in range(start, min(start + CHUNK_SIZE, n_alt_text_rows)):
+            user_id = FIRST_USER_ID + int(n_accounts * rng.random() ** 3)
+            n_images = rng.randint(1, 4)
+            alt_score = rng.randint(0, n_images) / n_images if rng.random() < 0.4 else 0.
+            processed_at = (now - timedelta(days=730 * rng.random())).strftime("%Y-%m-%d %H:%M:%S")
+            rows_by_shard.setdefault(user_id % n_shards, []).append(
+                (tweet_id(i * step), f'user{user_id}', user_id, n_images, alt_score, processed_at,
+                 int(user_id >= first_friend), int(user_id < FIRST_USER_ID + n_followers),
+                 None, None, None, None, None, None, None, None))
+
+        for shard, rows in rows_by_shard.items():
+            db.shards[shard].executemany(db_queries.SAVE_TWEET_ALT_TEXT_INFO_NO_FAIL, rows)
+            db.shards[shard].commit()
+    print(f'{n_alt_text_rows} alt text info rows in {time.time() - begin:.0f} s')
+
+    for connection in db.shards + [db.connection]:
+        connection.execute('PRAGMA synchronous=FULL')
+        connection.execute('ANALYZE')
+        connection.commit()
+
+
+def time_calls(function: Callable, args_list: List[tuple]) -> Dict[str, float]:
+    """
+    :param function: function to time
+    :param args_list: arguments of each call
+    :return: timings of the calls, in milliseconds
+    """
+    timings = []
+    for args in args_list:
+        begin = time.perf_counter()
+        function(*args)
+        timings.append((time.perf_counter() - begin) * 1000)
+
+    return dict(calls=len(timings), mean_ms=sum(timings) / len(timings), p50_ms=percentile(timings, 50),
+                p99_ms=percentile(timings, 99), max_ms=max(timings))
+
+
+def query_plans(db: DBAccess) -> Dict[str, List[str]]:
+    plans = {}
+    for name, (query, params) in QUERY_PLANS.items():
+        # the tables of processed tweets live in the shards, the rest in the main file
+        connection = db.shards[0] if 'processed_tweets' in query else db.connection
+        plans[name] = [row[3] for row in connection.execute(f'EXPLAIN QUERY PLAN {query}', params)]
+    return plans
+
+
+def run(db_file: str, n_shards: int, n_calls: int, seed: int) -> dict:
+    """
+    Time the DBAccess methods on db_file
+    :param db_file: DB file filled with generate
+    :param n_shards: number of shards it was generated with
+    :param n_calls: calls of each point query
+    :param seed: seed for the ids queried
+    :return: timings, query plans and size of the data
+    """
+    rng = random.Random(seed)
+
+    begin = time.perf_counter()
+    db = DBAccess(db_file, n_shards)
+    first_startup_ms = (time.perf_counter() - begin) * 1000
+    startup = time_calls(lambda: DBAccess(db_file, n_shards), [()] * 5)
+    startup['first_ms'] = first_startup_ms
+
+    n_processed_tweets = sum(shard.execute('SELECT Count(*) FROM processed_tweets').fetchone()[0]
+                             for shard in db.shards)
+    followers = sorted(db.get_followers(), key=lambda follower: follower[1])
+    n_alt_text_rows = sum(shard.execute('SELECT Count(*) FROM processed_tweets_alt_text_info').fetchone()[0]
+                          for shard in db.shards)
+
+    # half processed, half not
+    tweet_ids = [(tweet_id(rng.randrange(max(n_processed_tweets, 1))) if k % 2 == 0 else
+                  str(int(tweet_id(rng.randrange(max(n_processed_tweets, 1)))) + 1),) for k in range(n_calls)]
+    user_ids = [(rng.choice(followers)[1],) for _ in range(n_calls)]
+    start_date = (datetime.now() - timedelta(days=31)).strftime("%Y-%m-%d %H:%M:%S")
+
+    # 1% of the followers leave and as many arrive, as in a daily sync; undone afterwards
+    churn = set(rng.sample(followers, max(len(followers) // 100, 1)))
+    newcomers = {(f'user{user_id}', user_id) for user_id in range(-len(churn), 0)}
+
+    timings = dict(
+        startup=startup,
+        tweet_was_processed=time_calls(db.tweet_was_processed, tweet_ids),
+        get_percentage_of_alt_text_usage=time_calls(db.get_percentage_of_alt_text_usage, user_ids),
+        get_top_alt_text_users=time_calls(lambda: db.get_top_alt_text_users(followers=True, start_date=start_date),
+                                          [()] * 3),
+        update_followers=time_calls(db.update_followers, [(newcomers, churn)]),
+    )
+    db.update_followers(churn, newcomers)
+
+    return dict(date=datetime.now().isoformat(timespec='seconds'), commit=git_commit(),
+                data=dict(processed_tweets=n_processed_tweets, alt_text_rows=n_alt_text_rows,
+                          followers=len(followers), shards=n_shards,
+                          bytes=sum(os.path.getsize(f) for f in
+                                    [db_file] + [DBAccess.get_shard_file(db_file, s) for s in range(n_shards)]
+                                    if os.path.exists(f))),
+                timings=timings, query_plans=query_plans(db))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Microbenchmarks of DBAccess on a synthetic DB.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    generate_parser = subparsers.add_parser('generate', help="Fill a new DB file with synthetic data.")
+    generate_parser.add_argument("db_file", help="DB file to create.")
+    generate_parser.add_argument("--processed-tweets", help="Number of processed tweets.", type=int,
+                                 default=20000000)
+    generate_parser.add_argument("--alt-text-rows", help="Number of processed tweets with images.", type=int,
+                                 default=2000000)
+    generate_parser.add_argument("--followers", help="Number of followers.", type=int, default=1000000)
+    generate_parser.add_argument("--friends", help="Number of friends.", type=int, default=5000)
+
+    run_parser = subparsers.add_parser('run', help="Time the DBAccess methods on a generated DB.")
+    run_parser.add_argument("db_file", help="DB file filled with generate.")
+    run_parser.add_argument("--calls", help="Calls of each point query.", type=int, default=1000)
+    run_parser.add_argument("--results", help="JSON lines file to append the results to.",
+                            default=os.path.join(REPO_DIR, 'benchmarks', 'results.jsonl'))
+
+    for subparser in (generate_parser, run_parser):
+        subparser.add_argument("--shards", help="Number of shards of the processed tweets.", type=int, default=1)
+        subparser.add_argument("--seed", help="Seed of the generator.", type=int, default=0)
+
+    args = parser.parse_args()
+
+    if args.command == 'generate':
+        generate(args.db_file, args.shards, args.processed_tweets, args.alt_text_rows, args.followers, args.friends,
+                 args.seed)
+    else:
+        bench_result = run(args.db_file, args.shards, args.calls, args.seed)
+        bench_result['benchmark'] = 'db'
+
+        with open(args.results, 'a') as f:
+            f.write(json.dumps(bench_result) + '\n')
+
+        print(json.dumps(bench_result, indent=2))
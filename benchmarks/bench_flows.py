@@ -0,0 +1,238 @@
+"""
+End-to-end benchmark of the bot use cases against the local stand-in of the Twitter API
+(simulation/fake_twitter_api.py), so runs are reproducible and spend no quota:
+ - watch: watch_for_alt_text_usage_in_followers, reports accounts/s and API calls per account
+ - mentions: process_mentions, reports p50/p99 seconds per mention
+ - report: write_report for followers, reports seconds
+and for all the API calls of the run: p50/p99 latency per call, bytes received and TLS handshakes (new connections)
+
+The bot runs in this process, against a fresh DB in a temporary directory seeded with the synthetic followers; the
+fake API runs in a subprocess, so the peak RSS measured is the one of the bot. Results are appended, one JSON per
+run, to benchmarks/results.jsonl with the commit and the workload, to track regressions:
+    python -m benchmarks.bench_flows --followers 1000 --tweets-per-user 25 --latency 0.05
+"""
+import argparse
+import json
+import logging
+import os
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from typing import Dict, List
+
+import requests
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+FLOWS = ['watch', 'mentions', 'report']
+
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def peak_rss_mb() -> float:
+    # kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('localhost', 0))
+        return sock.getsockname()[1]
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+class FakeApiProcess:
+
+    def __init__(self, port: int, workdir: str, args: argparse.Namespace):
+        """
+        Run the fake API in a subprocess
+        :param port: port to listen to in localhost
+        :param workdir: where to write the certificate
+        :param args: workload of the benchmark
+        """
+        from simulation.fake_twitter_api import generate_certificate
+
+        self.port = port
+        self.certfile, keyfile = generate_certificate(workdir)
+        self.process = subprocess.Popen(
+            [sys.executable, '-m', 'simulation.fake_twitter_api', '--port', str(self.port),
+             '--users', str(args.followers * 2), '--followers', str(args.followers),
+             '--friends', str(args.followers // 2), '--allowed-to-dm', str(args.followers // 5),
+             '--tweets-per-user', str(args.tweets_per_user), '--image-rate', str(args.image_rate),
+             '--mentions', str(args.mentions), '--latency', str(args.latency),
+             '--rate-limit-scale', str(args.rate_limit_scale), '--seed', str(args.seed),
+             '--certfile', self.certfile, '--keyfile', keyfile],
+            cwd=REPO_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+        deadline = time.time() + 30
+        while True:
+            try:
+                self.stats()
+                break
+            except requests.exceptions.ConnectionError:
+                if time.time() > deadline or self.process.poll() is not None:
+                    raise Exception('The fake Twitter API did not start')
+                time.sleep(0.2)
+
+    @property
+    def host(self) -> str:
+        return f'localhost:{self.port}'
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        return requests.get(f'https://{self.host}/fake/stats.json', verify=self.certfile).json()
+
+    def n_requests(self) -> int:
+        # without the requests for the stats themselves
+        return sum(n for endpoint, n in self.stats().get('requests', {}).items() if not endpoint.startswith('/fake/'))
+
+    def stop(self) -> None:
+        self.process.terminate()
+        self.process.wait()
+
+
+def run_benchmark(args: argparse.Namespace) -> dict:
+    workdir = tempfile.mkdtemp(prefix='altbot-bench-')
+    port = free_port()
+
+    # settings reads the API host from the environment when first imported, so before importing the bot; the DB path
+    # is relative to the working directory
+    os.environ['TWITTER_API_HOST'] = f'localhost:{port}'
+    os.environ['TWITTER_API_CA_BUNDLE'] = os.path.join(workdir, 'fake-twitter-cert.pem')
+    os.makedirs(os.path.join(workdir, 'data_access_layer'))
+    os.makedirs(os.path.join(workdir, 'log'))
+    os.chdir(workdir)
+
+    logging.basicConfig(level=args.log_level, filename=os.path.join(workdir, 'log', 'bench.log'),
+                        format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s')
+
+    import altBot_main
+    from altBot_main import AltBot
+    from simulation.fake_twitter_api import FakeTwitterData
+
+    if args.api_pool_size is not None:
+        # e.g. 0 to compare with a new connection per call
+        altBot_main.API_POOL_SIZE = args.api_pool_size
+
+    api = FakeApiProcess(port, workdir, args)
+    if api.certfile != os.environ['TWITTER_API_CA_BUNDLE']:
+        raise Exception(f'Unexpected certificate {api.certfile}')
+
+    result = dict(date=datetime.now().isoformat(timespec='seconds'), commit=git_commit(),
+                  workload=dict(followers=args.followers, tweets_per_user=args.tweets_per_user,
+                                image_rate=args.image_rate, latency=args.latency, mentions=args.mentions,
+                                seed=args.seed, api_pool_size=args.api_pool_size),
+                  metrics={})
+
+    try:
+        bot = AltBot(live=True)
+
+        api_latencies = []
+        observe = bot.api_metrics.observe
+
+        def timed_observe(endpoint, seconds, *observe_args, **observe_kwargs):
+            api_latencies.append(seconds)
+            observe(endpoint, seconds, *observe_args, **observe_kwargs)
+
+        bot.api_metrics.observe = timed_observe
+
+        # the same accounts the fake API has, without paging them from the API
+        data = FakeTwitterData(n_users=args.followers * 2, n_followers=args.followers,
+                               n_allowed_to_dm=args.followers // 5)
+        bot.db.update_followers({(f'user{user_id}', user_id) for user_id in data.follower_ids}, set())
+        bot.db.update_allowed_to_dm(set(data.follower_ids[:data.n_allowed_to_dm]), set())
+
+        if 'watch' in args.flows:
+            n_requests = api.n_requests()
+            begin = time.time()
+            bot.watch_for_alt_text_usage_in_followers()
+            took = time.time() - begin
+            n_accounts = bot.db.count_scan_jobs('follower').get('done', 0)
+            result['metrics']['watch'] = dict(
+                seconds=took, accounts=n_accounts, accounts_per_second=n_accounts / took,
+                api_calls_per_account=(api.n_requests() - n_requests) / max(n_accounts, 1),
+                peak_rss_mb=peak_rss_mb())
+
+        if 'mentions' in args.flows:
+            latencies = []
+
+            def timed(method):
+                def wrapper(*method_args, **method_kwargs):
+                    begin_mention = time.time()
+                    try:
+                        return method(*method_args, **method_kwargs)
+                    finally:
+                        latencies.append(time.time() - begin_mention)
+                return wrapper
+
+            bot.process_mention_in_reply_to_tweet = timed(bot.process_mention_in_reply_to_tweet)
+            bot.process_mentioned_users_in_tweet = timed(bot.process_mentioned_users_in_tweet)
+
+            begin = time.time()
+            bot.process_mentions()
+            result['metrics']['mentions'] = dict(
+                seconds=time.time() - begin, mentions=len(latencies), p50_seconds=percentile(latencies, 50),
+                p99_seconds=percentile(latencies, 99), peak_rss_mb=peak_rss_mb())
+
+        if 'report' in args.flows:
+            begin = time.time()
+            bot.write_report(friends=False, followers=True)
+            result['metrics']['report'] = dict(seconds=time.time() - begin, peak_rss_mb=peak_rss_mb())
+
+        stats = api.stats()
+        n_handshakes = stats.get('connections', {}).get('tls_handshakes', 0)
+        result['metrics']['api'] = dict(
+            calls=len(api_latencies), p50_ms=percentile(api_latencies, 50) * 1000,
+            p99_ms=percentile(api_latencies, 99) * 1000,
+            response_bytes=sum(metrics['response_bytes'] for metrics in bot.api_metrics.snapshot().values()),
+            tls_handshakes=n_handshakes, handshakes_per_call=n_handshakes / max(len(api_latencies), 1))
+        result['api'] = stats
+    finally:
+        api.stop()
+
+    return result
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="End-to-end benchmark of the bot against a fake Twitter API.")
+    parser.add_argument("--followers", help="Number of followers.", type=int, default=1000)
+    parser.add_argument("--tweets-per-user", help="Length of each timeline.", type=int, default=25)
+    parser.add_argument("--image-rate", help="Portion of tweets with images.", type=float, default=0.3)
+    parser.add_argument("--latency", help="Mean seconds each API request takes.", type=float, default=0.05)
+    parser.add_argument("--mentions", help="Number of tweets mentioning the bot.", type=int, default=50)
+    parser.add_argument("--seed", help="Seed of the synthetic data.", type=int, default=0)
+    parser.add_argument("--rate-limit-scale", help="Factor applied to the rate limits of the fake API; big values "
+                                                   "measure throughput without waiting for quotas.", type=float,
+                        default=1000.)
+    parser.add_argument("--api-pool-size", help="Connections kept open to the API, API_POOL_SIZE by default; 0 opens "
+                                                "a new connection per call.", type=int, default=None)
+    parser.add_argument("--flows", help="Use cases to run.", nargs='+', choices=FLOWS, default=FLOWS)
+    parser.add_argument("--results", help="JSON lines file to append the results to.",
+                        default=os.path.join(REPO_DIR, 'benchmarks', 'results.jsonl'))
+    parser.add_argument("--log-level", help="Log level of the bot, logged to log/bench.log in the temporary "
+                                            "directory.", default='WARNING')
+    args = parser.parse_args()
+
+    bench_result = run_benchmark(args)
+
+    with open(args.results, 'a') as f:
+        f.write(json.dumps(bench_result) + '\n')
+
+    print(json.dumps(bench_result, indent=2))
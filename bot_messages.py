@@ -41,6 +41,9 @@ FIRST_ALT_TEXT_USER_PROVIDED = '1: {alt_text}'
 SECOND_ALT_TEXT_USER_PROVIDED = '2: {alt_text}'
 THIRD_ALT_TEXT_USER_PROVIDED = '3: {alt_text}'
 FOURTH_ALT_TEXT_USER_PROVIDED = '4: {alt_text}'
+HEADER_ALT_TEXT_BOT_SUGGESTED = 'Así describiría yo las imágenes sin alt_text (generado automáticamente, ' \
+                                'puede tener errores):'
+OCR_ALT_TEXT = 'Imagen con el texto: "{text}"'
 ALL_ALT_TEXT_USER_PROVIDED = [FIRST_ALT_TEXT_USER_PROVIDED, SECOND_ALT_TEXT_USER_PROVIDED, THIRD_ALT_TEXT_USER_PROVIDED,
                           FOURTH_ALT_TEXT_USER_PROVIDED]
 
@@ -65,4 +68,5 @@ HEADER_REPORT_PERIODIC_FOLLOWERS = emoji.emojize(':mag_right::memo: Este es el T
 
 SUMMARY_REPORT = '{n_accounts_some_texts} cuentas han usado algún texto alternativo en ese tiempo,' \
                  ' {n_accounts} analizadas ({portion:4.1f}%)'
+UNIQUE_IMAGES_REPORT = '{n_unique_images} imágenes distintas analizadas'
 FOOTER_REPORT_PERIODIC = f'+info https://rola93.github.io/altBotUY'
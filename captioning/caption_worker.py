@@ -0,0 +1,195 @@
+"""
+Caption worker: long running process with the warm models, shared by every bot process through a Unix socket.
+"""
+import json
+import logging
+import os
+import queue
+import socket
+import socketserver
+import threading
+import time
+from concurrent.futures import Future
+from typing import List, Optional, Tuple
+
+from settings import CAPTION_WORKER_SOCKET, CAPTION_WORKER_MAX_BATCH, CAPTION_WORKER_MAX_WAIT, \
+    CAPTION_WORKER_MAX_QUEUE, CAPTION_WORKER_TIMEOUT, CAPTION_WORKER_MAX_RETRIES, LOG_LEVEL, CAPTIONING_ENABLED, \
+    OCR_ENABLED
+
+BUSY = 'busy'
+
+
+class CaptionWorkerBusy(Exception):
+    pass
+
+
+class MicroBatcher:
+
+    def __init__(self, max_batch: int = CAPTION_WORKER_MAX_BATCH, max_wait: float = CAPTION_WORKER_MAX_WAIT,
+                 max_queue: int = CAPTION_WORKER_MAX_QUEUE):
+        """
+        Group requests of several clients to caption them together
+        :param max_batch: max number of images in a batch
+        :param max_wait: max seconds the first request of a batch waits for others
+        :param max_queue: max number of requests waiting; further requests are rejected
+        """
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.requests = queue.Queue(maxsize=max_queue)  # type: queue.Queue[Tuple[List[str], Future]]
+
+        self.thread = threading.Thread(target=self.run, name='micro-batcher', daemon=True)
+        self.thread.start()
+
+    def submit(self, urls: List[str]) -> Future:
+        """
+        Enqueue the request
+        :param urls: list of image urls
+        :return: future for the list of suggestions
+        :raise CaptionWorkerBusy: if too many requests are waiting
+        """
+        future = Future()
+        try:
+            self.requests.put_nowait((urls, future))
+        except queue.Full:
+            raise CaptionWorkerBusy()
+        return future
+
+    def next_batch(self) -> List[Tuple[List[str], Future]]:
+        batch = [self.requests.get()]
+        n_images = len(batch[0][0])
+        deadline = time.time() + self.max_wait
+
+        while n_images < self.max_batch:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                request = self.requests.get(timeout=remaining)
+            except queue.Empty:
+                break
+            batch.append(request)
+            n_images += len(request[0])
+
+        return batch
+
+    def run(self) -> None:
+        # the models and the cache are only used from this thread
+        from captioning.captioning import get_caption_engine, suggest_alt_texts
+        from captioning.ocr import get_ocr_engine
+
+        # load the models before the first request arrives
+        if CAPTIONING_ENABLED:
+            get_caption_engine()
+        if OCR_ENABLED:
+            get_ocr_engine()
+
+        while True:
+            batch = self.next_batch()
+            urls = [url for request_urls, _ in batch for url in request_urls]
+            begin = time.time()
+
+            try:
+                suggestions = suggest_alt_texts(urls)
+            except Exception as e:
+                logging.error(f'Can not caption batch of {len(urls)} images: {e}', exc_info=True)
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            logging.info(f'Batch of {len(batch)} requests, {len(urls)} images, took {time.time() - begin:.2f} s')
+
+            start = 0
+            for request_urls, future in batch:
+                future.set_result(suggestions[start:start + len(request_urls)])
+                start += len(request_urls)
+
+
+class CaptionRequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self) -> None:
+        for line in self.rfile:
+            try:
+                urls = json.loads(line)['urls']
+                suggestions = self.server.batcher.submit(urls).result(timeout=CAPTION_WORKER_TIMEOUT)
+                response = dict(suggestions=suggestions)
+            except CaptionWorkerBusy:
+                response = dict(error=BUSY)
+            except Exception as e:
+                logging.error(f'Can not process request: {e}')
+                response = dict(error=str(e))
+
+            self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+
+
+class CaptionWorkerServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+
+    daemon_threads = True
+
+    def __init__(self, socket_path: str = CAPTION_WORKER_SOCKET):
+        if os.path.exists(socket_path):
+            # left by a previous worker
+            os.remove(socket_path)
+
+        super().__init__(socket_path, CaptionRequestHandler)
+        self.batcher = MicroBatcher()
+
+
+class CaptionClient:
+
+    def __init__(self, socket_path: str = CAPTION_WORKER_SOCKET, timeout: float = CAPTION_WORKER_TIMEOUT,
+                 max_retries: int = CAPTION_WORKER_MAX_RETRIES):
+        """
+        Client of the caption worker
+        :param socket_path: Unix socket the worker listens to
+        :param timeout: seconds to wait for the suggestions
+        :param max_retries: attempts when the worker is busy, with exponential backoff
+        """
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self.max_retries = max_retries
+
+    def request(self, urls: List[str]) -> dict:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(self.timeout)
+            sock.connect(self.socket_path)
+            sock.sendall(json.dumps(dict(urls=urls)).encode('utf-8') + b'\n')
+            with sock.makefile('rb') as f:
+                return json.loads(f.readline())
+
+    def suggest_alt_texts(self, urls: List[str]) -> List[Optional[str]]:
+        """
+        Ask the worker for an alt_text suggestion for each image
+        :param urls: list of image urls
+        :return: list of suggestions aligned with urls; None when no suggestion could be computed
+        """
+        if not urls:
+            return []
+
+        for attempt in range(self.max_retries):
+            response = self.request(urls)
+
+            if response.get('error') == BUSY:
+                wait = 2 ** attempt
+                logging.info(f'[{attempt + 1}/{self.max_retries}] Caption worker busy, retrying in {wait} s')
+                time.sleep(wait)
+                continue
+            if 'error' in response:
+                raise Exception(f'Caption worker failed: {response["error"]}')
+
+            return response['suggestions']
+
+        raise CaptionWorkerBusy()
+
+
+if __name__ == '__main__':
+
+    logging.basicConfig(level=LOG_LEVEL, format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s',
+                        datefmt='%y-%m-%d %H:%M:%S')
+
+    server = CaptionWorkerServer()
+    logging.info(f'Caption worker listening on {CAPTION_WORKER_SOCKET}')
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.remove(CAPTION_WORKER_SOCKET)
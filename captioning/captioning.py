@@ -1,4 +1,327 @@
 """
 This modulte provides the logic to perform OCR/image captioning, no matter how is it solved:
 compute it here or request a remote API.
-"""
\ No newline at end of file
+"""
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional, Union
+
+import numpy as np
+
+from captioning.media_download import Media, download_medias, open_media, release_media, smallest_rendition
+from data_access_layer.caption_cache import CaptionCache
+from settings import CAPTION_MODEL_FILE, CAPTION_VOCAB_FILE, CAPTION_IMAGE_SIZE, CAPTION_BATCH_SIZE, \
+    CAPTION_PREPROCESS_WORKERS, CAPTION_INFERENCE_THREADS, CAPTIONING_ENABLED, OCR_ENABLED, OCR_MIN_IMAGE_SIZE
+
+# normalization used by most CLIP/ViT based image encoders
+IMAGE_MEAN = np.array([0.48145466, 0.4578275, 0.40821073], dtype=np.float32)
+IMAGE_STD = np.array([0.26862954, 0.26130258, 0.27577711], dtype=np.float32)
+
+SPECIAL_TOKENS = {'<pad>', '<bos>', '<eos>', '<unk>', '[PAD]', '[CLS]', '[SEP]', '[UNK]'}
+END_TOKENS = {'<eos>', '[SEP]'}
+
+
+def _lower_priority() -> None:
+    # preprocessing workers must not take the CPU from the scan loop
+    os.nice(10)
+
+
+def preprocess_image(image: Union[bytes, str], size: int = CAPTION_IMAGE_SIZE) -> np.ndarray:
+    """
+    Decode and normalize an image to be fed to the model. Module level function, so it can run in a process pool
+    :param image: downloaded image, raw bytes or path to the temporary file holding it
+    :param size: side of the square image expected by the model
+    :return: float32 array of shape 3 x size x size
+    """
+    from PIL import Image
+
+    with open_media(image) as f:
+        img = Image.open(f)
+        # draft lets the JPEG decoder downscale while decoding, far cheaper than decoding at full size
+        img.draft('RGB', (size, size))
+        img = img.convert('RGB').resize((size, size), Image.BICUBIC)
+
+    pixels = (np.asarray(img, dtype=np.float32) / 255. - IMAGE_MEAN) / IMAGE_STD
+    return pixels.transpose(2, 0, 1)
+
+
+def image_hash(image: Union[bytes, str], hash_size: int = 8) -> int:
+    """
+    Perceptual hash (dHash) of the image: each bit tells whether a pixel is brighter than its right neighbour in a
+    grayscale thumbnail, so re-encoded, resized or slightly edited copies of an image get (almost) the same hash
+    :param image: downloaded image, raw bytes or path to the temporary file holding it
+    :param hash_size: the hash has hash_size ** 2 bits
+    :return: unsigned hash
+    """
+    from PIL import Image
+
+    with open_media(image) as f:
+        img = Image.open(f)
+        img.draft('L', (hash_size * 8, hash_size * 8))
+        img = img.convert('L').resize((hash_size + 1, hash_size), Image.BILINEAR)
+
+    pixels = np.asarray(img, dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).ravel()
+
+    return int(sum(1 << i for i, bit in enumerate(bits) if bit))
+
+
+class CaptionEngine:
+
+    def __init__(self, model_file: str = CAPTION_MODEL_FILE, vocab_file: str = CAPTION_VOCAB_FILE,
+                 batch_size: int = CAPTION_BATCH_SIZE, preprocess_workers: int = CAPTION_PREPROCESS_WORKERS,
+                 inference_threads: int = CAPTION_INFERENCE_THREADS):
+        """
+        Load the captioning model, to be kept for the process lifetime
+        :param model_file: path to the .onnx or .pt (TorchScript) model
+        :param vocab_file: path to the vocabulary, one token per line
+        :param batch_size: max number of images to feed the model at once
+        :param preprocess_workers: processes used to decode and resize images
+        :param inference_threads: threads used by the runtime for a single inference
+        """
+        self.batch_size = batch_size
+
+        with open(vocab_file, 'r', encoding='utf-8') as f:
+            self.vocab = [line.rstrip('\n') for line in f]  # type: List[str]
+
+        begin = time.time()
+        if model_file.endswith('.onnx'):
+            import onnxruntime
+
+            options = onnxruntime.SessionOptions()
+            options.intra_op_num_threads = inference_threads
+            options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+            self.session = onnxruntime.InferenceSession(model_file, sess_options=options,
+                                                        providers=['CPUExecutionProvider'])
+            self.input_name = self.session.get_inputs()[0].name
+            self.model = None
+        else:
+            import torch
+
+            torch.set_num_threads(inference_threads)
+            self.model = torch.jit.load(model_file, map_location='cpu').eval()
+            self.session = None
+        logging.info(f'Caption model {model_file} loaded in {time.time() - begin:.2f} s')
+
+        self.pool = ProcessPoolExecutor(max_workers=preprocess_workers, initializer=_lower_priority)
+
+        # throughput counters, for the whole process lifetime
+        self.n_images = 0
+        self.inference_seconds = 0.
+
+    def close(self) -> None:
+        self.pool.shutdown(wait=True)
+
+    def decode(self, token_ids: np.ndarray) -> str:
+        """
+        Convert the token ids generated by the model into text
+        :param token_ids: 1D array of token ids
+        :return: caption
+        """
+        words = []
+        for token_id in token_ids:
+            token = self.vocab[int(token_id)] if 0 <= int(token_id) < len(self.vocab) else '<unk>'
+            if token in END_TOKENS:
+                break
+            if token in SPECIAL_TOKENS:
+                continue
+            if token.startswith('##') and words:
+                # word piece continuing the previous word
+                words[-1] += token[2:]
+            else:
+                words.append(token)
+
+        caption = ' '.join(words).strip()
+        return caption[:1].upper() + caption[1:]
+
+    def run_model(self, pixel_values: np.ndarray) -> np.ndarray:
+        """
+        Run the model over a batch of preprocessed images
+        :param pixel_values: float32 array of shape N x 3 x size x size
+        :return: int array of shape N x T with the generated tokens
+        """
+        if self.session is not None:
+            return self.session.run(None, {self.input_name: pixel_values})[0]
+
+        import torch
+
+        with torch.no_grad():
+            return self.model(torch.from_numpy(pixel_values)).numpy()
+
+    def caption_images(self, images: List[Media]) -> List[Optional[str]]:
+        """
+        Compute a caption for each image, in batches of at most batch_size images
+        :param images: list of downloaded images; None for images that could not be downloaded
+        :return: list of captions, aligned with images; None for images that could not be captioned
+        """
+        result = [None] * len(images)  # type: List[Optional[str]]
+
+        valid = [i for i, image in enumerate(images) if image is not None]
+        pixels = list(self.pool.map(preprocess_image, [images[i] for i in valid]))
+
+        for start in range(0, len(valid), self.batch_size):
+            batch_idx = valid[start:start + self.batch_size]
+            begin = time.time()
+            try:
+                token_ids = self.run_model(np.stack(pixels[start:start + self.batch_size]))
+            except Exception as e:
+                logging.error(f'Can not caption batch of {len(batch_idx)} images: {e}', exc_info=True)
+                continue
+            self.inference_seconds += time.time() - begin
+            self.n_images += len(batch_idx)
+
+            for i, ids in zip(batch_idx, token_ids):
+                result[i] = self.decode(ids) or None
+
+        logging.debug(f'Captioned {len(valid)} images; throughput: {self.throughput():.2f} images/s')
+
+        return result
+
+    def caption_urls(self, urls: List[str]) -> List[Optional[str]]:
+        """
+        Download and caption each image url
+        :param urls: list of image urls
+        :return: list of captions, aligned with urls; None for images that could not be captioned
+        """
+        images = download_medias(urls, rendition=smallest_rendition(CAPTION_IMAGE_SIZE))
+        try:
+            return self.caption_images(images)
+        finally:
+            release_media(images)
+
+    def throughput(self) -> float:
+        """
+        :return: images per second captioned by the model so far, only considering inference time
+        """
+        return self.n_images / self.inference_seconds if self.inference_seconds > 0 else 0.
+
+
+_caption_engine = None  # type: Optional[CaptionEngine]
+
+
+def get_caption_engine() -> CaptionEngine:
+    """
+    Get the CaptionEngine of this process, loading the model the first time
+    :return: warm CaptionEngine
+    """
+    global _caption_engine
+
+    if _caption_engine is None:
+        _caption_engine = CaptionEngine()
+
+    return _caption_engine
+
+
+_caption_cache = None  # type: Optional[CaptionCache]
+
+
+def get_caption_cache() -> CaptionCache:
+    global _caption_cache
+
+    if _caption_cache is None:
+        _caption_cache = CaptionCache()
+
+    return _caption_cache
+
+
+def suggest_alt_texts(urls: List[str]) -> List[Optional[str]]:
+    """
+    Suggest an alt_text for each image: text-heavy images are described by their text (OCR), the rest with a caption.
+    Suggestions already computed for the same url or for a near-duplicate image are taken from the cache.
+    :param urls: list of image urls
+    :return: list of suggestions aligned with urls; None when no suggestion could be computed
+    """
+    from captioning.ocr import get_ocr_engine, is_text_heavy, ocr_alt_text
+
+    cache = get_caption_cache()
+    result = [None] * len(urls)  # type: List[Optional[str]]
+
+    # cached by url, no need to download them
+    for i, url in enumerate(urls):
+        cached = cache.get_by_url(url)
+        if cached is not None:
+            result[i] = cached[0]
+    missing = [i for i in range(len(urls)) if result[i] is None]
+
+    images = download_medias([urls[i] for i in missing], rendition=smallest_rendition(CAPTION_IMAGE_SIZE))
+    hashes = {}
+
+    try:
+        # cached near-duplicates
+        for i, image in zip(missing, images):
+            if image is None:
+                continue
+            try:
+                hashes[i] = image_hash(image)
+            except Exception as e:
+                logging.warning(f'Can not hash image {urls[i]}: {e}')
+                continue
+            cached = cache.get_by_hash(hashes[i])
+            if cached is not None:
+                logging.debug(f'Image {urls[i]} is a near-duplicate of a cached one')
+                result[i] = cached[0]
+                cache.save(urls[i], hashes[i], cached[0], cached[1])
+
+        pending = {i: image for i, image in zip(missing, images) if image is not None and result[i] is None}
+
+        text_heavy = set()
+        if OCR_ENABLED:
+            for i, image in pending.items():
+                try:
+                    if is_text_heavy(image):
+                        text_heavy.add(i)
+                except Exception as e:
+                    logging.warning(f'Can not classify image {urls[i]}: {e}')
+
+            # OCR needs more resolution than the caption model, so text-heavy images are downloaded again
+            to_ocr = sorted(text_heavy)
+            ocr_images = download_medias([urls[i] for i in to_ocr], rendition=smallest_rendition(OCR_MIN_IMAGE_SIZE))
+            try:
+                texts = get_ocr_engine().ocr_images(ocr_images)
+            finally:
+                release_media(ocr_images)
+
+            for i, text in zip(to_ocr, texts):
+                if text is not None:
+                    result[i] = ocr_alt_text(text)
+                    cache.save(urls[i], hashes.get(i), result[i], 'ocr')
+                else:
+                    # no text found after all, let the caption model try
+                    text_heavy.discard(i)
+
+        if CAPTIONING_ENABLED:
+            to_caption = [i for i in pending if i not in text_heavy]
+            captions = get_caption_engine().caption_images([pending[i] for i in to_caption])
+            for i, caption in zip(to_caption, captions):
+                result[i] = caption
+                if caption is not None:
+                    cache.save(urls[i], hashes.get(i), caption, 'caption')
+    finally:
+        release_media(images)
+
+    return result
+
+
+if __name__ == '__main__':
+    # measure throughput on a commodity box:
+    # python -m captioning.captioning <image> [<image> ...]
+    import sys
+
+    logging.basicConfig(level=logging.INFO)
+
+    raw_images = []
+    for path in sys.argv[1:]:
+        with open(path, 'rb') as image_file:
+            raw_images.append(image_file.read())
+
+    engine = get_caption_engine()
+    start = time.time()
+    for path, caption in zip(sys.argv[1:], engine.caption_images(raw_images)):
+        print(f'{path}: {caption}')
+    took = time.time() - start
+
+    print(f'{len(raw_images)} images in {took:.2f} s: {len(raw_images) / took:.2f} images/s end to end, '
+          f'{engine.throughput():.2f} images/s in inference')
+    engine.close()
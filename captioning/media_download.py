@@ -0,0 +1,244 @@
+"""
+Async download of the images attached to tweets (media_url_https in extended_entities['media']).
+"""
+import asyncio
+import io
+import logging
+import os
+import tempfile
+import threading
+from typing import BinaryIO, List, Optional, Union
+from urllib.parse import urlparse, urlencode, parse_qsl, urlunparse
+
+import aiohttp
+
+from settings import MEDIA_DOWNLOAD_TIMEOUT, MEDIA_DOWNLOAD_CONCURRENCY, MEDIA_MAX_IN_MEMORY_BYTES, \
+    MEDIA_MAX_BYTES, MEDIA_TMP_DIR
+
+# bytes for small images, path to a temporary file for big ones, None if the download failed
+Media = Optional[Union[bytes, str]]
+
+# twitter renditions and the size of their longest side
+RENDITIONS = [('thumb', 150), ('small', 680), ('medium', 1200), ('large', 2048)]
+
+CHUNK_SIZE = 64 * 1024
+
+_lock = threading.Lock()
+_media_downloader = None  # type: Optional[MediaDownloader]
+
+
+def smallest_rendition(min_size: int) -> str:
+    """
+    Name of the smallest twitter rendition whose longest side is at least min_size pixels
+    :param min_size: size needed by the consumer
+    :return: rendition name
+    """
+    for name, size in RENDITIONS:
+        if size >= min_size:
+            return name
+    return RENDITIONS[-1][0]
+
+
+def rendition_url(url: str, rendition: str) -> str:
+    """
+    Url to download the given rendition of the image. Images in twitter (pbs.twimg.com) are requested as
+    <path>?format=<ext>&name=<rendition>; for other hosts name=<rendition> is just added to the query
+    :param url: media_url_https of the image
+    :param rendition: one of the RENDITIONS names
+    :return: url of the rendition
+    """
+    parts = urlparse(url)
+    path = parts.path
+    query = dict(parse_qsl(parts.query))
+
+    if parts.netloc == 'pbs.twimg.com' and '.' in os.path.basename(path):
+        path, ext = path.rsplit('.', 1)
+        query['format'] = ext
+
+    query['name'] = rendition
+
+    return urlunparse(parts._replace(path=path, query=urlencode(query)))
+
+
+def open_media(media: Union[bytes, str]) -> BinaryIO:
+    """
+    :param media: downloaded media
+    :return: file object to read the media, no matter if it is in memory or in a temporary file
+    """
+    return io.BytesIO(media) if isinstance(media, bytes) else open(media, 'rb')
+
+
+def release_media(medias: List[Media]) -> None:
+    """
+    Remove the temporary files of the given downloaded medias
+    :param medias: list of downloaded medias
+    :return: None
+    """
+    for media in medias:
+        if isinstance(media, str) and os.path.isfile(media):
+            os.remove(media)
+
+
+def _discard_spill(spill: Optional[BinaryIO]) -> None:
+    """
+    Close and remove the temporary file of a download not completed, if any
+    :param spill: temporary file the download was written to, None if it was kept in memory
+    :return: None
+    """
+    if spill is not None:
+        spill.close()
+        os.remove(spill.name)
+
+
+async def _fetch(session: aiohttp.ClientSession, semaphore: asyncio.Semaphore, url: str) -> Media:
+
+    async with semaphore:
+        spill = None  # type: Optional[BinaryIO]
+        try:
+            async with session.get(url) as response:
+                response.raise_for_status()
+
+                if response.content_length is not None and response.content_length > MEDIA_MAX_BYTES:
+                    logging.warning(f'Skip image {url}: {response.content_length} bytes')
+                    return None
+
+                buffer = bytearray()
+                size = 0
+
+                async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                    size += len(chunk)
+                    if size > MEDIA_MAX_BYTES:
+                        logging.warning(f'Skip image {url}: more than {MEDIA_MAX_BYTES} bytes')
+                        _discard_spill(spill)
+                        return None
+
+                    if spill is None and size > MEDIA_MAX_IN_MEMORY_BYTES:
+                        # too big to keep in memory; move what we have to a temporary file
+                        spill = tempfile.NamedTemporaryFile(prefix='media-', dir=MEDIA_TMP_DIR, delete=False)
+                        spill.write(buffer)
+                        buffer = None
+
+                    if spill is None:
+                        buffer.extend(chunk)
+                    else:
+                        spill.write(chunk)
+
+                if spill is not None:
+                    spill.close()
+                    return spill.name
+                return bytes(buffer)
+
+        except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+            # OSError: the temporary file could not be written
+            logging.warning(f'Can not download image {url}: {e}')
+            # the download may have failed after moving to a temporary file
+            _discard_spill(spill)
+            return None
+
+
+async def download_medias_async(session: aiohttp.ClientSession, urls: List[str], rendition: Optional[str] = None,
+                                concurrency: int = MEDIA_DOWNLOAD_CONCURRENCY) -> List[Media]:
+    """
+    Download the given images, at most concurrency at the same time, sharing the keep-alive connections of session
+    :param session: session to download with
+    :param urls: list of media_url_https
+    :param rendition: rendition to request, None to download the url as is
+    :param concurrency: max number of downloads in flight
+    :return: list of downloaded medias aligned with urls
+    """
+    if rendition is not None:
+        urls = [rendition_url(url, rendition) for url in urls]
+
+    semaphore = asyncio.Semaphore(concurrency)
+    return await asyncio.gather(*[_fetch(session, semaphore, url) for url in urls])
+
+
+class MediaDownloader:
+
+    def __init__(self, concurrency: int = MEDIA_DOWNLOAD_CONCURRENCY):
+        """
+        Event loop running in a background thread with a single session, so every download of the process shares its
+        keep-alive connections
+        :param concurrency: max number of connections of the session
+        """
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name='media-download', daemon=True)
+        self.thread.start()
+        self.session = self.run(self._create_session(concurrency))
+
+    @staticmethod
+    async def _create_session(concurrency: int) -> aiohttp.ClientSession:
+        # the session belongs to the loop it is created in
+        connector = aiohttp.TCPConnector(limit=concurrency, keepalive_timeout=30)
+        timeout = aiohttp.ClientTimeout(total=MEDIA_DOWNLOAD_TIMEOUT)
+        return aiohttp.ClientSession(connector=connector, timeout=timeout, auto_decompress=True)
+
+    def run(self, coroutine):
+        """
+        Run the coroutine in the loop of the downloader, from any other thread
+        :param coroutine: coroutine to run
+        :return: its result
+        """
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def download(self, urls: List[str], rendition: Optional[str] = None,
+                 concurrency: int = MEDIA_DOWNLOAD_CONCURRENCY) -> List[Media]:
+        """
+        See download_medias_async
+        """
+        return self.run(download_medias_async(self.session, urls, rendition, concurrency))
+
+    def close(self) -> None:
+        self.run(self.session.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+
+def get_media_downloader() -> MediaDownloader:
+    """
+    Get the MediaDownloader of this process, starting it the first time
+    :return: MediaDownloader
+    """
+    global _media_downloader
+
+    with _lock:
+        if _media_downloader is None:
+            _media_downloader = MediaDownloader()
+
+    return _media_downloader
+
+
+def download_medias(urls: List[str], rendition: Optional[str] = None,
+                    concurrency: int = MEDIA_DOWNLOAD_CONCURRENCY) -> List[Media]:
+    """
+    Synchronous version of download_medias_async, with the session of the MediaDownloader of the process
+    :param urls: list of media_url_https
+    :param rendition: rendition to request, None to download the url as is
+    :param concurrency: max number of downloads in flight
+    :return: list of downloaded medias aligned with urls; remember to release_media them when done
+    """
+    if not urls:
+        return []
+
+    return get_media_downloader().download(urls, rendition, concurrency)
+
+
+if __name__ == '__main__':
+    import sys
+    import time
+
+    logging.basicConfig(level=logging.DEBUG)
+
+    start = time.time()
+    downloaded = download_medias(sys.argv[1:], rendition='small')
+    took = time.time() - start
+
+    for media_url, downloaded_media in zip(sys.argv[1:], downloaded):
+        kind = 'failed' if downloaded_media is None else \
+            f'{len(downloaded_media)} bytes in memory' if isinstance(downloaded_media, bytes) else \
+            f'spilled to {downloaded_media}'
+        print(f'{media_url}: {kind}')
+    print(f'{len(downloaded)} images in {took:.2f} s')
+
+    release_media(downloaded)
@@ -0,0 +1,146 @@
+"""
+OCR stage for text-heavy images (screenshots, flyers), with Tesseract in a process pool.
+"""
+import logging
+import os
+import re
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from typing import List, Optional, Union
+
+import numpy as np
+
+from captioning.media_download import Media, open_media
+from bot_messages import OCR_ALT_TEXT
+from settings import OCR_LANG, OCR_MAX_WORKERS, OCR_MAX_CONCURRENT, OCR_TIMEOUT, OCR_MIN_CHARS, \
+    OCR_EDGE_DENSITY_THRESHOLD, OCR_FLAT_BACKGROUND_THRESHOLD
+
+# alt texts can not be longer than this in twitter
+MAX_ALT_TEXT_CHARS = 1000
+
+
+def is_text_heavy(image: Union[bytes, str], width: int = 256) -> bool:
+    """
+    Cheap heuristic to tell whether an image is mostly text: text images have a flat background (most pixels share
+    few intensities) and many sharp horizontal transitions (glyph strokes)
+    :param image: downloaded image, raw bytes or path to the temporary file holding it
+    :param width: the image is downscaled to this width before computing the features
+    :return: True iff the image looks like a screenshot of text
+    """
+    from PIL import Image
+
+    with open_media(image) as f:
+        img = Image.open(f)
+        img.draft('L', (width, width))
+        img = img.convert('L')
+    img = img.resize((width, max(1, int(img.height * width / img.width))))
+    pixels = np.asarray(img, dtype=np.int16)
+
+    # portion of strong horizontal transitions
+    edge_density = (np.abs(np.diff(pixels, axis=1)) > 64).mean()
+
+    # portion of pixels in the 2 most frequent intensity buckets
+    histogram = np.bincount((pixels // 16).ravel(), minlength=16)
+    flat_background = np.sort(histogram)[-2:].sum() / pixels.size
+
+    logging.debug(f'edge density: {edge_density:.3f} flat background: {flat_background:.3f}')
+
+    return edge_density >= OCR_EDGE_DENSITY_THRESHOLD and flat_background >= OCR_FLAT_BACKGROUND_THRESHOLD
+
+
+def ocr_image(image: Union[bytes, str], lang: str = OCR_LANG, timeout: float = OCR_TIMEOUT) -> Optional[str]:
+    """
+    Extract the text from the image with tesseract. Module level function, so it can run in a process pool
+    :param image: downloaded image, raw bytes or path to the temporary file holding it
+    :param lang: tesseract languages to use
+    :param timeout: seconds before killing tesseract
+    :return: extracted text, with whitespaces collapsed, or None if too short to be useful
+    """
+    import pytesseract
+    from PIL import Image
+
+    with open_media(image) as f:
+        text = pytesseract.image_to_string(Image.open(f), lang=lang, timeout=timeout)
+    text = re.sub(r'\s+', ' ', text).strip()
+
+    return text[:MAX_ALT_TEXT_CHARS] if len(text) >= OCR_MIN_CHARS else None
+
+
+def ocr_alt_text(text: str) -> str:
+    """
+    :param text: text extracted from an image with ocr_image
+    :return: alt text for the image, OCR_ALT_TEXT with the text cut so the whole alt text fits in MAX_ALT_TEXT_CHARS
+    """
+    room = MAX_ALT_TEXT_CHARS - len(OCR_ALT_TEXT.format(text=''))
+    return OCR_ALT_TEXT.format(text=text[:room])
+
+
+def _lower_priority() -> None:
+    # OCR workers must not take the CPU from the scan loop
+    os.nice(10)
+
+
+class OcrEngine:
+
+    def __init__(self, max_workers: int = OCR_MAX_WORKERS, max_concurrent: int = OCR_MAX_CONCURRENT,
+                 timeout: float = OCR_TIMEOUT):
+        """
+        Pool of processes to run OCR
+        :param max_workers: processes running tesseract
+        :param max_concurrent: max number of images being OCRed at the same time, from any thread; extra images wait
+        :param timeout: seconds to wait for the text of each image
+        """
+        self.timeout = timeout
+        self.pool = ProcessPoolExecutor(max_workers=max_workers, initializer=_lower_priority)
+        self.slots = threading.BoundedSemaphore(max_concurrent)
+
+    def close(self) -> None:
+        self.pool.shutdown(wait=True)
+
+    def ocr_images(self, images: List[Media]) -> List[Optional[str]]:
+        """
+        Run OCR on each image
+        :param images: list of downloaded images; None for images that could not be downloaded
+        :return: list aligned with images with the text of each, None if no text found, on timeout or error
+        """
+        result = [None] * len(images)  # type: List[Optional[str]]
+        futures = []
+
+        for image in images:
+            if image is None:
+                futures.append(None)
+                continue
+            self.slots.acquire()
+            future = self.pool.submit(ocr_image, image, OCR_LANG, self.timeout)
+            future.add_done_callback(lambda _: self.slots.release())
+            futures.append(future)
+
+        for i, future in enumerate(futures):
+            if future is None:
+                continue
+            try:
+                # tesseract is also killed after timeout; this is a guard for the pool itself
+                result[i] = future.result(timeout=self.timeout + 1)
+            except TimeoutError:
+                logging.warning(f'OCR timed out after {self.timeout} s')
+                future.cancel()
+            except Exception as e:
+                logging.error(f'Can not OCR image: {e}')
+
+        return result
+
+
+_ocr_engine = None  # type: Optional[OcrEngine]
+
+
+def get_ocr_engine() -> OcrEngine:
+    """
+    Get the OcrEngine of this process, starting it the first time
+    :return: OcrEngine
+    """
+    global _ocr_engine
+
+    if _ocr_engine is None:
+        _ocr_engine = OcrEngine()
+
+    return _ocr_engine
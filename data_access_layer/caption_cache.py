@@ -0,0 +1,123 @@
+import logging
+import sqlite3
+import time
+from typing import Optional, Tuple
+
+from data_access_layer import db_queries
+from settings import CAPTION_CACHE_DB_FILE, CAPTION_CACHE_MAX_BYTES, CAPTION_CACHE_MAX_HAMMING_DISTANCE
+
+
+class CaptionCache:
+    """
+    Suggested alt texts (captions or OCR) indexed by image url and by a 64 bits perceptual hash of the image, in
+    its own SQLite file limited to max_bytes: least recently used entries are evicted first.
+
+    Near-duplicates are found splitting the hash in 4 bands of 16 bits: two hashes at Hamming distance < 4 share at
+    least one band, so only rows matching some band need to be compared.
+    """
+
+    # fraction of the entries removed each time the cache gets too big
+    eviction_fraction = 0.1
+
+    def __init__(self, db_file: str = CAPTION_CACHE_DB_FILE, max_bytes: int = CAPTION_CACHE_MAX_BYTES,
+                 max_distance: int = CAPTION_CACHE_MAX_HAMMING_DISTANCE):
+
+        if max_distance > 3:
+            raise ValueError(f'Max Hamming distance must be < 4: {max_distance}')
+
+        self.db_file = db_file
+        self.max_bytes = max_bytes
+        self.max_distance = max_distance
+        self.connection = sqlite3.connect(db_file)
+
+        self.create_tables()
+
+    def __del__(self):
+        if hasattr(self, 'connection'):
+            self.connection.close()
+
+    def create_tables(self) -> None:
+        # auto_vacuum only takes effect if set before creating the tables
+        self.connection.execute(db_queries.CAPTION_CACHE_AUTO_VACUUM)
+        self.connection.execute(db_queries.CREATE_CAPTION_CACHE_TABLE)
+        self.connection.executescript(db_queries.CREATE_INDEXES_FOR_CAPTION_CACHE)
+        self.connection.commit()
+
+    @staticmethod
+    def to_signed(image_hash: int) -> int:
+        # SQLite integers are signed 64 bits
+        return image_hash - (1 << 64) if image_hash >= (1 << 63) else image_hash
+
+    @staticmethod
+    def bands(image_hash: int) -> Tuple[int, int, int, int]:
+        return tuple((image_hash >> (16 * i)) & 0xFFFF for i in range(4))
+
+    def get_by_url(self, url: str) -> Optional[Tuple[str, str]]:
+        """
+        Get the cached suggestion for the image in the url
+        :param url: media_url_https of the image
+        :return: pair (suggestion, source) if cached, None otherwise
+        """
+        row = self.connection.execute(db_queries.GET_CACHED_CAPTION_BY_URL, (url,)).fetchone()
+
+        if row is None:
+            return None
+
+        self.connection.execute(db_queries.TOUCH_CACHED_CAPTION, (time.time(), url))
+        self.connection.commit()
+        return row[0], row[1]
+
+    def get_by_hash(self, image_hash: int) -> Optional[Tuple[str, str]]:
+        """
+        Get the cached suggestion for the closest image to the given perceptual hash, within max_distance bits
+        :param image_hash: unsigned 64 bits perceptual hash of the image
+        :return: pair (suggestion, source) if some near-duplicate image is cached, None otherwise
+        """
+        best = None
+        for url, cached_hash, suggestion, source in self.connection.execute(
+                db_queries.GET_CACHED_CAPTION_CANDIDATES_BY_HASH, self.bands(image_hash)):
+            distance = bin((cached_hash & 0xFFFFFFFFFFFFFFFF) ^ image_hash).count('1')
+            if distance <= self.max_distance and (best is None or distance < best[0]):
+                best = (distance, url, suggestion, source)
+
+        if best is None:
+            return None
+
+        self.connection.execute(db_queries.TOUCH_CACHED_CAPTION, (time.time(), best[1]))
+        self.connection.commit()
+        return best[2], best[3]
+
+    def save(self, url: str, image_hash: Optional[int], suggestion: str, source: str) -> None:
+        """
+        Cache the suggestion for the image, evicting least recently used entries if the cache grows too big
+        :param url: media_url_https of the image
+        :param image_hash: unsigned 64 bits perceptual hash of the image, if available
+        :param suggestion: suggested alt text
+        :param source: how it was computed: 'caption' or 'ocr'
+        :return: None
+        """
+        if image_hash is None:
+            params = (url, None, None, None, None, None)
+        else:
+            params = (url, self.to_signed(image_hash)) + self.bands(image_hash)
+
+        self.connection.execute(db_queries.SAVE_CACHED_CAPTION, params + (suggestion, source, time.time()))
+        self.connection.commit()
+
+        self.evict_if_needed()
+
+    def evict_if_needed(self) -> None:
+        size = self.connection.execute(db_queries.GET_DB_SIZE).fetchone()[0]
+
+        if size <= self.max_bytes:
+            return
+
+        n_entries = self.connection.execute(db_queries.COUNT_CACHED_CAPTIONS).fetchone()[0]
+        n_evict = max(1, int(n_entries * self.eviction_fraction))
+        logging.info(f'Caption cache takes {size} bytes, evicting {n_evict}/{n_entries} entries')
+
+        self.connection.execute(db_queries.EVICT_LEAST_RECENTLY_USED_CAPTIONS, (n_evict,))
+        self.connection.commit()
+        # give the free pages back to the file system
+        self.connection.execute(db_queries.INCREMENTAL_VACUUM).fetchall()
+        self.connection.commit()
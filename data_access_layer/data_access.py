@@ -1,12 +1,16 @@
 import logging
+import os
 import sqlite3
+import time
 from datetime import datetime
+from itertools import chain
 from typing import Set, Optional, Tuple, List, Dict, Union
 
 import pandas as pd
 
 from data_access_layer import db_queries
-from settings import DB_FILE, INIT_SYSTEM_DATE
+from settings import DB_FILE, INIT_SYSTEM_DATE, DB_BUSY_TIMEOUT, DB_SHARDS, SHARD_MIGRATION_CHUNK_SIZE, \
+    BACKFILL_CAPTIONS_CHECKPOINT_KEY
 
 
 class DBAccess:
@@ -14,20 +18,54 @@ class DBAccess:
     last_mention_key_setting = 'last_mention_id'
     last_mention_value_setting = 1382671652857786368
 
-    def __init__(self, db_file: str = DB_FILE):
+    def __init__(self, db_file: str = DB_FILE, n_shards: int = DB_SHARDS):
+        """
+        Connect to the bot database
+        :param db_file: main DB file, with the global tables (followers, friends, settings...)
+        :param n_shards: number of files the tables of processed tweets (processed_tweets, its alt_text info and the
+         media index) are split into, by the user_id of the author; with 1 they stay in db_file
+        """
 
         self.db_file = db_file
-        self.connection = sqlite3.connect(db_file)
+        self.n_shards = n_shards
+        # several worker processes may share the file: wait for locks instead of failing
+        self.connection = sqlite3.connect(db_file, timeout=DB_BUSY_TIMEOUT)
 
         if self.connection is None:
             raise Exception(f'Cannot connect with database {DB_FILE}')
 
+        # readers do not block the writer (nor the other way round)
+        self.connection.execute(db_queries.ENABLE_WAL)
+
+        if n_shards == 1:
+            self.shards = [self.connection]  # type: List[sqlite3.Connection]
+        else:
+            self.shards = []
+            for shard in range(n_shards):
+                shard_connection = sqlite3.connect(self.get_shard_file(db_file, shard), timeout=DB_BUSY_TIMEOUT)
+                shard_connection.execute(db_queries.ENABLE_WAL)
+                self.shards.append(shard_connection)
+
         self.create_tables()
 
     def __del__(self):
+        for shard_connection in getattr(self, 'shards', [])[1:]:
+            shard_connection.close()
         if hasattr(self, 'connection'):
             self.connection.close()
 
+    @staticmethod
+    def get_shard_file(db_file: str, shard: int) -> str:
+        root, ext = os.path.splitext(db_file)
+        return f'{root}.shard{shard}{ext}'
+
+    def get_shard(self, user_id: int) -> sqlite3.Connection:
+        """
+        :param user_id: id of a twitter user
+        :return: connection to the shard holding the processed tweets of the user
+        """
+        return self.shards[int(user_id) % self.n_shards]
+
     def create_tables(self) -> None:
         """
         This method allows to create tables needed to store processed tweets
@@ -36,20 +74,102 @@ class DBAccess:
         self.connection.execute(db_queries.CREATE_PROCESSED_TWEETS_TABLE)
         self.connection.execute(db_queries.CREATE_PROCESSED_TWEETS_ALT_TEXT_INFO_TABLE)
         self.connection.execute(db_queries.CREATE_INDEX_FOR_HISTORIC_USER)
+        self.connection.execute(db_queries.CREATE_INDEX_FOR_PROCESSED_AT)
         self.connection.execute(db_queries.CREATE_FRIENDS_TWEETS_TABLE)
         self.connection.execute(db_queries.CREATE_FOLLOWERS_TABLE)
         self.connection.execute(db_queries.CREATE_ALLOWED_TO_DM_TABLE)
         self.connection.execute(db_queries.CREATE_SETTINGS_TABLE)
+        self.connection.execute(db_queries.CREATE_BROADCAST_DELIVERIES_TABLE)
+        self.connection.execute(db_queries.CREATE_INDEX_FOR_BROADCAST_STATUS)
+        self.connection.execute(db_queries.CREATE_MEDIA_INDEX_TABLE)
+        self.connection.execute(db_queries.CREATE_TWEET_MEDIA_TABLE)
+        self.connection.execute(db_queries.CREATE_INDEX_FOR_TWEET_MEDIA_KEY)
+        self.connection.execute(db_queries.CREATE_SCAN_JOBS_TABLE)
+        self.connection.execute(db_queries.CREATE_INDEX_FOR_SCAN_JOBS_STATUS)
+        self.connection.execute(db_queries.CREATE_ACCOUNT_SCHEDULE_TABLE)
+        self.connection.execute(db_queries.CREATE_SYNC_STAGING_TABLE)
+        self.connection.execute(db_queries.CREATE_NEGATIVE_CACHE_TABLE)
+        self.connection.execute(db_queries.CREATE_RUN_HISTORY_TABLE)
+        self.connection.execute(db_queries.CREATE_INDEX_FOR_RUN_HISTORY_STARTED_AT)
         self.create_last_mention_if_needed()
         self.add_alt_text_columns_if_needed()
 
-    def add_alt_text_columns_if_needed(self):
-        columns = [row[0].lower() for row in self.connection.execute(db_queries.GET_TABLE_INFO,
-                                                             ('processed_tweets_alt_text_info',))]
+        if self.n_shards > 1:
+            for shard_connection in self.shards:
+                shard_connection.execute(db_queries.CREATE_PROCESSED_TWEETS_TABLE)
+                shard_connection.execute(db_queries.CREATE_PROCESSED_TWEETS_ALT_TEXT_INFO_TABLE)
+                shard_connection.execute(db_queries.CREATE_INDEX_FOR_HISTORIC_USER)
+                shard_connection.execute(db_queries.CREATE_INDEX_FOR_PROCESSED_AT)
+                shard_connection.execute(db_queries.CREATE_MEDIA_INDEX_TABLE)
+                shard_connection.execute(db_queries.CREATE_TWEET_MEDIA_TABLE)
+                shard_connection.execute(db_queries.CREATE_INDEX_FOR_TWEET_MEDIA_KEY)
+                self.add_alt_text_columns_if_needed(shard_connection)
+            self.move_processed_tweets_to_shards()
+
+    def add_alt_text_columns_if_needed(self, connection: Optional[sqlite3.Connection] = None):
+        connection = self.connection if connection is None else connection
+        columns = [row[0].lower() for row in connection.execute(db_queries.GET_TABLE_INFO,
+                                                                ('processed_tweets_alt_text_info',))]
         if 'user_alt_text_1'not in columns:
             for single_query in db_queries.ALTER_PROCESSED_TWEETS_ALT_TEXT_INFO_TABLE.split(';'):
-                self.connection.execute(single_query + ';')
-            self.connection.commit()
+                if single_query.strip():
+                    connection.execute(single_query + ';')
+            connection.commit()
+
+    def move_processed_tweets_to_shards(self) -> None:
+        """
+        Move the processed tweets saved in the main DB (before sharding) to their shards: processed_tweets,
+        processed_tweets_alt_text_info, tweet_media and the media_index rows of their media
+        :return: None
+        """
+        n_rows = self.connection.execute(db_queries.COUNT_PROCESSED_TWEETS_TO_SHARD).fetchone()[0]
+        if n_rows == 0:
+            return
+
+        logging.info(f'Moving {n_rows} processed tweets to {self.n_shards} shards')
+
+        # the user of each tweet comes from processed_tweets_alt_text_info, so it is moved the last
+        self.copy_rows_to_shards(db_queries.GET_ALL_PROCESSED_TWEETS_WITH_USER,
+                                 lambda row: (row[0], row[1], [(db_queries.SAVE_PROCESSED_TWEET_NO_FAIL, (row[0],))]))
+        self.copy_rows_to_shards(db_queries.GET_ALL_TWEET_MEDIA_WITH_USER,
+                                 lambda row: (row[0], row[3], [(db_queries.COPY_MEDIA, (row[2],) + row[4:]),
+                                                               (db_queries.ADD_TWEET_MEDIA, row[:3])]))
+        self.copy_rows_to_shards(db_queries.GET_ALL_PROCESSED_TWEETS_ALT_TEXT_INFO,
+                                 lambda row: (row[0], row[2], [(db_queries.SAVE_TWEET_ALT_TEXT_INFO_NO_FAIL, row)]))
+
+        # only once all shards have their rows
+        with self.connection:
+            self.connection.execute(db_queries.DELETE_ALL_PROCESSED_TWEETS)
+            self.connection.execute(db_queries.DELETE_ALL_TWEET_MEDIA)
+            self.connection.execute(db_queries.DELETE_ALL_MEDIA_INDEX)
+            self.connection.execute(db_queries.DELETE_ALL_PROCESSED_TWEETS_ALT_TEXT_INFO)
+            # the rows got new numbers in the shards, the backfill starts over in all of them
+            self.connection.execute(db_queries.DELETE_SETTINGS_WITH_PREFIX,
+                                    (BACKFILL_CAPTIONS_CHECKPOINT_KEY, f'{BACKFILL_CAPTIONS_CHECKPOINT_KEY}_*'))
+
+    def copy_rows_to_shards(self, query: str, to_shard) -> None:
+        """
+        Copy the rows of a query on the main DB to the shards, SHARD_MIGRATION_CHUNK_SIZE at a time
+        :param query: query to read the rows
+        :param to_shard: function from a row to a tuple (tweet_id, user_id, statements), statements being a list of
+         (query, params) to run in the shard of the user; tweets without images have no known user (None), they are
+         spread by tweet_id
+        :return: None
+        """
+        cursor = self.connection.execute(query)
+        while True:
+            rows = cursor.fetchmany(SHARD_MIGRATION_CHUNK_SIZE)
+            if not rows:
+                break
+            statements_by_shard = {}  # type: Dict[int, List[Tuple[str, tuple]]]
+            for row in rows:
+                tweet_id, user_id, statements = to_shard(row)
+                shard = int(user_id if user_id is not None else tweet_id) % self.n_shards
+                statements_by_shard.setdefault(shard, []).extend(statements)
+            for shard, statements in statements_by_shard.items():
+                with self.shards[shard]:
+                    for statement, params in statements:
+                        self.shards[shard].execute(statement, params)
 
     def create_last_mention_if_needed(self):
         if self. get_last_mention_id() is None:
@@ -88,27 +208,30 @@ class DBAccess:
         follower = int(self.is_follower(user_id))
         friend = int(self.is_friend(user_id))
 
-        self.connection.execute(db_queries.SAVE_TWEET_ALT_TEXT_INFO,
-                                (tweet_id, screen_name, user_id, n_images, alt_score,
-                                 processed_at, friend, follower,
-                                 user_alt_text_1, user_alt_text_2, user_alt_text_3, user_alt_text_4,
-                                 bot_alt_text_1, bot_alt_text_2, bot_alt_text_3, bot_alt_text_4
-                                 ))
-        self.connection.commit()
+        shard_connection = self.get_shard(user_id)
+        shard_connection.execute(db_queries.SAVE_TWEET_ALT_TEXT_INFO,
+                                 (tweet_id, screen_name, user_id, n_images, alt_score,
+                                  processed_at, friend, follower,
+                                  user_alt_text_1, user_alt_text_2, user_alt_text_3, user_alt_text_4,
+                                  bot_alt_text_1, bot_alt_text_2, bot_alt_text_3, bot_alt_text_4
+                                  ))
+        shard_connection.commit()
 
-    def save_processed_tweet(self, tweet_id: str, do_not_fail: bool = False) -> None:
+    def save_processed_tweet(self, tweet_id: str, user_id: int, do_not_fail: bool = False) -> None:
         """
         Stores the id of processed tweet, no matter if contains images or not
         :param tweet_id: id of a processed tweet
+        :param user_id: id of the author of the tweet
         :param do_not_fail: do not fail if tweet_id already processed
         :return: None
         """
+        shard_connection = self.get_shard(user_id)
         if do_not_fail:
             # this query ignores the insertion if twet was already in table
-            self.connection.execute(db_queries.SAVE_PROCESSED_TWEET_NO_FAIL, (tweet_id,))
+            shard_connection.execute(db_queries.SAVE_PROCESSED_TWEET_NO_FAIL, (tweet_id,))
         else:
-            self.connection.execute(db_queries.SAVE_PROCESSED_TWEET, (tweet_id,))
-        self.connection.commit()
+            shard_connection.execute(db_queries.SAVE_PROCESSED_TWEET, (tweet_id,))
+        shard_connection.commit()
 
     def tweet_was_processed(self, tweet_id: str) -> bool:
         """
@@ -116,8 +239,8 @@ class DBAccess:
         :param tweet_id: id of the tweet to be checked
         :return: True iff the tweet already exist on db
         """
-        res = self.connection.execute(db_queries.CHECK_TWEET_PROCESSED, (tweet_id,)).fetchone()[0]
-        return bool(res)
+        return any(shard_connection.execute(db_queries.CHECK_TWEET_PROCESSED, (tweet_id,)).fetchone()[0]
+                   for shard_connection in self.shards)
 
     def is_follower(self, user_id) -> bool:
         res = self.connection.execute(db_queries.CHECK_FOLLOWER, (user_id,)).fetchone()[0]
@@ -205,7 +328,7 @@ class DBAccess:
         :return: the datetime when last tweet of the user was processed
         """
 
-        last_update = self.connection.execute(db_queries.MOST_RECENT_WITH_IMAGES, (user_id,)).fetchone()[0]
+        last_update = self.get_shard(user_id).execute(db_queries.MOST_RECENT_WITH_IMAGES, (user_id,)).fetchone()[0]
         ret = last_update if last_update is None else datetime.strptime(last_update, '%Y-%m-%d %H:%M:%S')
 
         return ret
@@ -220,7 +343,7 @@ class DBAccess:
 
         df = pd.DataFrame([
             dict(n_images=row[0], alt_score=row[1]) for row in
-            self.connection.execute(db_queries.GET_HISTORIC_SCORE_TABLE, (user_id,))])
+            self.get_shard(user_id).execute(db_queries.GET_HISTORIC_SCORE_TABLE, (user_id,))])
 
         if len(df) > 0:
             n_images = df['n_images'].sum()
@@ -236,7 +359,8 @@ class DBAccess:
         df = pd.DataFrame(
             [dict(screen_name=row[0], user_id=row[1], n_images=row[2], alt_score=row[3], friend=row[4], follower=row[5])
              for row in
-             self.connection.execute(db_queries.GET_HISTORIC_INFO_TABLE_FULL, (start_date,))
+             chain(*[shard_connection.execute(db_queries.GET_HISTORIC_INFO_TABLE_FULL, (start_date,))
+                     for shard_connection in self.shards])
              if ((row[4] and friends) or (row[5] and followers))])
 
         if len(df) == 0:
@@ -267,22 +391,38 @@ class DBAccess:
 
         return result, n_accounts, n_accounts_some_texts
 
-    def update_user_alt_text_info(self, tweet_id: str, user_alt_text_1: str = None, user_alt_text_2: str = None,
-                                  user_alt_text_3: str = None, user_alt_text_4: str = None):
+    def update_user_alt_text_info(self, tweet_id: str, user_id: int, user_alt_text_1: str = None,
+                                  user_alt_text_2: str = None, user_alt_text_3: str = None,
+                                  user_alt_text_4: str = None):
 
-        self.connection.execute(db_queries.UPDATE_USER_ALT_TEXT_INFO,
-                                (user_alt_text_1, user_alt_text_2, user_alt_text_3, user_alt_text_4, tweet_id))
-        self.connection.commit()
+        shard_connection = self.get_shard(user_id)
+        shard_connection.execute(db_queries.UPDATE_USER_ALT_TEXT_INFO,
+                                 (user_alt_text_1, user_alt_text_2, user_alt_text_3, user_alt_text_4, tweet_id))
+        shard_connection.commit()
 
-    def update_bot_alt_text_info(self, tweet_id: str, bot_alt_text_1: str = None, bot_alt_text_2: str = None,
-                                  bot_alt_text_3: str = None, bot_alt_text_4: str = None):
+    def update_bot_alt_text_info(self, tweet_id: str, user_id: int, bot_alt_text_1: str = None,
+                                 bot_alt_text_2: str = None, bot_alt_text_3: str = None, bot_alt_text_4: str = None):
 
-        self.connection.execute(db_queries.UPDATE_USER_ALT_TEXT_INFO,
-                                (bot_alt_text_1, bot_alt_text_2, bot_alt_text_3, bot_alt_text_4, tweet_id))
-        self.connection.commit()
+        shard_connection = self.get_shard(user_id)
+        shard_connection.execute(db_queries.UPDATE_BOT_ALT_TEXT_INFO,
+                                 (bot_alt_text_1, bot_alt_text_2, bot_alt_text_3, bot_alt_text_4, tweet_id))
+        shard_connection.commit()
+
+    def find_in_shards(self, query: str, params: tuple) -> Optional[tuple]:
+        """
+        Run the query in each shard until some returns a row; for queries by tweet_id, whose user is not known
+        :param query: query to run
+        :param params: query parameters
+        :return: first row found, None if no shard returns rows
+        """
+        for shard_connection in self.shards:
+            row = shard_connection.execute(query, params).fetchone()
+            if row is not None:
+                return row
+        return None
 
     def get_alt_score_from_tweet(self, tweet_id: str) -> Optional[float]:
-        query_result = self.connection.execute(db_queries.GET_ALT_SCORE_FOR_PROCESSED_TWEET, (tweet_id,)).fetchone()
+        query_result = self.find_in_shards(db_queries.GET_ALT_SCORE_FOR_PROCESSED_TWEET, (tweet_id,))
 
         result = None if query_result is None else query_result[0]
 
@@ -290,7 +430,7 @@ class DBAccess:
 
     def get_alt_text_info_from_tweet(self, tweet_id: str) -> Optional[Dict[str, Union[List[Optional[str]], int, float]]]:
 
-        query_result = self.connection.execute(db_queries.GET_ALT_TEXT_INFO_FROM_TWEET, (tweet_id,)).fetchone()
+        query_result = self.find_in_shards(db_queries.GET_ALT_TEXT_INFO_FROM_TWEET, (tweet_id,))
 
         if query_result is not None:
             result = dict(n_images=int(query_result[0]), alt_score=float(query_result[1]),
@@ -310,6 +450,412 @@ class DBAccess:
         self.connection.execute(db_queries.UPDATE_SETTING, (last_mention_id, DBAccess.last_mention_key_setting))
         self.connection.commit()
 
+    def add_broadcast_recipients(self, broadcast_id: str, recipients: Set[Tuple[str, int]]) -> None:
+        """
+        Register recipients for the given broadcast as pending; recipients already registered keep their state,
+        so calling it again for the same broadcast does not resend anything
+        :param broadcast_id: id of the broadcast, computed from the message
+        :param recipients: set of pairs (screen_name, user_id) to receive the message
+        :return: None
+        """
+        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        self.connection.executemany(db_queries.ADD_BROADCAST_RECIPIENT,
+                                    [(broadcast_id, user_id, screen_name, now) for screen_name, user_id in recipients])
+        self.connection.commit()
+
+    def get_pending_broadcast_recipients(self, broadcast_id: str, max_attempts: int) -> List[Tuple[str, int]]:
+        """
+        Get recipients of the broadcast still waiting for the message: never tried or failed less than max_attempts
+        :param broadcast_id: id of the broadcast
+        :param max_attempts: failed deliveries with this number of attempts are not retried anymore
+        :return: list of pairs (screen_name, user_id)
+        """
+        return [(row[0], row[1]) for row in self.connection.execute(db_queries.GET_PENDING_BROADCAST_RECIPIENTS,
+                                                                    (broadcast_id, max_attempts))]
+
+    def update_broadcast_delivery(self, broadcast_id: str, user_id: int, status: str,
+                                  error: Optional[str] = None) -> None:
+        """
+        Save the result of a delivery attempt
+        :param broadcast_id: id of the broadcast
+        :param user_id: recipient of the message
+        :param status: one of 'sent', 'closed' (DMs closed for the bot, never retried) or 'failed'
+        :param error: error description, if any
+        :return: None
+        """
+        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        self.connection.execute(db_queries.UPDATE_BROADCAST_DELIVERY, (status, error, now, broadcast_id, user_id))
+        self.connection.commit()
+
+    def count_dms_sent_since(self, since: datetime) -> int:
+        """
+        Count broadcast DMs sent since the given datetime, needed to respect the DM quota
+        :param since: datetime to start counting
+        :return: number of DMs sent
+        """
+        return self.connection.execute(db_queries.COUNT_DMS_SENT_SINCE,
+                                       (since.strftime("%Y-%m-%d %H:%M:%S"),)).fetchone()[0]
+
+    def get_broadcast_report(self, broadcast_id: str) -> Dict[str, Dict[str, int]]:
+        """
+        Summarize the state of each delivery in the broadcast
+        :param broadcast_id: id of the broadcast
+        :return: dict from status to a dict with the number of recipients and attempts in that status
+        """
+        return {row[0]: dict(recipients=row[1], attempts=row[2])
+                for row in self.connection.execute(db_queries.GET_BROADCAST_REPORT, (broadcast_id,))}
+
+    def get_setting(self, key: str, default: Optional[str] = None) -> Optional[str]:
+        """
+        Read a value from bot_settings
+        :param key: setting key
+        :param default: value to return if the setting does not exist
+        :return: the setting value, as string
+        """
+        query_result = self.connection.execute(db_queries.GET_SETTING, (key,)).fetchone()
+        return default if query_result is None else query_result[0]
+
+    def set_setting(self, key: str, value: Optional[str]) -> None:
+        """
+        Write a value to bot_settings, creating the setting if needed
+        :param key: setting key
+        :param value: value to save
+        :return: None
+        """
+        self.connection.execute(db_queries.UPSERT_SETTING, (key, value))
+        self.connection.commit()
+
+    def delete_setting(self, key: str) -> None:
+        """
+        Remove a value from bot_settings, if it exists
+        :param key: setting key
+        :return: None
+        """
+        self.connection.execute(db_queries.DELETE_SETTING, (key,))
+        self.connection.commit()
+
+    def get_tweets_without_bot_alt_text(self, after_row: int, chunk_size: int,
+                                        shard: int = 0) -> List[Dict[str, Union[int, str, List[Optional[str]]]]]:
+        """
+        Get a chunk of processed tweets with some image without user alt_text and without bot alt_texts
+        :param after_row: only rows after this one are considered; use the last row of the previous chunk to go on
+        :param chunk_size: max number of tweets to return
+        :param shard: shard to read; rows are numbered independently in each shard
+        :return: list of dicts with keys row, tweet_id, user_id, n_images and user_alt_text, ordered by row
+        """
+        return [dict(row=row[0], tweet_id=row[1], user_id=row[2], n_images=row[3], user_alt_text=list(row[4:8]))
+                for row in self.shards[shard].execute(db_queries.GET_TWEETS_WITHOUT_BOT_ALT_TEXT,
+                                                      (after_row, chunk_size))]
+
+    def update_bot_alt_text_info_bulk(self, bot_alt_texts: Dict[str, List[Optional[str]]], shard: int = 0) -> None:
+        """
+        Update the bot alt_texts of several tweets in a single transaction
+        :param bot_alt_texts: dict from tweet_id to the list of (up to 4) bot alt_texts
+        :param shard: shard holding the tweets, as given to get_tweets_without_bot_alt_text
+        :return: None
+        """
+        params = [tuple((texts + [None] * 4)[:4]) + (tweet_id,) for tweet_id, texts in bot_alt_texts.items()]
+
+        with self.shards[shard]:
+            self.shards[shard].executemany(db_queries.UPDATE_BOT_ALT_TEXT_INFO, params)
+
+    def index_tweet_media(self, tweet_id: str, user_id: int, photos: List[Dict[str, Optional[str]]]) -> None:
+        """
+        Save the photos of the tweet in the media index of the shard of its author; photos already indexed there (same
+        media in other tweets) just count one more sight, keeping the known bot alt_text unless a new one is given
+        :param tweet_id: id of the tweet
+        :param user_id: id of the author of the tweet
+        :param photos: list of dicts with keys media_key, url, alt_text and optionally bot_alt_text
+        :return: None
+        """
+        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        shard_connection = self.get_shard(user_id)
+
+        with shard_connection:
+            for position, photo in enumerate(photos, start=1):
+                shard_connection.execute(db_queries.ADD_MEDIA, (photo['media_key'], photo['url'], photo['alt_text'],
+                                                                photo.get('bot_alt_text'), tweet_id, now))
+                if shard_connection.execute(db_queries.ADD_TWEET_MEDIA,
+                                            (tweet_id, position, photo['media_key'])).rowcount > 0:
+                    shard_connection.execute(db_queries.UPDATE_MEDIA_SEEN, (photo['alt_text'],
+                                                                            photo.get('bot_alt_text'),
+                                                                            photo['media_key']))
+
+    def get_media(self, media_key: str) -> Optional[Dict[str, Optional[str]]]:
+        """
+        Get an indexed media
+        :param media_key: twitter id of the media
+        :return: dict with keys media_key, url, alt_text and bot_alt_text, or None if not indexed
+        """
+        row = self.find_in_shards(db_queries.GET_MEDIA, (media_key,))
+        return None if row is None else dict(media_key=media_key, url=row[0], alt_text=row[1], bot_alt_text=row[2])
+
+    def get_tweet_media(self, tweet_id: str) -> List[Dict[str, Optional[str]]]:
+        """
+        Get the indexed photos of the tweet
+        :param tweet_id: id of the tweet
+        :return: list of dicts with keys media_key, url, alt_text and bot_alt_text; empty if the tweet is not indexed
+        """
+        for shard_connection in self.shards:
+            photos = [dict(media_key=row[0], url=row[1], alt_text=row[2], bot_alt_text=row[3])
+                      for row in shard_connection.execute(db_queries.GET_TWEET_MEDIA, (tweet_id,))]
+            if photos:
+                return photos
+        return []
+
+    def count_unique_images(self, start_date: str = INIT_SYSTEM_DATE, followers: bool = False,
+                            friends: bool = False) -> Tuple[int, int]:
+        """
+        Count the images processed since start_date, considering repeated media only once
+        :param start_date: only tweets processed since this date are considered
+        :param followers: consider tweets from followers
+        :param friends: consider tweets from friends
+        :return: pair with the number of unique images and the number of images including repetitions
+        """
+        # the same media may be in tweets of users in different shards
+        n_seen = {}  # type: Dict[str, int]
+        for shard_connection in self.shards:
+            for media_key, count in shard_connection.execute(db_queries.COUNT_IMAGES_BY_MEDIA,
+                                                             (start_date, int(friends), int(followers))):
+                n_seen[media_key] = n_seen.get(media_key, 0) + count
+
+        return len(n_seen), sum(n_seen.values())
+
+    def enqueue_scan_jobs(self, kind: str, users: List[Tuple[str, int, bool, float]]) -> None:
+        """
+        Queue accounts to be scanned. Finished jobs of the same accounts are queued again; jobs still pending just
+        get the new data; jobs being processed are left alone
+        :param kind: 'follower' or 'friend'
+        :param users: list of (screen_name, user_id, allowed_to_dm, priority); higher priority jobs are claimed first
+        :return: None
+        """
+        now = time.time()
+
+        with self.connection:
+            for screen_name, user_id, allowed_to_dm, priority in users:
+                self.connection.execute(db_queries.REQUEUE_SCAN_JOB, (screen_name, int(allowed_to_dm), priority, now,
+                                                                      kind, user_id))
+                self.connection.execute(db_queries.UPDATE_PENDING_SCAN_JOB, (screen_name, int(allowed_to_dm),
+                                                                             priority, kind, user_id))
+                self.connection.execute(db_queries.ADD_SCAN_JOB, (kind, user_id, screen_name, int(allowed_to_dm),
+                                                                  priority, now))
+
+    def claim_scan_jobs(self, kind: str, owner: str, n: int, lease_seconds: float) -> List[Tuple[str, int, bool]]:
+        """
+        Lease up to n pending jobs (or jobs whose lease expired, because their worker died) to the given owner, those
+        allowed to DM first, then by priority. The claim runs in a write transaction, so two workers never get the
+        same job
+        :param kind: 'follower' or 'friend'
+        :param owner: id of the worker process
+        :param n: max number of jobs to claim
+        :param lease_seconds: the jobs return to the queue if not completed nor renewed in this time
+        :return: list of (screen_name, user_id, allowed_to_dm) of the claimed jobs
+        """
+        now = time.time()
+
+        # BEGIN IMMEDIATE takes the write lock before reading, no other worker can claim in between
+        self.connection.commit()
+        self.connection.execute('BEGIN IMMEDIATE')
+        try:
+            rows = self.connection.execute(db_queries.GET_CLAIMABLE_SCAN_JOBS,
+                                           (kind, n, kind, now, n, n)).fetchall()
+            for user_id, _, _ in rows:
+                self.connection.execute(db_queries.LEASE_SCAN_JOB, (owner, now + lease_seconds, kind, user_id))
+            self.connection.commit()
+        except sqlite3.Error:
+            self.connection.rollback()
+            raise
+
+        return [(screen_name, user_id, bool(allowed_to_dm)) for user_id, screen_name, allowed_to_dm in rows]
+
+    def renew_scan_job_lease(self, kind: str, user_id: int, owner: str, lease_seconds: float) -> bool:
+        """
+        Extend the lease of a job still being processed
+        :param kind: 'follower' or 'friend'
+        :param user_id: id of the account of the job
+        :param owner: id of the worker process
+        :param lease_seconds: new lease, from now
+        :return: False if the job is no longer leased to owner
+        """
+        with self.connection:
+            return self.connection.execute(db_queries.RENEW_SCAN_JOB_LEASE, (time.time() + lease_seconds, kind,
+                                                                             user_id, owner)).rowcount > 0
+
+    def complete_scan_job(self, kind: str, user_id: int, owner: str, success: bool, max_attempts: int) -> None:
+        """
+        Release a leased job: done on success, otherwise back to pending until max_attempts, then failed
+        :param kind: 'follower' or 'friend'
+        :param user_id: id of the account of the job
+        :param owner: id of the worker process; nothing is done if the job is no longer leased to it
+        :param success: whether the account was scanned
+        :param max_attempts: max times a job is tried
+        :return: None
+        """
+        with self.connection:
+            self.connection.execute(db_queries.FINISH_SCAN_JOB, (int(success), max_attempts, time.time(), kind,
+                                                                 user_id, owner))
+
+    def release_scan_jobs(self, kind: str, user_ids: List[int], owner: str) -> None:
+        """
+        Give back leased jobs that were not started, without counting the attempt
+        :param kind: 'follower' or 'friend'
+        :param user_ids: ids of the accounts of the jobs
+        :param owner: id of the worker process; jobs no longer leased to it are left alone
+        :return: None
+        """
+        with self.connection:
+            self.connection.executemany(db_queries.RELEASE_SCAN_JOB, [(kind, user_id, owner) for user_id in user_ids])
+
+    def get_scan_job_lease_owners(self, kind: str) -> Set[str]:
+        """
+        :param kind: 'follower' or 'friend'
+        :return: ids of the worker processes holding leases of jobs of the kind
+        """
+        return {row[0] for row in self.connection.execute(db_queries.GET_SCAN_JOB_LEASE_OWNERS, (kind,))}
+
+    def expire_scan_job_leases(self, kind: str, owner: str) -> None:
+        """
+        Make the jobs leased by owner claimable right away, e.g. when it is known to be dead; the attempt counts
+        :param kind: 'follower' or 'friend'
+        :param owner: id of the worker process
+        :return: None
+        """
+        with self.connection:
+            self.connection.execute(db_queries.EXPIRE_SCAN_JOB_LEASES_OF_OWNER, (kind, owner))
+
+    def count_scan_jobs(self, kind: str) -> Dict[str, int]:
+        """
+        :param kind: 'follower' or 'friend'
+        :return: dict from status (pending, leased, done, failed) to number of jobs
+        """
+        return {row[0]: row[1] for row in self.connection.execute(db_queries.COUNT_SCAN_JOBS_BY_STATUS, (kind,))}
+
+    def get_account_schedules(self) -> Dict[int, Dict[str, Optional[float]]]:
+        """
+        :return: dict from user_id to its scan schedule: dict with keys image_rate (image tweets per day),
+                 scan_interval (seconds), last_scan_at and next_due_at (epochs)
+        """
+        return {row[0]: dict(image_rate=row[1], scan_interval=row[2], last_scan_at=row[3], next_due_at=row[4])
+                for row in self.connection.execute(db_queries.GET_ACCOUNT_SCHEDULES)}
+
+    def get_account_schedule(self, user_id: int) -> Optional[Dict[str, Optional[float]]]:
+        """
+        :param user_id: id of the account
+        :return: scan schedule of the account, see get_account_schedules; None if it was never scheduled
+        """
+        row = self.connection.execute(db_queries.GET_ACCOUNT_SCHEDULE, (user_id,)).fetchone()
+        return None if row is None else dict(image_rate=row[0], scan_interval=row[1], last_scan_at=row[2],
+                                             next_due_at=row[3])
+
+    def save_account_schedule(self, user_id: int, image_rate: float, scan_interval: float,
+                              last_scan_at: Optional[float], next_due_at: float) -> None:
+        """
+        Save the scan schedule of the account
+        :param user_id: id of the account
+        :param image_rate: estimated image tweets per day
+        :param scan_interval: seconds between scans
+        :param last_scan_at: epoch of the last scan
+        :param next_due_at: epoch of the next scan
+        :return: None
+        """
+        self.connection.execute(db_queries.SAVE_ACCOUNT_SCHEDULE, (user_id, image_rate, scan_interval, last_scan_at,
+                                                                   next_due_at))
+        self.connection.commit()
+
+    def count_image_tweets_by_user(self, since: str) -> Dict[int, int]:
+        """
+        :param since: date, as saved in processed_at
+        :return: dict from user_id to number of tweets with images processed since the date
+        """
+        return {row[0]: row[1] for shard_connection in self.shards
+                for row in shard_connection.execute(db_queries.GET_IMAGE_TWEETS_BY_USER, (since,))}
+
+    def count_image_tweets_for_user(self, user_id: int, since: str) -> int:
+        """
+        :param user_id: id of the account
+        :param since: date, as saved in processed_at
+        :return: number of tweets with images of the account processed since the date
+        """
+        return self.get_shard(user_id).execute(db_queries.COUNT_IMAGE_TWEETS_FOR_USER, (user_id, since)).fetchone()[0]
+
+    def save_sync_page(self, sync_key: str, users: List[Tuple[Optional[str], int]], next_cursor: int) -> None:
+        """
+        Save a page read by a paginated fetch together with the cursor of the next page, in a single transaction,
+        so the fetch can be resumed from there
+        :param sync_key: name of the fetch
+        :param users: list of (screen_name, user_id) in the page; screen_name may be None
+        :param next_cursor: cursor of the next page
+        :return: None
+        """
+        with self.connection:
+            self.connection.executemany(db_queries.ADD_SYNC_STAGING_USER,
+                                        [(sync_key, user_id, screen_name) for screen_name, user_id in users])
+            self.connection.execute(db_queries.UPSERT_SETTING, (f'sync_cursor_{sync_key}', str(next_cursor)))
+
+    def get_sync_checkpoint(self, sync_key: str) -> Tuple[Optional[int], Set[Tuple[Optional[str], int]]]:
+        """
+        :param sync_key: name of the fetch
+        :return: pair with the cursor of the next page to read, None if there is no fetch to resume, and the users
+                 read so far
+        """
+        cursor = self.get_setting(f'sync_cursor_{sync_key}')
+        if cursor is None:
+            return None, set()
+        return int(cursor), {(row[0], row[1]) for row in self.connection.execute(db_queries.GET_SYNC_STAGING_USERS,
+                                                                                 (sync_key,))}
+
+    def clear_sync_checkpoint(self, sync_key: str) -> None:
+        """
+        Forget the checkpoint of a finished fetch
+        :param sync_key: name of the fetch
+        :return: None
+        """
+        with self.connection:
+            self.connection.execute(db_queries.DELETE_SYNC_STAGING_USERS, (sync_key,))
+            self.connection.execute(db_queries.DELETE_SETTING, (f'sync_cursor_{sync_key}',))
+
+    def add_negative_cache(self, target_type: str, target_id: Union[int, str], error_code: int, ttl: float) -> None:
+        """
+        Remember that the account or tweet can not be read, removing expired entries on the way
+        :param target_type: 'user' or 'tweet'
+        :param target_id: id of the user or tweet
+        :param error_code: error got when reading it
+        :param ttl: seconds to remember it
+        :return: None
+        """
+        now = time.time()
+        with self.connection:
+            self.connection.execute(db_queries.PURGE_NEGATIVE_CACHE, (now,))
+            self.connection.execute(db_queries.ADD_NEGATIVE_CACHE, (target_type, str(target_id), error_code,
+                                                                    now + ttl))
+
+    def get_negative_cache(self, target_type: str, target_id: Union[int, str]) -> Optional[int]:
+        """
+        :param target_type: 'user' or 'tweet'
+        :param target_id: id of the user or tweet
+        :return: the error got when reading it, if not expired; None otherwise
+        """
+        row = self.connection.execute(db_queries.GET_NEGATIVE_CACHE, (target_type, str(target_id),
+                                                                      time.time())).fetchone()
+        return None if row is None else row[0]
+
+    def save_run_summary(self, started_at: str, worker_id: str, summary: str) -> None:
+        """
+        :param started_at: date the run started, as %Y-%m-%d %H:%M:%S
+        :param worker_id: process that did the run
+        :param summary: JSON document with the timings and counts of the run
+        :return: None
+        """
+        with self.connection:
+            self.connection.execute(db_queries.SAVE_RUN_SUMMARY, (started_at, worker_id, summary))
+
+    def get_run_history(self, start_date: str = INIT_SYSTEM_DATE) -> List[str]:
+        """
+        :param start_date: first date to get runs from
+        :return: JSON summaries of the runs started since start_date, oldest first
+        """
+        return [row[0] for row in self.connection.execute(db_queries.GET_RUN_HISTORY, (start_date,))]
+
 
 if __name__ == '__main__':
 
@@ -26,8 +26,7 @@ ALTER_PROCESSED_TWEETS_ALT_TEXT_INFO_TABLE = """
  ALTER TABLE processed_tweets_alt_text_info  ADD COLUMN bot_alt_text_1 TEXT NULL;
  ALTER TABLE processed_tweets_alt_text_info  ADD COLUMN bot_alt_text_2 TEXT NULL;
  ALTER TABLE processed_tweets_alt_text_info  ADD COLUMN bot_alt_text_3 TEXT NULL;
- ALTER TABLE processed_tweets_alt_text_info  ADD COLUMN bot_alt_text_4 TEXT NULL; 
-                                    );
+ ALTER TABLE processed_tweets_alt_text_info  ADD COLUMN bot_alt_text_4 TEXT NULL;
 """
 
 GET_TABLE_INFO = """SELECT name FROM PRAGMA_TABLE_INFO(?);"""
@@ -36,6 +35,13 @@ CREATE_INDEX_FOR_HISTORIC_USER = """
 CREATE INDEX IF NOT EXISTS processed_tweets_alt_text_info_user_id_index ON processed_tweets_alt_text_info(user_id);
 """
 
+# image tweets of the users in the last days (GET_IMAGE_TWEETS_BY_USER, COUNT_IMAGE_TWEETS_FOR_USER), read from the
+# index alone; sqlite seeks the dates of each user_id instead of reading every row
+CREATE_INDEX_FOR_PROCESSED_AT = """
+CREATE INDEX IF NOT EXISTS processed_tweets_alt_text_info_user_processed_at_index
+ON processed_tweets_alt_text_info(user_id, processed_at);
+"""
+
 CREATE_FOLLOWERS_TABLE = """
  CREATE TABLE IF NOT EXISTS followers (
                                         screen_name TEXT,
@@ -147,3 +153,332 @@ MOST_RECENT_WITH_IMAGES = """
 Select MAX(processed_at) from processed_tweets_alt_text_info
 WHERE user_id=?;
 """
+
+CREATE_BROADCAST_DELIVERIES_TABLE = """
+ CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+                                        broadcast_id TEXT,
+                                        user_id INT,
+                                        screen_name TEXT,
+                                        status TEXT,
+                                        attempts INTEGER,
+                                        last_error TEXT,
+                                        updated_at TEXT,
+                                        PRIMARY KEY (broadcast_id, user_id)
+                                    );
+"""
+
+CREATE_INDEX_FOR_BROADCAST_STATUS = """
+CREATE INDEX IF NOT EXISTS broadcast_deliveries_status_index ON broadcast_deliveries(status, updated_at);
+"""
+
+ADD_BROADCAST_RECIPIENT = """
+INSERT OR IGNORE INTO broadcast_deliveries (broadcast_id, user_id, screen_name, status, attempts, updated_at)
+      VALUES (?, ?, ?, 'pending', 0, ?);
+"""
+
+GET_PENDING_BROADCAST_RECIPIENTS = """SELECT screen_name, user_id FROM broadcast_deliveries
+                                      WHERE broadcast_id=? AND (status='pending' OR (status='failed' AND attempts<?))
+                                      ORDER BY user_id"""
+
+UPDATE_BROADCAST_DELIVERY = """UPDATE broadcast_deliveries
+                               SET status=?, attempts=attempts+1, last_error=?, updated_at=?
+                               WHERE broadcast_id=? AND user_id=?"""
+
+COUNT_DMS_SENT_SINCE = "SELECT Count(*) FROM broadcast_deliveries WHERE status='sent' AND updated_at>=?"
+
+GET_BROADCAST_REPORT = """SELECT status, Count(*), SUM(attempts) FROM broadcast_deliveries
+                          WHERE broadcast_id=? GROUP BY status"""
+
+# Caption cache, in its own DB file (CAPTION_CACHE_DB_FILE)
+CAPTION_CACHE_AUTO_VACUUM = "PRAGMA auto_vacuum = INCREMENTAL;"
+
+CREATE_CAPTION_CACHE_TABLE = """
+ CREATE TABLE IF NOT EXISTS caption_cache (
+                                        url TEXT PRIMARY KEY,
+                                        image_hash INTEGER,
+                                        hash_band_0 INTEGER,
+                                        hash_band_1 INTEGER,
+                                        hash_band_2 INTEGER,
+                                        hash_band_3 INTEGER,
+                                        suggestion TEXT,
+                                        source TEXT,
+                                        last_used_at REAL
+                                    );
+"""
+
+CREATE_INDEXES_FOR_CAPTION_CACHE = """
+CREATE INDEX IF NOT EXISTS caption_cache_band_0_index ON caption_cache(hash_band_0);
+CREATE INDEX IF NOT EXISTS caption_cache_band_1_index ON caption_cache(hash_band_1);
+CREATE INDEX IF NOT EXISTS caption_cache_band_2_index ON caption_cache(hash_band_2);
+CREATE INDEX IF NOT EXISTS caption_cache_band_3_index ON caption_cache(hash_band_3);
+CREATE INDEX IF NOT EXISTS caption_cache_last_used_at_index ON caption_cache(last_used_at);
+"""
+
+GET_CACHED_CAPTION_BY_URL = "SELECT suggestion, source FROM caption_cache WHERE url=?"
+
+GET_CACHED_CAPTION_CANDIDATES_BY_HASH = """SELECT url, image_hash, suggestion, source FROM caption_cache
+                                           WHERE hash_band_0=? OR hash_band_1=? OR hash_band_2=? OR hash_band_3=?"""
+
+TOUCH_CACHED_CAPTION = "UPDATE caption_cache SET last_used_at=? WHERE url=?"
+
+SAVE_CACHED_CAPTION = """
+INSERT OR REPLACE INTO caption_cache (url, image_hash, hash_band_0, hash_band_1, hash_band_2, hash_band_3,
+                                      suggestion, source, last_used_at)
+      VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);
+"""
+
+EVICT_LEAST_RECENTLY_USED_CAPTIONS = """DELETE FROM caption_cache WHERE url IN
+                                        (SELECT url FROM caption_cache ORDER BY last_used_at LIMIT ?)"""
+
+COUNT_CACHED_CAPTIONS = "SELECT Count(*) FROM caption_cache"
+
+GET_DB_SIZE = "SELECT page_count * page_size FROM pragma_page_count(), pragma_page_size()"
+
+INCREMENTAL_VACUUM = "PRAGMA incremental_vacuum;"
+
+UPSERT_SETTING = "INSERT OR REPLACE INTO bot_settings (setting_key, setting_value) VALUES (?,?);"
+
+DELETE_SETTING = "DELETE FROM bot_settings WHERE setting_key=?"
+
+# the setting and the ones named after it (setting_key, setting_key_*)
+DELETE_SETTINGS_WITH_PREFIX = "DELETE FROM bot_settings WHERE setting_key=? OR setting_key GLOB ?"
+
+GET_TWEETS_WITHOUT_BOT_ALT_TEXT = """SELECT rowid, tweet_id, user_id, n_images,
+                                            user_alt_text_1, user_alt_text_2, user_alt_text_3, user_alt_text_4
+                                     FROM processed_tweets_alt_text_info
+                                     WHERE rowid>? AND alt_score<1
+                                           AND bot_alt_text_1 IS NULL AND bot_alt_text_2 IS NULL
+                                           AND bot_alt_text_3 IS NULL AND bot_alt_text_4 IS NULL
+                                     ORDER BY rowid LIMIT ?"""
+
+CREATE_MEDIA_INDEX_TABLE = """
+ CREATE TABLE IF NOT EXISTS media_index (
+                                        media_key TEXT PRIMARY KEY,
+                                        url TEXT,
+                                        user_alt_text TEXT NULL,
+                                        bot_alt_text TEXT NULL,
+                                        first_tweet_id TEXT,
+                                        first_seen_at TEXT,
+                                        n_seen INTEGER
+                                    );
+"""
+
+CREATE_TWEET_MEDIA_TABLE = """
+ CREATE TABLE IF NOT EXISTS tweet_media (
+                                        tweet_id TEXT,
+                                        position INTEGER,
+                                        media_key TEXT,
+                                        PRIMARY KEY (tweet_id, position)
+                                    );
+"""
+
+CREATE_INDEX_FOR_TWEET_MEDIA_KEY = """
+CREATE INDEX IF NOT EXISTS tweet_media_media_key_index ON tweet_media(media_key);
+"""
+
+ADD_MEDIA = """
+INSERT OR IGNORE INTO media_index (media_key, url, user_alt_text, bot_alt_text, first_tweet_id, first_seen_at, n_seen)
+      VALUES (?, ?, ?, ?, ?, ?, 0);
+"""
+
+UPDATE_MEDIA_SEEN = """UPDATE media_index
+                       SET n_seen=n_seen+1, user_alt_text=?, bot_alt_text=COALESCE(?, bot_alt_text)
+                       WHERE media_key=?"""
+
+ADD_TWEET_MEDIA = "INSERT OR IGNORE INTO tweet_media (tweet_id, position, media_key) VALUES (?, ?, ?);"
+
+GET_MEDIA = "SELECT url, user_alt_text, bot_alt_text FROM media_index WHERE media_key=?"
+
+GET_TWEET_MEDIA = """SELECT media_index.media_key, url, user_alt_text, bot_alt_text
+                     FROM tweet_media JOIN media_index ON tweet_media.media_key=media_index.media_key
+                     WHERE tweet_id=? ORDER BY position"""
+
+COUNT_IMAGES_BY_MEDIA = """SELECT tweet_media.media_key, Count(*)
+                           FROM tweet_media JOIN processed_tweets_alt_text_info
+                                ON tweet_media.tweet_id=processed_tweets_alt_text_info.tweet_id
+                           WHERE processed_at>=? AND ((friend AND ?) OR (follower AND ?))
+                           GROUP BY tweet_media.media_key"""
+
+ENABLE_WAL = "PRAGMA journal_mode=WAL;"
+
+CREATE_SCAN_JOBS_TABLE = """
+ CREATE TABLE IF NOT EXISTS scan_jobs (
+                                        kind TEXT,
+                                        user_id INT,
+                                        screen_name TEXT,
+                                        allowed_to_dm INTEGER,
+                                        priority REAL,
+                                        status TEXT,
+                                        lease_owner TEXT NULL,
+                                        lease_expires_at REAL NULL,
+                                        attempts INTEGER,
+                                        enqueued_at REAL,
+                                        finished_at REAL NULL,
+                                        PRIMARY KEY (kind, user_id)
+                                    );
+"""
+
+# claims read the pending jobs of a kind in the order of the index, without sorting them
+CREATE_INDEX_FOR_SCAN_JOBS_STATUS = """
+CREATE INDEX IF NOT EXISTS scan_jobs_claim_index ON scan_jobs(kind, status, allowed_to_dm, priority);
+"""
+
+ADD_SCAN_JOB = """
+INSERT OR IGNORE INTO scan_jobs (kind, user_id, screen_name, allowed_to_dm, priority, status, attempts, enqueued_at)
+      VALUES (?, ?, ?, ?, ?, 'pending', 0, ?);
+"""
+
+REQUEUE_SCAN_JOB = """UPDATE scan_jobs
+                      SET status='pending', screen_name=?, allowed_to_dm=?, priority=?, attempts=0, enqueued_at=?,
+                          lease_owner=NULL, lease_expires_at=NULL
+                      WHERE kind=? AND user_id=? AND status IN ('done', 'failed')"""
+
+UPDATE_PENDING_SCAN_JOB = """UPDATE scan_jobs SET screen_name=?, allowed_to_dm=?, priority=?
+                             WHERE kind=? AND user_id=? AND status='pending'"""
+
+# pending jobs and jobs whose lease expired, each part on its own so both use scan_jobs_claim_index: an OR of the two
+# statuses would read every job of the kind and sort them
+GET_CLAIMABLE_SCAN_JOBS = """SELECT user_id, screen_name, allowed_to_dm FROM (
+                                 SELECT * FROM (SELECT user_id, screen_name, allowed_to_dm, priority FROM scan_jobs
+                                                WHERE kind=? AND status='pending'
+                                                ORDER BY allowed_to_dm DESC, priority DESC LIMIT ?)
+                                 UNION ALL
+                                 SELECT * FROM (SELECT user_id, screen_name, allowed_to_dm, priority FROM scan_jobs
+                                                WHERE kind=? AND status='leased' AND lease_expires_at<?
+                                                ORDER BY allowed_to_dm DESC, priority DESC LIMIT ?)
+                             )
+                             ORDER BY allowed_to_dm DESC, priority DESC LIMIT ?"""
+
+LEASE_SCAN_JOB = """UPDATE scan_jobs SET status='leased', lease_owner=?, lease_expires_at=?, attempts=attempts+1
+                    WHERE kind=? AND user_id=?"""
+
+RENEW_SCAN_JOB_LEASE = """UPDATE scan_jobs SET lease_expires_at=?
+                          WHERE kind=? AND user_id=? AND status='leased' AND lease_owner=?"""
+
+FINISH_SCAN_JOB = """UPDATE scan_jobs
+                     SET status=CASE WHEN ? THEN 'done' WHEN attempts>=? THEN 'failed' ELSE 'pending' END,
+                         lease_owner=NULL, lease_expires_at=NULL, finished_at=?
+                     WHERE kind=? AND user_id=? AND status='leased' AND lease_owner=?"""
+
+COUNT_SCAN_JOBS_BY_STATUS = "SELECT status, Count(*) FROM scan_jobs WHERE kind=? GROUP BY status"
+
+# Shards: rows of the tables of processed tweets saved in DB_FILE before sharding
+COUNT_PROCESSED_TWEETS_TO_SHARD = """SELECT (SELECT Count(*) FROM processed_tweets_alt_text_info)
+                                            + (SELECT Count(*) FROM processed_tweets)"""
+
+# the user of tweets without images is not known (NULL)
+GET_ALL_PROCESSED_TWEETS_WITH_USER = """SELECT processed_tweets.tweet_id, user_id
+                                        FROM processed_tweets LEFT JOIN processed_tweets_alt_text_info
+                                             ON processed_tweets.tweet_id=processed_tweets_alt_text_info.tweet_id"""
+
+GET_ALL_TWEET_MEDIA_WITH_USER = """SELECT tweet_media.tweet_id, position, tweet_media.media_key, user_id,
+                                          url, media_index.user_alt_text, media_index.bot_alt_text, first_tweet_id,
+                                          first_seen_at, n_seen
+                                   FROM tweet_media JOIN media_index ON tweet_media.media_key=media_index.media_key
+                                        LEFT JOIN processed_tweets_alt_text_info
+                                        ON tweet_media.tweet_id=processed_tweets_alt_text_info.tweet_id"""
+
+COPY_MEDIA = """
+INSERT OR IGNORE INTO media_index (media_key, url, user_alt_text, bot_alt_text, first_tweet_id, first_seen_at, n_seen)
+      VALUES (?, ?, ?, ?, ?, ?, ?);
+"""
+
+DELETE_ALL_PROCESSED_TWEETS = "DELETE FROM processed_tweets"
+
+DELETE_ALL_TWEET_MEDIA = "DELETE FROM tweet_media"
+
+DELETE_ALL_MEDIA_INDEX = "DELETE FROM media_index"
+
+GET_ALL_PROCESSED_TWEETS_ALT_TEXT_INFO = """SELECT tweet_id, screen_name, user_id, n_images, alt_score, processed_at,
+                                                   friend, follower,
+                                                   user_alt_text_1, user_alt_text_2, user_alt_text_3, user_alt_text_4,
+                                                   bot_alt_text_1, bot_alt_text_2, bot_alt_text_3, bot_alt_text_4
+                                            FROM processed_tweets_alt_text_info ORDER BY rowid"""
+
+SAVE_TWEET_ALT_TEXT_INFO_NO_FAIL = SAVE_TWEET_ALT_TEXT_INFO.replace('INSERT INTO', 'INSERT OR IGNORE INTO')
+
+DELETE_ALL_PROCESSED_TWEETS_ALT_TEXT_INFO = "DELETE FROM processed_tweets_alt_text_info"
+
+CREATE_ACCOUNT_SCHEDULE_TABLE = """
+ CREATE TABLE IF NOT EXISTS account_schedule (
+                                        user_id INT PRIMARY KEY,
+                                        image_rate REAL,
+                                        scan_interval REAL,
+                                        last_scan_at REAL NULL,
+                                        next_due_at REAL
+                                    );
+"""
+
+SAVE_ACCOUNT_SCHEDULE = """
+INSERT OR REPLACE INTO account_schedule (user_id, image_rate, scan_interval, last_scan_at, next_due_at)
+      VALUES (?, ?, ?, ?, ?);
+"""
+
+GET_ACCOUNT_SCHEDULES = "SELECT user_id, image_rate, scan_interval, last_scan_at, next_due_at FROM account_schedule"
+
+GET_IMAGE_TWEETS_BY_USER = """SELECT user_id, Count(*) FROM processed_tweets_alt_text_info
+                              WHERE processed_at>=? GROUP BY user_id"""
+
+GET_ACCOUNT_SCHEDULE = """SELECT image_rate, scan_interval, last_scan_at, next_due_at FROM account_schedule
+                          WHERE user_id=?"""
+
+COUNT_IMAGE_TWEETS_FOR_USER = "SELECT Count(*) FROM processed_tweets_alt_text_info WHERE user_id=? AND processed_at>=?"
+
+RELEASE_SCAN_JOB = """UPDATE scan_jobs SET status='pending', lease_owner=NULL, lease_expires_at=NULL, attempts=attempts-1
+                      WHERE kind=? AND user_id=? AND status='leased' AND lease_owner=?"""
+
+# Users read so far by paginated fetches (followers, friends, retweeters), to resume them after a crash
+CREATE_SYNC_STAGING_TABLE = """
+ CREATE TABLE IF NOT EXISTS sync_staging (
+                                        sync_key TEXT,
+                                        user_id INT,
+                                        screen_name TEXT NULL,
+                                        PRIMARY KEY (sync_key, user_id)
+                                    );
+"""
+
+ADD_SYNC_STAGING_USER = "INSERT OR IGNORE INTO sync_staging (sync_key, user_id, screen_name) VALUES (?, ?, ?);"
+
+GET_SYNC_STAGING_USERS = "SELECT screen_name, user_id FROM sync_staging WHERE sync_key=?"
+
+DELETE_SYNC_STAGING_USERS = "DELETE FROM sync_staging WHERE sync_key=?"
+
+EXPIRE_SCAN_JOB_LEASES_OF_OWNER = """UPDATE scan_jobs SET lease_expires_at=0
+                                     WHERE kind=? AND status='leased' AND lease_owner=?"""
+
+GET_SCAN_JOB_LEASE_OWNERS = "SELECT DISTINCT lease_owner FROM scan_jobs WHERE kind=? AND status='leased'"
+
+# Accounts and tweets that can not be read, until expires_at
+CREATE_NEGATIVE_CACHE_TABLE = """
+ CREATE TABLE IF NOT EXISTS negative_cache (
+                                        target_type TEXT,
+                                        target_id TEXT,
+                                        error_code INTEGER,
+                                        expires_at REAL,
+                                        PRIMARY KEY (target_type, target_id)
+                                    );
+"""
+
+ADD_NEGATIVE_CACHE = """
+INSERT OR REPLACE INTO negative_cache (target_type, target_id, error_code, expires_at) VALUES (?, ?, ?, ?);
+"""
+
+GET_NEGATIVE_CACHE = "SELECT error_code FROM negative_cache WHERE target_type=? AND target_id=? AND expires_at>?"
+
+PURGE_NEGATIVE_CACHE = "DELETE FROM negative_cache WHERE expires_at<=?"
+
+CREATE_RUN_HISTORY_TABLE = """
+ CREATE TABLE IF NOT EXISTS run_history (
+                                        started_at TEXT,
+                                        worker_id TEXT,
+                                        summary TEXT
+                                    );
+"""
+
+CREATE_INDEX_FOR_RUN_HISTORY_STARTED_AT = """
+CREATE INDEX IF NOT EXISTS run_history_started_at_index ON run_history(started_at);
+"""
+
+SAVE_RUN_SUMMARY = "INSERT INTO run_history (started_at, worker_id, summary) VALUES (?, ?, ?);"
+
+GET_RUN_HISTORY = "SELECT summary FROM run_history WHERE started_at>=? ORDER BY started_at"
@@ -0,0 +1,103 @@
+"""
+Logging of the bot off the hot path, from a queue, with sampling of DEBUG records per logger.
+"""
+import atexit
+import gzip
+import logging
+import os
+import queue
+import random
+import shutil
+from logging.handlers import QueueHandler, QueueListener, TimedRotatingFileHandler
+from typing import Dict, Optional
+
+from settings import LOG_FILENAME, LOG_LEVEL, LOG_FORMAT, LOG_DATE_FORMAT, LOG_SAMPLING, LOG_COMPRESS_ROTATED, \
+    LOG_BACKUP_DAYS
+
+# categories of the hot paths; the logger name is the category
+SCAN_LOG = 'scan'
+TWEETS_LOG = 'tweets'
+DMS_LOG = 'dms'
+
+
+class OneLine:
+    """
+    Text logged in a single line: newlines are replaced only if the record is written
+    """
+
+    __slots__ = ('text',)
+
+    def __init__(self, text: str):
+        self.text = text
+
+    def __str__(self) -> str:
+        return self.text.replace('\n', ';')
+
+
+class SamplingFilter(logging.Filter):
+
+    def __init__(self, rates: Dict[str, float]):
+        """
+        Keep only a random fraction of the DEBUG records of some loggers
+        :param rates: dict from logger name to fraction of its DEBUG records to keep, in [0, 1]
+        """
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > logging.DEBUG:
+            return True
+        rate = self.rates.get(record.name)
+        return rate is None or random.random() < rate
+
+
+class DeferredQueueHandler(QueueHandler):
+    """
+    QueueHandler formatting the records in the writer thread instead of in the logging one, when their arguments can
+    not change in the meantime
+    """
+
+    immutable_types = (str, int, float, bool, type(None), OneLine)
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        args = record.args.values() if isinstance(record.args, dict) else record.args or ()
+        if all(isinstance(arg, self.immutable_types) for arg in args):
+            return record
+        # e.g. lists or dicts, which could be modified before the writer thread gets to them
+        return super().prepare(record)
+
+
+def gzip_rotator(source: str, dest: str) -> None:
+    with open(source, 'rb') as f_in, gzip.open(dest, 'wb') as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(source)
+
+
+def setup_logging(log_file: str = LOG_FILENAME, level: int = LOG_LEVEL,
+                  sampling: Optional[Dict[str, float]] = None, compress: bool = LOG_COMPRESS_ROTATED) -> QueueListener:
+    """
+    Send the logs of the process to log_file, rotated daily, through a writer thread
+    :param log_file: file to log to
+    :param level: level of the root logger
+    :param sampling: dict from logger name to fraction of its DEBUG records to keep; LOG_SAMPLING by default
+    :param compress: gzip the rotated files
+    :return: the listener writing the records; it is stopped, flushing the queue, when the process exits
+    """
+    file_handler = TimedRotatingFileHandler(log_file, when='D', backupCount=LOG_BACKUP_DAYS)
+    file_handler.setFormatter(logging.Formatter(LOG_FORMAT, datefmt=LOG_DATE_FORMAT))
+    if compress:
+        file_handler.namer = lambda name: f'{name}.gz'
+        file_handler.rotator = gzip_rotator
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = DeferredQueueHandler(log_queue)
+    # records formatted in advance only get their message merged; the file handler adds date, level and logger
+    queue_handler.setFormatter(logging.Formatter('%(message)s'))
+    queue_handler.addFilter(SamplingFilter(sampling if sampling is not None else LOG_SAMPLING))
+
+    logging.basicConfig(level=level, handlers=[queue_handler])
+
+    listener = QueueListener(log_queue, file_handler)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
@@ -0,0 +1,114 @@
+"""
+Profiling of a run of the bot (--profile, --profile-memory), written next to LOG_FILENAME.
+"""
+import logging
+import os
+import time
+from datetime import datetime
+from typing import Optional
+
+from settings import LOG_FILENAME, PROFILE_TOP_N, PROFILE_SAMPLING, PROFILE_TRACEMALLOC_FRAMES
+
+
+class Profiler:
+
+    def __init__(self, memory: bool = False, output_dir: Optional[str] = None, top_n: int = PROFILE_TOP_N,
+                 sampling: bool = PROFILE_SAMPLING):
+        """
+        Profile the code in a with block
+        :param memory: also trace memory allocations with tracemalloc, which slows the run down noticeably
+        :param output_dir: where to write the reports; next to LOG_FILENAME by default
+        :param top_n: number of functions and allocation sites in the text reports
+        :param sampling: use pyinstrument if installed, cProfile otherwise
+        """
+        self.memory = memory
+        self.top_n = top_n
+        self.sampling = sampling
+        output_dir = output_dir if output_dir is not None else os.path.dirname(LOG_FILENAME)
+        self.path = os.path.join(output_dir, f'profile-{datetime.now().strftime("%y%m%d-%H%M%S")}')
+        self.profiler = None
+        self.begin = None  # type: Optional[float]
+
+    def __enter__(self) -> 'Profiler':
+        if self.memory:
+            import tracemalloc
+            tracemalloc.start(PROFILE_TRACEMALLOC_FRAMES)
+
+        if self.sampling:
+            try:
+                import pyinstrument
+                self.profiler = pyinstrument.Profiler()
+            except ImportError:
+                logging.info('pyinstrument not installed, profiling with cProfile')
+
+        if self.profiler is None:
+            import cProfile
+            self.profiler = cProfile.Profile()
+
+        self.begin = time.time()
+        if hasattr(self.profiler, 'enable'):
+            self.profiler.enable()
+        else:
+            self.profiler.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        if hasattr(self.profiler, 'disable'):
+            self.profiler.disable()
+        else:
+            self.profiler.stop()
+        logging.info(f'Profiled {time.time() - self.begin:.1f} s')
+
+        try:
+            self.write_cpu_reports()
+            if self.memory:
+                self.write_memory_report()
+        except Exception as e:
+            # never hide the result of the run
+            logging.error(f'Can not write profile to {self.path}: {e}', exc_info=True)
+
+    def write_cpu_reports(self) -> None:
+        if hasattr(self.profiler, 'dump_stats'):
+            import pstats
+
+            self.profiler.dump_stats(f'{self.path}.prof')
+            with open(f'{self.path}.txt', 'w') as f:
+                pstats.Stats(self.profiler, stream=f).sort_stats('cumulative').print_stats(self.top_n)
+            logging.info(f'cProfile stats written to {self.path}.prof and {self.path}.txt')
+            return
+
+        with open(f'{self.path}.html', 'w') as f:
+            f.write(self.profiler.output_html())
+        with open(f'{self.path}.txt', 'w') as f:
+            f.write(self.profiler.output_text())
+        try:
+            from pyinstrument.renderers import SpeedscopeRenderer
+            with open(f'{self.path}.speedscope.json', 'w') as f:
+                f.write(self.profiler.output(SpeedscopeRenderer()))
+        except ImportError:
+            # older pyinstrument versions
+            pass
+        logging.info(f'pyinstrument profile written to {self.path}.html and {self.path}.txt')
+
+    def write_memory_report(self) -> None:
+        import tracemalloc
+
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        ])
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        with open(f'{self.path}-memory.txt', 'w') as f:
+            f.write(f'Traced memory: {current / 2 ** 20:.1f} MiB at the end, {peak / 2 ** 20:.1f} MiB peak\n\n')
+            f.write(f'Top {self.top_n} lines by memory still allocated:\n')
+            for stat in snapshot.statistics('lineno')[:self.top_n]:
+                f.write(f'{stat}\n')
+
+            f.write('\nTracebacks of the top 3:\n')
+            for stat in snapshot.statistics('traceback')[:3]:
+                f.write(f'\n{stat.size / 2 ** 10:.1f} KiB in {stat.count} blocks\n')
+                f.write('\n'.join(stat.traceback.format()) + '\n')
+
+        logging.info(f'Memory allocations written to {self.path}-memory.txt')
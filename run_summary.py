@@ -0,0 +1,77 @@
+import json
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, Optional
+
+from api_access_layer.api_metrics import ApiMetrics
+
+# phases of a run, in the order they run
+PHASES = ['followers_sync', 'allowed_to_dm_sync', 'friends_sync', 'followers_scan', 'friends_scan', 'mentions',
+          'broadcast', 'report', 'backfill']
+
+# things counted along a run
+COUNTERS = ['accounts_scanned', 'tweets_fetched', 'tweets_already_processed', 'image_tweets', 'images', 'favs', 'dms',
+            'replies', 'tweets']
+
+
+class RunSummary:
+    """
+    Seconds spent in each phase of a run and counts of what was done, saved as one JSON document per run in the
+    run_history table, e.g. to follow the cost per account over time:
+        SELECT started_at, json_extract(summary, '$.phases.followers_scan') /
+                           json_extract(summary, '$.counters.accounts_scanned') FROM run_history
+    """
+
+    def __init__(self, worker_id: str):
+        """
+        :param worker_id: process doing the run
+        """
+        self.worker_id = worker_id
+        self.started_at = datetime.now()
+        self.begin = time.time()
+        self.phases = {}  # type: Dict[str, float]
+        self.counters = {counter: 0 for counter in COUNTERS}  # type: Dict[str, int]
+        # counters are increased from the broadcast threads too
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name: str):
+        """
+        Time the code in the with block as part of the phase
+        :param name: one of PHASES
+        """
+        begin = time.time()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.phases[name] = self.phases.get(name, 0.) + time.time() - begin
+
+    def count(self, counter: str, n: int = 1) -> None:
+        """
+        :param counter: one of COUNTERS
+        :param n: amount to add
+        :return: None
+        """
+        with self.lock:
+            self.counters[counter] += n
+
+    def to_json(self, api_metrics: ApiMetrics, error: Optional[str] = None) -> str:
+        """
+        :param api_metrics: metrics of the API calls of the run
+        :param error: error that stopped the run, if any
+        :return: the summary of the run as a JSON document
+        """
+        api = api_metrics.snapshot()
+        with self.lock:
+            return json.dumps(dict(
+                worker_id=self.worker_id, started_at=self.started_at.strftime("%Y-%m-%d %H:%M:%S"),
+                seconds=time.time() - self.begin, error=error,
+                phases={name: self.phases[name] for name in PHASES if name in self.phases},
+                counters=dict(self.counters),
+                api_calls={endpoint: metrics['calls'] for endpoint, metrics in api.items()},
+                api_errors={endpoint: metrics['errors'] for endpoint, metrics in api.items() if metrics['errors']},
+                api_circuits={group: circuit for group, circuit in api_metrics.circuits_snapshot().items()
+                              if circuit['opens']}))
@@ -1,4 +1,5 @@
 import logging
+import os
 
 # Tweeter credentials must be obtained from tweeter;
 # checkout this: https://realpython.com/twitter-bot-python-tweepy/#creating-twitter-api-authentication-credentials
@@ -21,6 +22,14 @@ LAST_N_MENTIONS = 100
 
 LOG_LEVEL = logging.DEBUG
 LOG_FILENAME = 'log/alt-bot.log'
+LOG_FORMAT = '%(asctime)s %(name)-12s %(levelname)-8s %(message)s'
+LOG_DATE_FORMAT = '%y-%m-%d %H:%M:%S'
+# days of rotated log files to keep, gzipped if LOG_COMPRESS_ROTATED
+LOG_BACKUP_DAYS = 7
+LOG_COMPRESS_ROTATED = False
+# fraction of the DEBUG records kept per category of the hot paths ('scan', 'tweets', 'dms'), e.g. {'scan': 0.1};
+# categories not listed keep everything
+LOG_SAMPLING = {}
 
 DB_FILE = 'data_access_layer/.alt_bot_data.db'
 
@@ -35,3 +44,136 @@ ACCEPT_DM_TWEET_ID = 1385971762819706888
 INIT_SYSTEM_DATE = '2021-01-01'
 
 MAX_CHARS_IN_TWEET = 280
+
+# Broadcast messages to followers (-m use case): a broadcast sends at most DM_QUOTA_PER_DAY messages in the last 24 hs,
+# counting the DMs of previous broadcasts only; leave room in it for the DMs sent by the scans (AUTO_DM_NO_ALT_TEXT)
+DM_QUOTA_PER_DAY = 1000
+BROADCAST_WORKERS = 4
+# pace of the broadcast DMs, shared by the BROADCAST_WORKERS threads: a burst of DMs looks like spam to twitter
+BROADCAST_DMS_PER_MINUTE = 10
+BROADCAST_BURST = BROADCAST_WORKERS
+BROADCAST_MAX_ATTEMPTS = 3
+
+# Image captioning: suggest alt texts for images without them. The model runs locally on CPU, see captioning module
+CAPTIONING_ENABLED = False
+# quantized ONNX (.onnx) or TorchScript (.pt) model, taking pixel_values and returning generated token ids
+CAPTION_MODEL_FILE = 'captioning/models/caption_model_int8.onnx'
+# one token per line, the line number is the token id
+CAPTION_VOCAB_FILE = 'captioning/models/vocab.txt'
+CAPTION_IMAGE_SIZE = 224
+CAPTION_BATCH_SIZE = 8
+CAPTION_PREPROCESS_WORKERS = 2
+CAPTION_INFERENCE_THREADS = 2
+
+# OCR for text-heavy images (screenshots, flyers), needs tesseract installed with the OCR_LANG languages
+OCR_ENABLED = False
+OCR_LANG = 'spa+eng'
+OCR_MAX_WORKERS = 1
+OCR_MAX_CONCURRENT = 2
+OCR_TIMEOUT = 20
+OCR_MIN_CHARS = 20
+OCR_EDGE_DENSITY_THRESHOLD = 0.04
+OCR_FLAT_BACKGROUND_THRESHOLD = 0.5
+OCR_MIN_IMAGE_SIZE = 1200
+
+# Download of images to be captioned
+MEDIA_DOWNLOAD_TIMEOUT = 10
+MEDIA_DOWNLOAD_CONCURRENCY = 8
+# images bigger than this are streamed to a temporary file in MEDIA_TMP_DIR (None for the system default)
+MEDIA_MAX_IN_MEMORY_BYTES = 512 * 1024
+MEDIA_MAX_BYTES = 16 * 1024 * 1024
+MEDIA_TMP_DIR = None
+
+# Cache of suggested alt texts, by image url and perceptual hash, so repeated images are not captioned again
+CAPTION_CACHE_DB_FILE = 'data_access_layer/.caption_cache.db'
+CAPTION_CACHE_MAX_BYTES = 64 * 1024 * 1024
+# images whose hashes differ in at most this number of bits are considered the same; must be < 4
+CAPTION_CACHE_MAX_HAMMING_DISTANCE = 3
+
+# Caption worker (python -m captioning.caption_worker): set the socket to let the bot ask the worker for suggestions
+# instead of loading the models in its own process
+CAPTION_WORKER_SOCKET = None  # for instance '/tmp/altbot-caption-worker.sock'
+CAPTION_WORKER_MAX_BATCH = 16
+CAPTION_WORKER_MAX_WAIT = 0.2
+CAPTION_WORKER_MAX_QUEUE = 32
+CAPTION_WORKER_TIMEOUT = 120
+CAPTION_WORKER_MAX_RETRIES = 5
+
+# Backfill of bot alt texts for processed tweets (--backfill-captions): the scans save tweets without suggestions, run
+# it periodically (e.g. with --cpu-budget 0.5) to caption them
+BACKFILL_CHUNK_SIZE = 500
+BACKFILL_CAPTIONS_CHECKPOINT_KEY = 'backfill_captions_last_row'
+
+# Extra read-only app tokens, as (CONSUMER_KEY, CONSUMER_SECRET, KEY, SECRET), to spread read calls
+# (timelines, tweets lookup) and scale scans. Define them in settings_prod, never commit them
+READ_ONLY_TOKENS = []
+
+# Scan jobs: accounts to scan are queued in the DB, so several worker processes (--worker) can share the work
+DB_BUSY_TIMEOUT = 30
+SCAN_JOB_LEASE_SECONDS = 600
+SCAN_JOB_CLAIM_SIZE = 5
+SCAN_JOB_MAX_ATTEMPTS = 3
+
+# The tables of processed tweets (processed_tweets, processed_tweets_alt_text_info, tweet_media and media_index) are
+# split by the user id of the author in this number of files next to DB_FILE (DB_FILE itself when 1), so workers saving
+# tweets of different users do not wait for each other. Rows saved in DB_FILE before sharding are moved to the shards
+# on start, SHARD_MIGRATION_CHUNK_SIZE at a time; do not change the number once there is data in the shards
+DB_SHARDS = 1
+SHARD_MIGRATION_CHUNK_SIZE = 10000
+
+# Adaptive scan schedule: each account is scanned again once, at its learnt rate of image tweets, about
+# SCHEDULE_TARGET_IMAGE_TWEETS new ones are expected. Accounts without new images wait SCHEDULE_BACKOFF_FACTOR times
+# longer each time; intervals are kept between the floor and the ceiling (seconds)
+SCHEDULE_MIN_INTERVAL = 60 * 60
+SCHEDULE_MAX_INTERVAL = 30 * 24 * 60 * 60
+SCHEDULE_BACKOFF_FACTOR = 2.
+SCHEDULE_TARGET_IMAGE_TWEETS = 1.
+# weight of the last scan in the image tweets rate (exponentially weighted moving average)
+SCHEDULE_RATE_SMOOTHING = 0.3
+# days of processed tweets used to estimate the rate of accounts without schedule yet
+SCHEDULE_HISTORY_DAYS = 90
+
+# Negative cache: accounts and tweets that failed with these errors are not requested again for the given seconds.
+# Keys are twitter error codes about the account or tweet; never bare HTTP statuses, a 401 may be an invalid token
+NEGATIVE_CACHE_TTL = {
+    179: 7 * 24 * 60 * 60,  # not allowed to see the tweet, e.g. protected account
+    63: 30 * 24 * 60 * 60,  # user suspended
+    50: 30 * 24 * 60 * 60,  # user not found
+    144: 30 * 24 * 60 * 60,  # no status found, e.g. deleted tweet
+    34: 30 * 24 * 60 * 60,  # page does not exist, e.g. deleted account
+}
+
+# Twitter API server. To run the bot offline against the local stand-in (python -m simulation.fake_twitter_api), set
+# them in the environment: tweepy always uses https, so the CA bundle must trust the certificate of the stand-in
+TWITTER_API_HOST = os.environ.get('TWITTER_API_HOST', 'api.twitter.com')
+TWITTER_API_CA_BUNDLE = os.environ.get('TWITTER_API_CA_BUNDLE')
+
+# Metrics of the calls to the API, per endpoint, written at the end of each run. Set the port to also serve them live
+# on localhost (/metrics for Prometheus, /metrics.json), or use --metrics-port
+API_LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10., 30.)
+API_METRICS_PROMETHEUS_FILE = 'log/api-metrics.prom'
+API_METRICS_JSON_FILE = 'log/api-metrics.json'
+API_METRICS_PORT = None
+
+# Profiling of a run (--profile), written next to LOG_FILENAME. The sampling profiler (pyinstrument) is used if
+# installed, cProfile otherwise
+PROFILE_SAMPLING = True
+PROFILE_TOP_N = 40
+# frames kept for each allocation with --profile-memory; more frames give better tracebacks but slow the run more
+PROFILE_TRACEMALLOC_FRAMES = 10
+
+# HTTP connections to the API: calls from all threads share a pool of API_POOL_SIZE keep-alive connections per host
+# (0 opens a new connection for each call), ask for gzipped responses and give up after the timeouts (seconds)
+API_POOL_SIZE = 8
+API_COMPRESSION = True
+API_CONNECT_TIMEOUT = 10
+API_READ_TIMEOUT = 60
+
+# Circuit breakers per group of endpoints: after CIRCUIT_FAILURE_THRESHOLD consecutive outage errors (no response,
+# 5xx) the calls of the group are paused, first for about CIRCUIT_BASE_DELAY seconds, doubling up to CIRCUIT_MAX_DELAY
+# while the API stays down; calls give up after waiting CIRCUIT_MAX_PAUSE seconds. The backoff also paces the
+# MAX_RECONNECTION_ATTEMPTS to connect
+CIRCUIT_FAILURE_THRESHOLD = 5
+CIRCUIT_BASE_DELAY = 5
+CIRCUIT_MAX_DELAY = 5 * 60
+CIRCUIT_MAX_PAUSE = 30 * 60
@@ -0,0 +1,666 @@
+"""
+Local stand-in for the Twitter v1.1 API, to run the bot offline: load tests, integration tests and benchmarks without
+spending real quota.
+
+It serves the endpoints the bot uses, with synthetic accounts, timelines, images (with or without alt_text) and
+mentions generated from a seed, so every run sees the same data. Each response takes a configurable latency and
+carries x-rate-limit-* headers; quotas are counted per token (oauth_token) and endpoint, as Twitter does, and
+exhausted quotas are answered with error 88.
+
+tweepy always talks https, so the server uses TLS with a self-signed certificate for localhost, generated with the
+openssl command line if none is given. Run it with:
+    python -m simulation.fake_twitter_api --port 8443 --followers 1000 --latency 0.05
+
+and point the bot to it, in settings or in the environment:
+    export TWITTER_API_HOST=localhost:8443
+    export TWITTER_API_CA_BUNDLE=<certificate printed by the server>
+
+GET /fake/stats.json returns the number of requests served per endpoint, rate limited requests, writes (favs,
+tweets, DMs, follows) and TLS handshakes, i.e. new connections. Responses are gzipped if the client accepts it.
+POST /fake/outage.json?seconds=60 makes every other endpoint answer 503 (over capacity) for that long.
+"""
+import argparse
+import gzip
+import json
+import logging
+import os
+import random
+import re
+import socket
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple, Union
+from urllib.parse import urlparse, parse_qsl
+
+from settings import ALT_BOT_NAME, ACCEPT_DM_TWEET_ID, LOG_LEVEL
+
+API_ROOT = '/1.1'
+
+BOT_USER_ID = 1
+# users are numbered from here; tweets of a user have ids user_id * TWEETS_PER_USER_ID + k
+FIRST_USER_ID = 1000
+TWEETS_PER_USER_ID = 10 ** 6
+# mentions must be newer than the last mention the bot knows, see DBAccess.last_mention_value_setting
+FIRST_MENTION_ID = 2 * 10 ** 18
+
+# requests per 15 minutes window and token, as documented by Twitter
+RATE_LIMITS = {
+    '/statuses/user_timeline.json': 900,
+    '/statuses/show.json': 900,
+    '/statuses/lookup.json': 900,
+    '/statuses/mentions_timeline.json': 75,
+    '/statuses/retweeters/ids.json': 75,
+    '/followers/list.json': 15,
+    '/followers/ids.json': 15,
+    '/friends/list.json': 15,
+    '/friends/ids.json': 15,
+    '/users/lookup.json': 900,
+    '/account/verify_credentials.json': 75,
+}
+
+# max page size of each paginated endpoint
+PAGE_SIZES = {
+    '/followers/list.json': 200,
+    '/friends/list.json': 200,
+    '/followers/ids.json': 5000,
+    '/friends/ids.json': 5000,
+    '/statuses/retweeters/ids.json': 100,
+}
+
+WORDS = ['alt', 'text', 'imagen', 'foto', 'hoy', 'montevideo', 'playa', 'gato', 'perro', 'mate', 'sol', 'lluvia',
+         'partido', 'concierto', 'libro', 'café', 'atardecer', 'rambla', 'amigos', 'familia']
+
+
+class ApiError(Exception):
+
+    def __init__(self, status: int, code: Optional[int], message: str):
+        super().__init__(message)
+        self.status = status
+        self.code = code
+        self.message = message
+
+    def to_json(self) -> dict:
+        if self.code is None:
+            return dict(error=self.message)
+        return dict(errors=[dict(code=self.code, message=self.message)])
+
+
+def without_entities(payload: Union[dict, list]) -> Union[dict, list]:
+    """
+    The tweets in the payload as returned with include_entities=false
+    """
+    if isinstance(payload, list):
+        return [without_entities(tweet) for tweet in payload]
+    return {key: value for key, value in payload.items() if key not in ('entities', 'extended_entities')}
+
+
+def twitter_date(when: datetime) -> str:
+    return when.strftime('%a %b %d %H:%M:%S +0000 %Y')
+
+
+class FakeTwitterData:
+
+    def __init__(self, n_users: int = 2000, n_followers: int = 1000, n_friends: int = 500,
+                 n_allowed_to_dm: int = 200, tweets_per_user: int = 200, image_rate: float = 0.3,
+                 alt_text_rate: float = 0.4, protected_rate: float = 0.02, suspended_rate: float = 0.01,
+                 n_mentions: int = 50, seed: int = 0):
+        """
+        Synthetic twitter, generated on demand from the seed
+        :param n_users: number of accounts besides the bot
+        :param n_followers: the first n_followers accounts follow the bot
+        :param n_friends: the last n_friends accounts are followed by the bot
+        :param n_allowed_to_dm: the first n_allowed_to_dm followers retweeted ACCEPT_DM_TWEET_ID
+        :param tweets_per_user: length of each timeline
+        :param image_rate: portion of tweets with images
+        :param alt_text_rate: portion of images with alt_text
+        :param protected_rate: portion of protected accounts (timeline not readable)
+        :param suspended_rate: portion of suspended accounts
+        :param n_mentions: number of tweets mentioning the bot
+        :param seed: seed of the generators
+        """
+        self.n_users = n_users
+        self.n_followers = min(n_followers, n_users)
+        self.n_friends = min(n_friends, n_users)
+        self.n_allowed_to_dm = min(n_allowed_to_dm, self.n_followers)
+        self.tweets_per_user = min(tweets_per_user, TWEETS_PER_USER_ID - 1)
+        self.image_rate = image_rate
+        self.alt_text_rate = alt_text_rate
+        self.protected_rate = protected_rate
+        self.suspended_rate = suspended_rate
+        self.seed = seed
+        # tweets are one hour apart, the newest one an hour ago
+        self.now = datetime.utcnow()
+
+        self.user_ids = list(range(FIRST_USER_ID, FIRST_USER_ID + n_users))
+        self.follower_ids = self.user_ids[:self.n_followers]
+        self.friend_ids = self.user_ids[n_users - self.n_friends:]
+
+        # tweets written by the bot through the API
+        self.bot_tweets = {}  # type: Dict[int, dict]
+        self.next_bot_tweet_id = FIRST_MENTION_ID - 10 ** 9
+        self.lock = threading.Lock()
+
+        self.mentions = self.generate_mentions(n_mentions)
+
+    def rng(self, *key) -> random.Random:
+        return random.Random('-'.join(str(k) for k in (self.seed,) + key))
+
+    def user_exists(self, user_id: int) -> bool:
+        return user_id == BOT_USER_ID or FIRST_USER_ID <= user_id < FIRST_USER_ID + self.n_users
+
+    def user_state(self, user_id: int) -> str:
+        """
+        :return: 'protected', 'suspended' or 'public'
+        """
+        if user_id == BOT_USER_ID:
+            return 'public'
+        draw = self.rng('state', user_id).random()
+        if draw < self.suspended_rate:
+            return 'suspended'
+        if draw < self.suspended_rate + self.protected_rate:
+            return 'protected'
+        return 'public'
+
+    def user_id_from(self, params: Dict[str, str]) -> int:
+        if 'user_id' in params:
+            user_id = int(params['user_id'])
+        elif 'screen_name' in params or 'id' in params:
+            screen_name = params.get('screen_name', params.get('id'))
+            if screen_name.lower() == ALT_BOT_NAME.lower():
+                user_id = BOT_USER_ID
+            elif re.fullmatch(r'user\d+', screen_name):
+                user_id = int(screen_name[4:])
+            elif screen_name.isdigit():
+                user_id = int(screen_name)
+            else:
+                user_id = -1
+        else:
+            raise ApiError(400, 38, 'screen_name or user_id parameter is missing.')
+
+        if not self.user_exists(user_id):
+            raise ApiError(404, 50, 'User not found.')
+        return user_id
+
+    def user(self, user_id: int) -> dict:
+        if user_id == BOT_USER_ID:
+            screen_name = ALT_BOT_NAME
+            followers_count, friends_count = self.n_followers, self.n_friends
+        else:
+            screen_name = f'user{user_id}'
+            rng = self.rng('user', user_id)
+            followers_count, friends_count = rng.randint(0, 5000), rng.randint(0, 2000)
+
+        return dict(id=user_id, id_str=str(user_id), screen_name=screen_name, name=screen_name.capitalize(),
+                    protected=self.user_state(user_id) == 'protected', followers_count=followers_count,
+                    friends_count=friends_count, statuses_count=self.tweets_per_user,
+                    created_at=twitter_date(self.now - timedelta(days=1000)), verified=False, lang=None)
+
+    def text(self, rng: random.Random, n_words: int = 8) -> str:
+        return ' '.join(rng.choice(WORDS) for _ in range(n_words))
+
+    def status(self, tweet_id: int, trim_user: bool = False) -> dict:
+        """
+        The tweet with the given id, as returned with tweet_mode=extended and include_ext_alt_text=true
+        """
+        if tweet_id in self.mentions:
+            status = dict(self.mentions[tweet_id])
+        elif tweet_id in self.bot_tweets:
+            status = dict(self.bot_tweets[tweet_id])
+        elif tweet_id == ACCEPT_DM_TWEET_ID:
+            status = self.base_status(tweet_id, BOT_USER_ID, 'RT para recibir DMs', self.now - timedelta(days=300))
+            status['retweet_count'] = self.n_allowed_to_dm
+        else:
+            user_id, k = divmod(tweet_id, TWEETS_PER_USER_ID)
+            if not self.user_exists(user_id) or user_id == BOT_USER_ID or not 0 < k <= self.tweets_per_user:
+                raise ApiError(404, 144, 'No status found with that ID.')
+            if self.user_state(user_id) == 'suspended':
+                raise ApiError(403, 63, 'User has been suspended.')
+            if self.user_state(user_id) == 'protected':
+                raise ApiError(403, 179, 'Sorry, you are not authorized to see this status.')
+
+            rng = self.rng('tweet', tweet_id)
+            status = self.base_status(tweet_id, user_id, self.text(rng),
+                                      self.now - timedelta(hours=self.tweets_per_user - k + 1))
+            if rng.random() < self.image_rate:
+                media = []
+                for j in range(rng.randint(1, 4)):
+                    media_id = tweet_id * 10 + j
+                    media.append(dict(id=media_id, id_str=str(media_id), type='photo',
+                                      media_url_https=f'https://pbs.twimg.com/media/fake{media_id}.jpg',
+                                      ext_alt_text=self.text(rng, 12) if rng.random() < self.alt_text_rate else None,
+                                      sizes=dict(small=dict(w=680, h=510, resize='fit'))))
+                status['entities']['media'] = media[:1]
+                status['extended_entities'] = dict(media=media)
+
+        if trim_user:
+            status['user'] = dict(id=status['user']['id'], id_str=status['user']['id_str'])
+        return status
+
+    def base_status(self, tweet_id: int, user_id: int, text: str, created_at: datetime) -> dict:
+        return dict(id=tweet_id, id_str=str(tweet_id), created_at=twitter_date(created_at), full_text=text,
+                    text=text, truncated=False, display_text_range=[0, len(text)],
+                    entities=dict(hashtags=[], symbols=[], user_mentions=[], urls=[]),
+                    user=self.user(user_id), in_reply_to_status_id=None, in_reply_to_status_id_str=None,
+                    in_reply_to_user_id=None, in_reply_to_user_id_str=None, in_reply_to_screen_name=None,
+                    is_quote_status=False, retweet_count=0, favorite_count=0, favorited=False, retweeted=False,
+                    lang='es')
+
+    def user_mention(self, user_id: int) -> dict:
+        user = self.user(user_id)
+        return dict(screen_name=user['screen_name'], name=user['name'], id=user_id, id_str=str(user_id))
+
+    def generate_mentions(self, n_mentions: int) -> Dict[int, dict]:
+        """
+        Half of the mentions reply to a tweet of other user, the other half ask for a report of other users
+        """
+        rng = self.rng('mentions')
+        mentions = {}
+        for k in range(n_mentions):
+            tweet_id = FIRST_MENTION_ID + k
+            author_id = rng.choice(self.follower_ids or self.user_ids)
+            created_at = self.now - timedelta(minutes=n_mentions - k)
+
+            if k % 2 == 0:
+                other_id = rng.choice(self.user_ids)
+                text = f'@user{other_id} @{ALT_BOT_NAME}'
+                status = self.base_status(tweet_id, author_id, text, created_at)
+                replied_id = other_id * TWEETS_PER_USER_ID + rng.randint(1, self.tweets_per_user)
+                status.update(in_reply_to_status_id=replied_id, in_reply_to_status_id_str=str(replied_id),
+                              in_reply_to_user_id=other_id, in_reply_to_user_id_str=str(other_id),
+                              in_reply_to_screen_name=f'user{other_id}')
+                status['entities']['user_mentions'] = [self.user_mention(other_id), self.user_mention(BOT_USER_ID)]
+            else:
+                others = rng.sample(self.user_ids, min(3, len(self.user_ids)))
+                text = f'@{ALT_BOT_NAME} ' + ' '.join(f'@user{other_id}' for other_id in others)
+                status = self.base_status(tweet_id, author_id, text, created_at)
+                status['entities']['user_mentions'] = [self.user_mention(BOT_USER_ID)] + \
+                                                      [self.user_mention(other_id) for other_id in others]
+            mentions[tweet_id] = status
+
+        return mentions
+
+    def timeline(self, user_id: int, count: int, since_id: Optional[int], max_id: Optional[int],
+                 trim_user: bool) -> List[dict]:
+        state = self.user_state(user_id)
+        if state == 'suspended':
+            raise ApiError(401, None, 'Not authorized.')
+        if state == 'protected':
+            raise ApiError(401, None, 'Not authorized.')
+
+        result = []
+        for k in range(self.tweets_per_user, 0, -1):
+            tweet_id = user_id * TWEETS_PER_USER_ID + k
+            if max_id is not None and tweet_id > max_id:
+                continue
+            if since_id is not None and tweet_id <= since_id:
+                break
+            result.append(self.status(tweet_id, trim_user))
+            if len(result) >= count:
+                break
+        return result
+
+    def new_bot_tweet(self, text: str, in_reply_to: Optional[int]) -> dict:
+        with self.lock:
+            tweet_id = self.next_bot_tweet_id
+            self.next_bot_tweet_id += 1
+        status = self.base_status(tweet_id, BOT_USER_ID, text, datetime.utcnow())
+        if in_reply_to is not None:
+            status.update(in_reply_to_status_id=in_reply_to, in_reply_to_status_id_str=str(in_reply_to))
+        self.bot_tweets[tweet_id] = status
+        return status
+
+
+class RateLimiter:
+
+    def __init__(self, window: float = 15 * 60, scale: float = 1.):
+        """
+        Count requests per token and endpoint in fixed windows
+        :param window: seconds of the window
+        :param scale: factor applied to RATE_LIMITS, e.g. to make quotas run out sooner
+        """
+        self.window = window
+        self.scale = scale
+        # (token, endpoint) -> (used, reset epoch)
+        self.windows = {}  # type: Dict[Tuple[str, str], Tuple[int, float]]
+        self.lock = threading.Lock()
+
+    def hit(self, token: str, endpoint: str) -> Optional[Tuple[int, int, int]]:
+        """
+        Count a request
+        :return: (limit, remaining, reset epoch) for the headers, None for endpoints without limit;
+                 remaining is -1 if the request exceeds the quota
+        """
+        if endpoint not in RATE_LIMITS:
+            return None
+
+        limit = max(1, int(RATE_LIMITS[endpoint] * self.scale))
+        now = time.time()
+        with self.lock:
+            used, reset = self.windows.get((token, endpoint), (0, now + self.window))
+            if reset <= now:
+                used, reset = 0, now + self.window
+            used += 1
+            self.windows[(token, endpoint)] = (used, reset)
+
+        return limit, limit - used, int(reset)
+
+
+class FakeTwitterHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, fmt, *args) -> None:
+        logging.debug(fmt % args)
+
+    def do_GET(self) -> None:
+        self.handle_api('GET')
+
+    def do_POST(self) -> None:
+        self.handle_api('POST')
+
+    def token(self) -> str:
+        match = re.search(r'oauth_token="([^"]*)"', self.headers.get('Authorization', ''))
+        return match.group(1) if match else 'anonymous'
+
+    def handle_api(self, method: str) -> None:
+        server = self.server  # type: FakeTwitterServer
+        url = urlparse(self.path)
+        params = dict(parse_qsl(url.query))
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if body and self.headers.get('Content-Type', '').startswith('application/x-www-form-urlencoded'):
+            params.update(parse_qsl(body.decode('utf-8')))
+
+        endpoint = url.path[len(API_ROOT):] if url.path.startswith(API_ROOT) else url.path
+        server.count('requests', endpoint)
+
+        if server.latency > 0:
+            time.sleep(max(0., random.gauss(server.latency, server.latency * server.jitter)))
+
+        headers = {}
+        try:
+            if time.time() < server.outage_until and not endpoint.startswith('/fake/'):
+                server.count('outage', endpoint)
+                raise ApiError(503, 130, 'Over capacity')
+
+            quota = server.rate_limiter.hit(self.token(), endpoint)
+            if quota is not None:
+                limit, remaining, reset = quota
+                headers.update({'x-rate-limit-limit': str(limit), 'x-rate-limit-remaining': str(max(remaining, 0)),
+                                'x-rate-limit-reset': str(reset)})
+                if remaining < 0:
+                    server.count('rate_limited', endpoint)
+                    raise ApiError(429, 88, 'Rate limit exceeded')
+
+            route = server.routes.get((method, endpoint))
+            if route is None:
+                raise ApiError(404, 34, 'Sorry, that page does not exist.')
+            payload = route(params, body)
+            if params.get('include_entities') == 'false':
+                payload = without_entities(payload)
+            status = 200
+        except ApiError as e:
+            payload, status = e.to_json(), e.status
+            server.count('errors', f'{endpoint} {e.code or e.status}')
+        except (ValueError, KeyError) as e:
+            payload, status = ApiError(400, 44, f'Invalid parameter: {e}').to_json(), 400
+
+        data = json.dumps(payload).encode('utf-8')
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            data = gzip.compress(data, compresslevel=6)
+            headers['Content-Encoding'] = 'gzip'
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json;charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class FakeTwitterServer(ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, address: Tuple[str, int], data: FakeTwitterData, rate_limiter: RateLimiter,
+                 latency: float = 0., jitter: float = 0.2, certfile: Optional[str] = None,
+                 keyfile: Optional[str] = None):
+        """
+        Fake Twitter API over https
+        :param address: (host, port) to listen to
+        :param data: synthetic data to serve
+        :param rate_limiter: quotas of the tokens
+        :param latency: mean seconds each request takes
+        :param jitter: standard deviation of the latency, as a portion of it
+        :param certfile: certificate for TLS; a self-signed one is generated if None
+        :param keyfile: private key of the certificate
+        """
+        super().__init__(address, FakeTwitterHandler)
+        self.data = data
+        self.rate_limiter = rate_limiter
+        self.latency = latency
+        self.jitter = jitter
+        # epoch until which the API is down, see start_outage
+        self.outage_until = 0.
+
+        if certfile is None:
+            certfile, keyfile = generate_certificate(tempfile.mkdtemp(prefix='fake-twitter-'))
+        self.certfile = certfile
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(certfile, keyfile)
+        self.socket = context.wrap_socket(self.socket, server_side=True)
+
+        self.stats = {}  # type: Dict[str, Dict[str, int]]
+        self.stats_lock = threading.Lock()
+
+        self.routes = {
+            ('GET', '/account/verify_credentials.json'): lambda p, b: data.user(BOT_USER_ID),
+            ('GET', '/statuses/user_timeline.json'): self.user_timeline,
+            ('GET', '/statuses/show.json'): lambda p, b: data.status(int(p['id']), p.get('trim_user') == 'true'),
+            ('GET', '/statuses/lookup.json'): self.statuses_lookup,
+            ('POST', '/statuses/lookup.json'): self.statuses_lookup,
+            ('GET', '/statuses/mentions_timeline.json'): self.mentions_timeline,
+            ('GET', '/statuses/retweeters/ids.json'): self.retweeters,
+            ('GET', '/followers/list.json'): lambda p, b: self.users_page('/followers/list.json',
+                                                                          data.follower_ids, p, ids=False),
+            ('GET', '/followers/ids.json'): lambda p, b: self.users_page('/followers/ids.json',
+                                                                         data.follower_ids, p, ids=True),
+            ('GET', '/friends/list.json'): lambda p, b: self.users_page('/friends/list.json',
+                                                                        data.friend_ids, p, ids=False),
+            ('GET', '/friends/ids.json'): lambda p, b: self.users_page('/friends/ids.json',
+                                                                       data.friend_ids, p, ids=True),
+            ('POST', '/users/lookup.json'): self.users_lookup,
+            ('GET', '/users/lookup.json'): self.users_lookup,
+            ('POST', '/favorites/create.json'): self.create_favorite,
+            ('POST', '/statuses/update.json'): self.update_status,
+            ('POST', '/friendships/create.json'): self.create_friendship,
+            ('POST', '/direct_messages/events/new.json'): self.direct_message,
+            ('GET', '/fake/stats.json'): lambda p, b: self.get_stats(),
+            ('POST', '/fake/outage.json'): lambda p, b: self.start_outage(float(p['seconds'])),
+        }
+
+    def get_request(self):
+        # the TLS handshake of each new connection happens here
+        connection, address = super().get_request()
+        self.count('connections', 'tls_handshakes')
+        # headers and body are written apart: without this, Nagle's algorithm delays the body until the client acks
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return connection, address
+
+    def count(self, counter: str, key: str) -> None:
+        with self.stats_lock:
+            self.stats.setdefault(counter, {})
+            self.stats[counter][key] = self.stats[counter].get(key, 0) + 1
+
+    def start_outage(self, seconds: float) -> dict:
+        self.outage_until = time.time() + seconds
+        return dict(outage_until=self.outage_until)
+
+    def get_stats(self) -> Dict[str, Dict[str, int]]:
+        with self.stats_lock:
+            return {counter: dict(values) for counter, values in self.stats.items()}
+
+    def user_timeline(self, params: Dict[str, str], body: bytes) -> List[dict]:
+        user_id = self.data.user_id_from(params)
+        count = min(int(params.get('count', 20)), 200)
+        since_id = int(params['since_id']) if 'since_id' in params else None
+        max_id = int(params['max_id']) if 'max_id' in params else None
+        return self.data.timeline(user_id, count, since_id, max_id, params.get('trim_user') == 'true')
+
+    def statuses_lookup(self, params: Dict[str, str], body: bytes) -> List[dict]:
+        result = []
+        for tweet_id in params['id'].split(',')[:100]:
+            try:
+                result.append(self.data.status(int(tweet_id), params.get('trim_user') == 'true'))
+            except ApiError:
+                # unavailable tweets are just missing
+                continue
+        return result
+
+    def mentions_timeline(self, params: Dict[str, str], body: bytes) -> List[dict]:
+        count = min(int(params.get('count', 20)), 200)
+        since_id = int(params.get('since_id', 0))
+        max_id = int(params['max_id']) if 'max_id' in params else None
+        ids = sorted((tweet_id for tweet_id in self.data.mentions
+                      if tweet_id > since_id and (max_id is None or tweet_id <= max_id)), reverse=True)
+        return [self.data.status(tweet_id) for tweet_id in ids[:count]]
+
+    def retweeters(self, params: Dict[str, str], body: bytes) -> dict:
+        ids = self.data.follower_ids[:self.data.n_allowed_to_dm] if int(params['id']) == ACCEPT_DM_TWEET_ID else []
+        return self.users_page('/statuses/retweeters/ids.json', ids, params, ids=True)
+
+    def users_page(self, endpoint: str, user_ids: List[int], params: Dict[str, str], ids: bool) -> dict:
+        # cursors are offsets in the list; -1 is the first page
+        cursor = max(int(params.get('cursor', -1)), 0)
+        count = min(int(params.get('count', PAGE_SIZES[endpoint])), PAGE_SIZES[endpoint])
+        page = user_ids[cursor:cursor + count]
+        next_cursor = cursor + count if cursor + count < len(user_ids) else 0
+        # -1 stands for the first page, 0 for no page
+        previous_cursor = 0 if cursor == 0 else -1 if cursor <= count else cursor - count
+
+        result = dict(next_cursor=next_cursor, next_cursor_str=str(next_cursor), previous_cursor=previous_cursor,
+                      previous_cursor_str=str(previous_cursor))
+        if ids:
+            result['ids'] = page
+        else:
+            result['users'] = [self.data.user(user_id) for user_id in page]
+        return result
+
+    def users_lookup(self, params: Dict[str, str], body: bytes) -> List[dict]:
+        result = []
+        keys = [('user_id', value) for value in params.get('user_id', '').split(',') if value] + \
+               [('screen_name', value) for value in params.get('screen_name', '').split(',') if value]
+        for key, value in keys[:100]:
+            try:
+                result.append(self.data.user(self.data.user_id_from({key: value})))
+            except ApiError:
+                continue
+        return result
+
+    def create_favorite(self, params: Dict[str, str], body: bytes) -> dict:
+        status = self.data.status(int(params['id']))
+        self.count('writes', 'favorites')
+        status['favorited'] = True
+        return status
+
+    def update_status(self, params: Dict[str, str], body: bytes) -> dict:
+        in_reply_to = params.get('in_reply_to_status_id')
+        self.count('writes', 'tweets')
+        return self.data.new_bot_tweet(params['status'], int(in_reply_to) if in_reply_to else None)
+
+    def create_friendship(self, params: Dict[str, str], body: bytes) -> dict:
+        user = self.data.user(self.data.user_id_from(params))
+        self.count('writes', 'follows')
+        return user
+
+    def direct_message(self, params: Dict[str, str], body: bytes) -> dict:
+        message_create = json.loads(body)['event']['message_create']
+        recipient_id = int(message_create['target']['recipient_id'])
+        if not self.data.user_exists(recipient_id):
+            raise ApiError(404, 50, 'User not found.')
+        if recipient_id not in self.data.follower_ids[:self.data.n_allowed_to_dm]:
+            raise ApiError(403, 349, 'You cannot send messages to this user.')
+        self.count('writes', 'direct_messages')
+        return dict(event=dict(type='message_create', id=str(int(time.time() * 1000)),
+                               created_timestamp=str(int(time.time() * 1000)),
+                               message_create=dict(target=dict(recipient_id=str(recipient_id)),
+                                                   sender_id=str(BOT_USER_ID),
+                                                   message_data=message_create['message_data'])))
+
+
+def generate_certificate(directory: str, host: str = 'localhost') -> Tuple[str, str]:
+    """
+    Generate a self-signed certificate for host with the openssl command line
+    :param directory: where to write the files
+    :param host: name the clients use to reach the server
+    :return: pair of paths (certificate, private key); the certificate is also the CA bundle for the clients
+    """
+    certfile = os.path.join(directory, 'fake-twitter-cert.pem')
+    keyfile = os.path.join(directory, 'fake-twitter-key.pem')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '30',
+                    '-keyout', keyfile, '-out', certfile, '-subj', f'/CN={host}',
+                    '-addext', f'subjectAltName=DNS:{host},IP:127.0.0.1'],
+                   check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return certfile, keyfile
+
+
+def start_fake_twitter_api(port: int = 0, latency: float = 0., **data_kwargs) -> FakeTwitterServer:
+    """
+    Start the fake API in a background thread, e.g. for benchmarks running the bot in the same process
+    :param port: port to listen to in localhost; 0 for any free port
+    :param latency: mean seconds each request takes
+    :param data_kwargs: arguments for FakeTwitterData
+    :return: the running server; its address is server.server_address and its CA bundle server.certfile
+    """
+    server = FakeTwitterServer(('localhost', port), FakeTwitterData(**data_kwargs), RateLimiter(), latency=latency)
+    threading.Thread(target=server.serve_forever, name='fake-twitter-api', daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+
+    logging.basicConfig(level=LOG_LEVEL, format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s',
+                        datefmt='%y-%m-%d %H:%M:%S')
+
+    parser = argparse.ArgumentParser(description="Local stand-in for the Twitter API, with synthetic data.")
+    parser.add_argument("--port", help="Port to listen to in localhost.", type=int, default=8443)
+    parser.add_argument("--users", help="Number of accounts.", type=int, default=2000)
+    parser.add_argument("--followers", help="Number of followers of the bot.", type=int, default=1000)
+    parser.add_argument("--friends", help="Number of friends of the bot.", type=int, default=500)
+    parser.add_argument("--allowed-to-dm", help="Number of followers who accepted DMs.", type=int, default=200)
+    parser.add_argument("--tweets-per-user", help="Length of each timeline.", type=int, default=200)
+    parser.add_argument("--image-rate", help="Portion of tweets with images.", type=float, default=0.3)
+    parser.add_argument("--alt-text-rate", help="Portion of images with alt_text.", type=float, default=0.4)
+    parser.add_argument("--mentions", help="Number of tweets mentioning the bot.", type=int, default=50)
+    parser.add_argument("--seed", help="Seed of the synthetic data.", type=int, default=0)
+    parser.add_argument("--latency", help="Mean seconds each request takes.", type=float, default=0.)
+    parser.add_argument("--rate-limit-window", help="Seconds of the rate limit windows.", type=float,
+                        default=15 * 60)
+    parser.add_argument("--rate-limit-scale", help="Factor applied to the documented rate limits.", type=float,
+                        default=1.)
+    parser.add_argument("--certfile", help="TLS certificate; a self-signed one is generated if missing.",
+                        default=None)
+    parser.add_argument("--keyfile", help="Private key of the TLS certificate.", default=None)
+    args = parser.parse_args()
+
+    fake_data = FakeTwitterData(n_users=args.users, n_followers=args.followers, n_friends=args.friends,
+                                n_allowed_to_dm=args.allowed_to_dm, tweets_per_user=args.tweets_per_user,
+                                image_rate=args.image_rate, alt_text_rate=args.alt_text_rate,
+                                n_mentions=args.mentions, seed=args.seed)
+    fake_server = FakeTwitterServer(('localhost', args.port), fake_data,
+                                    RateLimiter(args.rate_limit_window, args.rate_limit_scale),
+                                    latency=args.latency, certfile=args.certfile, keyfile=args.keyfile)
+
+    print(f'Fake Twitter API listening on https://localhost:{args.port}{API_ROOT}')
+    print(f'    export TWITTER_API_HOST=localhost:{args.port}')
+    print(f'    export TWITTER_API_CA_BUNDLE={fake_server.certfile}')
+    try:
+        fake_server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        fake_server.server_close()
@@ -0,0 +1,37 @@
+import argparse
+import os
+import sys
+import tempfile
+
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from benchmarks.bench_flows import FakeApiProcess, free_port  # noqa: E402
+
+# settings reads the host of the API when imported, before any test runs: point it to the fake API of the tests
+FAKE_API_DIR = tempfile.mkdtemp(prefix='altbot-tests-')
+FAKE_API_PORT = free_port()
+os.environ['TWITTER_API_HOST'] = f'localhost:{FAKE_API_PORT}'
+os.environ['TWITTER_API_CA_BUNDLE'] = os.path.join(FAKE_API_DIR, 'fake-twitter-cert.pem')
+
+# workload of the fake API; FakeTwitterData(n_users=60, n_followers=30, n_allowed_to_dm=6) has the same accounts
+FAKE_API_WORKLOAD = argparse.Namespace(followers=30, tweets_per_user=10, image_rate=0.3, mentions=0, latency=0.,
+                                       rate_limit_scale=1., seed=0)
+
+
+@pytest.fixture(scope='session')
+def fake_api():
+    api = FakeApiProcess(FAKE_API_PORT, FAKE_API_DIR, FAKE_API_WORKLOAD)
+    yield api
+    api.stop()
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    # the bot uses paths relative to the repo: data_access_layer/ for the DB, log/ for the reports
+    (tmp_path / 'data_access_layer').mkdir()
+    (tmp_path / 'log').mkdir()
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
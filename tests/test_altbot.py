@@ -0,0 +1,55 @@
+import pytest
+
+import altBot_main
+from altBot_main import AltBot
+from simulation.fake_twitter_api import FakeTwitterData
+
+
+@pytest.fixture
+def bot(fake_api, workdir):
+    bot = AltBot(live=True)
+    data = FakeTwitterData(n_users=60, n_followers=30, n_allowed_to_dm=6)
+    bot.db.update_followers({(f'user{user_id}', user_id) for user_id in data.follower_ids}, set())
+    return bot
+
+
+def test_broadcast_resumes_without_resending(bot, fake_api, monkeypatch):
+    monkeypatch.setattr(altBot_main, 'BROADCAST_DMS_PER_MINUTE', 60000)
+    dms_before = fake_api.stats().get('writes', {}).get('direct_messages', 0)
+
+    # the quota stops the first run halfway
+    monkeypatch.setattr(altBot_main, 'DM_QUOTA_PER_DAY', 10)
+    report = bot.send_message_to_all_followers('hello')
+    assert sum(status['attempts'] for status in report.values()) == 10
+    assert report['pending']['recipients'] == 20
+
+    monkeypatch.setattr(altBot_main, 'DM_QUOTA_PER_DAY', 1000)
+    report = bot.send_message_to_all_followers('hello')
+    assert 'pending' not in report
+    assert sum(status['attempts'] for status in report.values()) == 30
+    # only the followers who allowed DMs get them, once
+    assert report['sent'] == dict(recipients=6, attempts=6)
+    assert fake_api.stats()['writes']['direct_messages'] - dms_before == 6
+
+
+def test_backfill_holds_the_checkpoint_before_tweets_without_suggestions(bot, monkeypatch):
+    bot.live = False
+    bot.watch_for_alt_text_usage_in_followers()
+    monkeypatch.setattr(altBot_main, 'CAPTIONING_ENABLED', True)
+
+    n_calls = []
+
+    def suggest_alt_texts(urls):
+        # the captioner fails the images of the second chunk
+        n_calls.append(len(urls))
+        return [None if len(n_calls) == 2 else 'a picture'] * len(urls)
+
+    monkeypatch.setattr(altBot_main, 'suggest_alt_texts', suggest_alt_texts)
+    bot.backfill_captions(chunk_size=5)
+    checkpoint = int(bot.db.get_setting(altBot_main.BACKFILL_CAPTIONS_CHECKPOINT_KEY))
+    pending = bot.db.get_tweets_without_bot_alt_text(0, 1000)
+    assert pending and checkpoint == pending[0]['row'] - 1
+
+    monkeypatch.setattr(altBot_main, 'suggest_alt_texts', lambda urls: ['a picture'] * len(urls))
+    bot.backfill_captions(chunk_size=5)
+    assert bot.db.get_tweets_without_bot_alt_text(0, 1000) == []
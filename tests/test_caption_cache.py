@@ -0,0 +1,50 @@
+import pytest
+
+from data_access_layer.caption_cache import CaptionCache
+
+IMAGE_HASH = 0xF0F0_1234_ABCD_8001
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = CaptionCache(str(tmp_path / 'cache.db'), max_bytes=1 << 20, max_distance=3)
+    cache.save('https://pbs.twimg.com/media/a.jpg', IMAGE_HASH, 'a dog', 'caption')
+    return cache
+
+
+def test_hits_by_url(cache):
+    assert cache.get_by_url('https://pbs.twimg.com/media/a.jpg') == ('a dog', 'caption')
+    assert cache.get_by_url('https://pbs.twimg.com/media/b.jpg') is None
+
+
+@pytest.mark.parametrize('flipped_bits', [
+    [],
+    # all in one band
+    [0, 1, 2],
+    # one per band: the fourth band still matches
+    [0, 16, 32],
+    # the sign bit, stored as a negative integer by SQLite
+    [63],
+])
+def test_near_duplicates_hit_by_hash(cache, flipped_bits):
+    near_hash = IMAGE_HASH
+    for bit in flipped_bits:
+        near_hash ^= 1 << bit
+    assert cache.get_by_hash(near_hash) == ('a dog', 'caption')
+
+
+def test_images_too_far_away_miss(cache):
+    # 4 bits, one in each band
+    assert cache.get_by_hash(IMAGE_HASH ^ (1 | 1 << 16 | 1 << 32 | 1 << 48)) is None
+    # 4 bits in a single band: the band candidates are compared bit by bit
+    assert cache.get_by_hash(IMAGE_HASH ^ 0xF) is None
+
+
+def test_the_closest_image_wins(cache):
+    cache.save('https://pbs.twimg.com/media/b.jpg', IMAGE_HASH ^ 0b1, 'a puppy', 'caption')
+    assert cache.get_by_hash(IMAGE_HASH ^ 0b11) == ('a puppy', 'caption')
+
+
+def test_bands_must_find_every_near_duplicate(tmp_path):
+    with pytest.raises(ValueError):
+        CaptionCache(str(tmp_path / 'cache.db'), max_distance=4)
@@ -0,0 +1,127 @@
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+import requests
+import tweepy
+
+from api_access_layer.circuit_breaker import CircuitBreaker, CircuitBreakers, CircuitOpenError, is_outage, CLOSED, \
+    HALF_OPEN, OPEN
+
+
+def api_error(status_code=None, context=None):
+    try:
+        try:
+            if context is not None:
+                raise context
+            raise tweepy.TweepError('error', SimpleNamespace(status_code=status_code) if status_code else None)
+        except tweepy.TweepError:
+            raise
+        except Exception as e:
+            # as tweepy wraps the errors of requests
+            raise tweepy.TweepError(f'Failed to send request: {e}')
+    except tweepy.TweepError as e:
+        return e
+
+
+def test_only_errors_of_the_api_being_down_are_outages():
+    assert is_outage(api_error(503))
+    assert is_outage(api_error(context=requests.exceptions.ConnectionError('refused')))
+    assert is_outage(api_error(context=requests.exceptions.ReadTimeout('timed out')))
+    assert not is_outage(api_error(404))
+    assert not is_outage(api_error(429))
+    assert not is_outage(api_error(context=requests.exceptions.InvalidURL('bad url')))
+    # raised by tweepy itself, e.g. a payload it can not parse
+    assert not is_outage(api_error())
+
+
+def test_circuit_open_error_is_not_caught_as_an_api_error():
+    assert not issubclass(CircuitOpenError, tweepy.TweepError)
+
+
+def breaker(**kwargs):
+    return CircuitBreaker('tweets', **dict(dict(failure_threshold=2, base_delay=0.2, max_delay=0.2, max_pause=5),
+                                            **kwargs))
+
+
+def test_circuit_opens_after_failures_in_a_row():
+    circuit = breaker()
+    circuit.failure()
+    circuit.success()
+    circuit.failure()
+    assert circuit.state == CLOSED
+
+    circuit.failure()
+    assert circuit.state == OPEN
+
+
+def test_calls_give_up_after_max_pause():
+    circuit = breaker(max_pause=0.05)
+    circuit.failure()
+    circuit.failure()
+
+    begin = time.time()
+    with pytest.raises(CircuitOpenError):
+        circuit.acquire()
+    assert time.time() - begin < 0.2
+
+
+def test_a_single_call_probes_the_api_when_half_open():
+    circuit = breaker()
+    circuit.failure()
+    circuit.failure()
+
+    begin = time.time()
+    circuit.acquire()
+    # the backoff is jittered between half and all of base_delay
+    assert time.time() - begin >= 0.1
+    assert circuit.state == HALF_OPEN and circuit.probing
+
+    waited = []
+
+    def call():
+        circuit.acquire()
+        waited.append(time.time())
+
+    waiting = threading.Thread(target=call)
+    waiting.start()
+    time.sleep(0.1)
+    assert not waited
+
+    probe_done = time.time()
+    circuit.success()
+    waiting.join(1)
+    assert circuit.state == CLOSED
+    assert waited and waited[0] >= probe_done
+
+
+def test_a_failed_probe_opens_the_circuit_again():
+    circuit = breaker()
+    circuit.failure()
+    circuit.failure()
+    circuit.acquire()
+
+    circuit.failure()
+    assert circuit.state == OPEN and not circuit.probing
+    assert circuit.n_opens == 2
+
+
+def test_an_interrupted_probe_lets_another_call_probe():
+    circuit = breaker()
+    circuit.failure()
+    circuit.failure()
+    circuit.acquire()
+
+    circuit.release()
+    circuit.acquire()
+    assert circuit.state == HALF_OPEN and circuit.probing
+
+
+def test_endpoints_share_the_breaker_of_their_group():
+    breakers = CircuitBreakers(failure_threshold=1)
+    assert breakers.for_method('get_status') is breakers.for_method('statuses_lookup')
+    assert breakers.for_method('get_status') is not breakers.for_method('update_status')
+    assert breakers.for_method('get_status').failure_threshold == 1
+    assert breakers.retryable('user_timeline')
+    assert not breakers.retryable('send_direct_message')
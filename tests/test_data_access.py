@@ -0,0 +1,190 @@
+import time
+
+import pytest
+
+from data_access_layer.data_access import DBAccess
+from settings import BACKFILL_CAPTIONS_CHECKPOINT_KEY
+
+
+@pytest.fixture
+def db_file(tmp_path):
+    return str(tmp_path / 'bot.db')
+
+
+def photo(media_key, alt_text=None, bot_alt_text=None):
+    return dict(media_key=media_key, url=f'https://pbs.twimg.com/media/{media_key}.jpg', alt_text=alt_text,
+                bot_alt_text=bot_alt_text)
+
+
+def save_image_tweet(db, tweet_id, user_id, photos):
+    db.save_processed_tweet(tweet_id, user_id)
+    db.index_tweet_media(tweet_id, user_id, photos)
+    db.save_processed_tweet_with_with_alt_text_info(f'user{user_id}', user_id, tweet_id, len(photos), 0.)
+
+
+def count_rows(connection, table):
+    return connection.execute(f'SELECT Count(*) FROM {table}').fetchone()[0]
+
+
+def test_processed_tweets_go_to_the_shard_of_their_author(db_file):
+    db = DBAccess(db_file, 3)
+
+    save_image_tweet(db, '100', 4, [photo('m1')])
+    db.update_bot_alt_text_info('100', 4, bot_alt_text_1='a dog')
+
+    assert count_rows(db.shards[1], 'processed_tweets') == 1
+    assert count_rows(db.shards[1], 'processed_tweets_alt_text_info') == 1
+    assert count_rows(db.shards[1], 'media_index') == 1
+    for shard in (0, 2):
+        assert count_rows(db.shards[shard], 'processed_tweets') == 0
+    assert count_rows(db.connection, 'processed_tweets') == 0
+
+    assert db.tweet_was_processed('100')
+    assert not db.tweet_was_processed('101')
+    assert db.get_alt_text_info_from_tweet('100')['bot_alt_text'][0] == 'a dog'
+    assert [p['media_key'] for p in db.get_tweet_media('100')] == ['m1']
+    assert db.get_media('m1')['url'].endswith('m1.jpg')
+
+
+def test_moving_to_shards_keeps_every_row_and_resets_the_backfill(db_file):
+    db = DBAccess(db_file, 1)
+    save_image_tweet(db, '100', 4, [photo('m1'), photo('m2', alt_text='a cat')])
+    save_image_tweet(db, '200', 5, [photo('m3')])
+    # without images there is no known author
+    db.save_processed_tweet('301', 7)
+    db.set_setting(BACKFILL_CAPTIONS_CHECKPOINT_KEY, '2')
+    del db
+
+    db = DBAccess(db_file, 3)
+
+    for table in ('processed_tweets', 'processed_tweets_alt_text_info', 'tweet_media', 'media_index'):
+        assert count_rows(db.connection, table) == 0
+    assert count_rows(db.shards[1], 'processed_tweets_alt_text_info') == 1
+    assert count_rows(db.shards[2], 'processed_tweets_alt_text_info') == 1
+    assert count_rows(db.shards[1], 'tweet_media') == 2
+    # 100 by its author, 301 by its id
+    assert count_rows(db.shards[1], 'processed_tweets') == 2
+    assert all(db.tweet_was_processed(tweet_id) for tweet_id in ('100', '200', '301'))
+    assert db.get_media('m2')['alt_text'] == 'a cat'
+    assert db.get_setting(BACKFILL_CAPTIONS_CHECKPOINT_KEY) is None
+
+    # opening it again does not move anything
+    del db
+    db = DBAccess(db_file, 3)
+    assert sum(count_rows(shard, 'processed_tweets') for shard in db.shards) == 3
+
+
+def test_backfill_reads_each_shard_by_row(db_file):
+    db = DBAccess(db_file, 2)
+    for i, user_id in enumerate([2, 3, 4, 5, 6]):
+        save_image_tweet(db, str(100 + i), user_id, [photo(f'm{i}')])
+
+    chunk = db.get_tweets_without_bot_alt_text(0, 10, shard=0)
+    assert [tweet['user_id'] for tweet in chunk] == [2, 4, 6]
+    assert db.get_tweets_without_bot_alt_text(chunk[0]['row'], 10, shard=0)[0]['user_id'] == 4
+
+    db.update_bot_alt_text_info_bulk({chunk[0]['tweet_id']: ['a dog']}, shard=0)
+    assert [tweet['user_id'] for tweet in db.get_tweets_without_bot_alt_text(0, 10, shard=0)] == [4, 6]
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000000.]
+    monkeypatch.setattr(time, 'time', lambda: now[0])
+    return now
+
+
+def enqueue(db, user_ids, kind='follower'):
+    db.enqueue_scan_jobs(kind, [(f'user{user_id}', user_id, False, 0.) for user_id in user_ids])
+
+
+def test_claimed_scan_jobs_are_not_claimed_again_until_the_lease_expires(db_file, clock):
+    db = DBAccess(db_file, 1)
+    enqueue(db, [1, 2, 3])
+
+    first = db.claim_scan_jobs('follower', 'a', 2, lease_seconds=60)
+    second = db.claim_scan_jobs('follower', 'b', 2, lease_seconds=120)
+    assert len(first) == 2 and len(second) == 1
+    assert {job[1] for job in first} | {job[1] for job in second} == {1, 2, 3}
+    assert db.claim_scan_jobs('follower', 'b', 2, lease_seconds=60) == []
+
+    clock[0] += 30
+    assert db.renew_scan_job_lease('follower', first[0][1], 'a', 60)
+    assert not db.renew_scan_job_lease('follower', first[0][1], 'b', 60)
+
+    # the lease of the other job of a was not renewed: b takes it over
+    clock[0] += 31
+    taken = db.claim_scan_jobs('follower', 'b', 5, lease_seconds=60)
+    assert [job[1] for job in taken] == [first[1][1]]
+    assert not db.renew_scan_job_lease('follower', first[1][1], 'a', 60)
+
+    # a can not finish a job it lost
+    db.complete_scan_job('follower', first[1][1], 'a', True, 3)
+    assert db.count_scan_jobs('follower') == {'leased': 3}
+
+
+def test_scan_jobs_are_retried_until_max_attempts(db_file, clock):
+    db = DBAccess(db_file, 1)
+    enqueue(db, [1])
+
+    for _ in range(2):
+        db.claim_scan_jobs('follower', 'a', 1, lease_seconds=60)
+        db.complete_scan_job('follower', 1, 'a', False, 2)
+    assert db.count_scan_jobs('follower') == {'failed': 1}
+
+    # queued again by the next run
+    enqueue(db, [1])
+    db.claim_scan_jobs('follower', 'a', 1, lease_seconds=60)
+    db.complete_scan_job('follower', 1, 'a', True, 2)
+    assert db.count_scan_jobs('follower') == {'done': 1}
+
+
+def test_released_and_expired_scan_jobs_go_back_to_the_queue(db_file, clock):
+    db = DBAccess(db_file, 1)
+    enqueue(db, [1, 2])
+    db.claim_scan_jobs('follower', 'a', 2, lease_seconds=60)
+    assert db.get_scan_job_lease_owners('follower') == {'a'}
+
+    db.release_scan_jobs('follower', [1], 'a')
+    assert db.count_scan_jobs('follower') == {'pending': 1, 'leased': 1}
+
+    db.expire_scan_job_leases('follower', 'a')
+    assert {job[1] for job in db.claim_scan_jobs('follower', 'b', 2, lease_seconds=60)} == {1, 2}
+    assert db.get_scan_job_lease_owners('follower') == {'b'}
+
+
+def test_negative_cache_entries_expire(db_file, clock):
+    db = DBAccess(db_file, 1)
+    db.add_negative_cache('user', 1, 63, ttl=60)
+    db.add_negative_cache('tweet', '100', 144, ttl=10)
+
+    assert db.get_negative_cache('user', 1) == 63
+    assert db.get_negative_cache('tweet', 100) == 144
+    assert db.get_negative_cache('tweet', 1) is None
+
+    clock[0] += 30
+    assert db.get_negative_cache('tweet', '100') is None
+    assert db.get_negative_cache('user', 1) == 63
+
+    # expired entries are removed when adding
+    db.add_negative_cache('user', 2, 63, ttl=60)
+    assert count_rows(db.connection, 'negative_cache') == 2
+
+
+def test_broadcast_deliveries_resume_where_they_stopped(db_file):
+    db = DBAccess(db_file, 1)
+    recipients = {('user1', 1), ('user2', 2), ('user3', 3)}
+    db.add_broadcast_recipients('b', recipients)
+
+    db.update_broadcast_delivery('b', 1, 'sent')
+    db.update_broadcast_delivery('b', 2, 'failed', 'timeout')
+
+    # registering them again keeps their state
+    db.add_broadcast_recipients('b', recipients)
+    assert db.get_pending_broadcast_recipients('b', max_attempts=2) == [('user2', 2), ('user3', 3)]
+    assert db.get_pending_broadcast_recipients('b', max_attempts=1) == [('user3', 3)]
+
+    db.update_broadcast_delivery('b', 3, 'closed', 'DMs closed')
+    assert db.get_broadcast_report('b') == {'sent': dict(recipients=1, attempts=1),
+                                            'failed': dict(recipients=1, attempts=1),
+                                            'closed': dict(recipients=1, attempts=1)}
@@ -0,0 +1,103 @@
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+import tweepy
+
+from api_access_layer.rate_limiter import RateLimiter
+from api_access_layer.token_pool import BOT_TOKEN, TokenPool
+
+
+class FakeApi:
+    """
+    Stand-in for tweepy.API answering get_status with the given rate limit headers, or failing with the given error
+    """
+
+    def __init__(self, remaining=None, error=None):
+        self.remaining = remaining
+        self.error = error
+        self.last_response = None
+        self.n_calls = 0
+
+    def get_status(self, tweet_id):
+        self.n_calls += 1
+        if self.error is not None:
+            raise self.error
+        headers = {}
+        if self.remaining is not None:
+            headers = {'x-rate-limit-remaining': str(self.remaining), 'x-rate-limit-reset': str(time.time() + 900)}
+            self.remaining -= 1
+        self.last_response = SimpleNamespace(headers=headers)
+        return tweet_id
+
+
+def pool(*apis):
+    token_pool = TokenPool([('key', 'secret', 'token', 'token_secret')] * len(apis))
+    token_pool.apis = list(apis)
+    return token_pool
+
+
+def test_calls_go_to_the_token_with_more_remaining_calls():
+    apis = [FakeApi(remaining=5), FakeApi(remaining=50)]
+    token_pool = pool(*apis)
+
+    # tokens never used go first, then the one with more quota left
+    for _ in range(4):
+        token_pool.call('get_status', '1')
+    assert [api.n_calls for api in apis] == [1, 3]
+    assert token_pool.n_calls == 4
+
+
+def test_a_token_can_be_forced():
+    apis = [FakeApi(remaining=5), FakeApi(remaining=50)]
+    token_pool = pool(*apis)
+    token_pool.call('get_status', '1')
+    token_pool.call('get_status', '1')
+
+    token_pool.call('get_status', '1', token=BOT_TOKEN)
+    assert apis[0].n_calls == 2
+
+
+def test_rate_limited_tokens_are_skipped():
+    apis = [FakeApi(error=tweepy.RateLimitError('too many requests')), FakeApi()]
+    token_pool = pool(*apis)
+
+    assert token_pool.call('get_status', '1') == '1'
+    assert token_pool.call('get_status', '2') == '2'
+    assert [api.n_calls for api in apis] == [1, 2]
+
+
+def test_rejected_tokens_are_removed_from_the_pool():
+    apis = [FakeApi(error=tweepy.TweepError('expired', api_code=89)), FakeApi()]
+    token_pool = pool(*apis)
+
+    assert token_pool.call('get_status', '1') == '1'
+    assert token_pool.invalid == {0}
+
+    with pytest.raises(tweepy.TweepError):
+        token_pool.call('get_status', '1', token=0)
+
+
+def test_errors_about_the_request_are_raised_without_trying_other_tokens():
+    apis = [FakeApi(error=tweepy.TweepError('not found', api_code=[144, 34])), FakeApi()]
+    token_pool = pool(*apis)
+
+    with pytest.raises(tweepy.TweepError):
+        token_pool.call('get_status', '1')
+    assert [api.n_calls for api in apis] == [1, 0]
+    assert token_pool.invalid == set()
+
+
+def test_rate_limiter_spreads_calls_after_the_burst():
+    limiter = RateLimiter(rate=50, burst=2)
+    waits = []
+
+    threads = [threading.Thread(target=lambda: waits.append(limiter.acquire())) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # the burst goes right away, the other threads queue one call every 1 / rate seconds
+    assert sorted(waits) == pytest.approx([0., 0., 0.02, 0.04], abs=0.01)